@@ -0,0 +1,168 @@
+"""数据库连接配置档位
+
+通过环境变量 DB_PROFILE 选择：
+
+- serverless（默认）：Vercel 等 Serverless 环境，每个请求结束即关闭连接，
+  连接复用交给 Supabase/PgBouncer 等外部连接池（pooler）。
+- persistent：gunicorn 等常驻进程，每个工作线程持有一个长连接，
+  请求开始时做健康检查（CONN_HEALTH_CHECKS）。
+- pooled：使用 Django 5.1+ 内置的 psycopg 3 连接池（需要安装 psycopg[pool]）。
+
+连接 PgBouncer 事务模式（Supabase 6543 端口）时必须禁用服务端游标，
+配置冲突会在启动时抛出 ImproperlyConfigured。除非用 DB_POOLER_MODE=none 声明直连数据库，
+服务端游标默认禁用。
+
+未配置 DATABASE_URL 时使用本地 SQLite，见 build_sqlite_config。
+"""
+import os
+from urllib.parse import urlparse
+
+from django.core.exceptions import ImproperlyConfigured
+
+PROFILES = ('serverless', 'persistent', 'pooled')
+
+# Supabase 事务模式 pooler 的默认端口
+TRANSACTION_POOLER_PORT = 6543
+
+
+def _env_bool(environ, name, default):
+    value = environ.get(name)
+    if value is None or value == '':
+        return default
+    return value.lower() in ('true', '1', 'yes')
+
+
+def _env_int(environ, name, default):
+    value = environ.get(name)
+    if value is None or value == '':
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        raise ImproperlyConfigured(f'{name} 必须是整数，当前值: {value!r}')
+
+
+def detect_pooler_mode(database_url, environ=os.environ):
+    """判断数据库连接经过的 pooler 模式
+
+    优先使用 DB_POOLER_MODE（transaction / session / none），
+    未配置时按端口推断：6543 为 Supabase 事务模式 pooler。
+    """
+    mode = environ.get('DB_POOLER_MODE', '').lower()
+    if mode:
+        if mode not in ('transaction', 'session', 'none'):
+            raise ImproperlyConfigured(f'DB_POOLER_MODE 只支持 transaction/session/none，当前值: {mode!r}')
+        return mode
+
+    port = urlparse(database_url).port
+    if port == TRANSACTION_POOLER_PORT:
+        return 'transaction'
+    return 'none'
+
+
+def build_database_config(database_url, environ=os.environ):
+    """根据 DB_PROFILE 生成 DATABASES['default'] 配置"""
+    import dj_database_url
+
+    profile = environ.get('DB_PROFILE', 'serverless').lower()
+    if profile not in PROFILES:
+        raise ImproperlyConfigured(f'DB_PROFILE 只支持 {"/".join(PROFILES)}，当前值: {profile!r}')
+
+    config = dj_database_url.parse(database_url)
+    options = config.setdefault('OPTIONS', {})
+
+    # Supabase PostgreSQL SSL 配置：URL 中没有 sslmode 参数时强制 SSL
+    if 'sslmode' not in database_url.lower():
+        options['sslmode'] = 'require'
+
+    # 连接超时和 keepalive 设置
+    options['connect_timeout'] = _env_int(environ, 'DB_CONNECT_TIMEOUT', 10)
+    options['keepalives'] = 1
+    options['keepalives_idle'] = 30
+    options['keepalives_interval'] = 10
+    options['keepalives_count'] = 5
+
+    if profile == 'serverless':
+        # 函数实例随时被冻结，不保留连接；连接池大小由外部 pooler 控制
+        config['CONN_MAX_AGE'] = 0
+        config['CONN_HEALTH_CHECKS'] = False
+    elif profile == 'persistent':
+        # 每个工作线程一个长连接（连接数 = 进程数 × 线程数）
+        config['CONN_MAX_AGE'] = _env_int(environ, 'DB_CONN_MAX_AGE', 600)
+        config['CONN_HEALTH_CHECKS'] = True
+    else:
+        # Django 内置连接池要求 CONN_MAX_AGE = 0，由连接池负责复用
+        try:
+            import psycopg  # noqa: F401
+            import psycopg_pool  # noqa: F401
+        except ImportError:
+            raise ImproperlyConfigured('DB_PROFILE=pooled 需要安装 psycopg 3 连接池：pip install "psycopg[binary,pool]"')
+        min_size = _env_int(environ, 'DB_POOL_MIN_SIZE', 2)
+        max_size = _env_int(environ, 'DB_POOL_MAX_SIZE', 10)
+        if min_size < 0 or max_size < 1 or min_size > max_size:
+            raise ImproperlyConfigured(f'连接池大小无效: DB_POOL_MIN_SIZE={min_size}, DB_POOL_MAX_SIZE={max_size}')
+        config['CONN_MAX_AGE'] = 0
+        config['CONN_HEALTH_CHECKS'] = False
+        options['pool'] = {
+            'min_size': min_size,
+            'max_size': max_size,
+            'timeout': _env_int(environ, 'DB_POOL_TIMEOUT', 10),
+        }
+
+    # 事务模式 pooler 不会把同一个服务端会话保留给游标，必须禁用服务端游标。
+    # 按端口推断不出的 pooler（自建 PgBouncer、Supabase 5432 端口的 Supavisor 等）同样可能是事务模式，
+    # 所以默认禁用，只有显式声明 DB_POOLER_MODE=none（直连数据库）时才默认启用
+    pooler_mode = detect_pooler_mode(database_url, environ)
+    direct_connection = environ.get('DB_POOLER_MODE', '').lower() == 'none'
+    disable_server_side_cursors = _env_bool(
+        environ, 'DB_DISABLE_SERVER_SIDE_CURSORS', not direct_connection
+    )
+    if pooler_mode == 'transaction' and not disable_server_side_cursors:
+        raise ImproperlyConfigured(
+            '数据库连接经过事务模式 pooler（PgBouncer/Supabase 6543 端口），'
+            '不能启用服务端游标，请移除 DB_DISABLE_SERVER_SIDE_CURSORS=False'
+        )
+    config['DISABLE_SERVER_SIDE_CURSORS'] = disable_server_side_cursors
+
+    return config
+
+
+# SQLite synchronous / journal_mode 允许的取值（拼接进 init_command，不能直接使用环境变量原值）
+SQLITE_SYNCHRONOUS_MODES = ('OFF', 'NORMAL', 'FULL', 'EXTRA')
+SQLITE_JOURNAL_MODES = ('DELETE', 'TRUNCATE', 'PERSIST', 'MEMORY', 'WAL', 'OFF')
+
+
+def build_sqlite_config(path, environ=os.environ):
+    """单机 SQLite 部署的连接配置
+
+    - transaction_mode=IMMEDIATE：事务开始即获取写锁。默认的 DEFERRED 事务先读后写，
+      两个事务都持有读锁后同时升级为写锁时，SQLite 直接返回 "database is locked"，busy_timeout 也不会等待；
+    - timeout：等待其他连接释放写锁的秒数（busy_timeout）；
+    - WAL + synchronous=NORMAL：读写互不阻塞，提交时不再每次 fsync；
+    - mmap_size：用内存映射读取数据库文件，减少系统调用。
+    """
+    synchronous = environ.get('SQLITE_SYNCHRONOUS', 'NORMAL').upper()
+    if synchronous not in SQLITE_SYNCHRONOUS_MODES:
+        raise ImproperlyConfigured(
+            f'SQLITE_SYNCHRONOUS 只支持 {"/".join(SQLITE_SYNCHRONOUS_MODES)}，当前值: {synchronous!r}'
+        )
+    journal_mode = environ.get('SQLITE_JOURNAL_MODE', 'WAL').upper()
+    if journal_mode not in SQLITE_JOURNAL_MODES:
+        raise ImproperlyConfigured(
+            f'SQLITE_JOURNAL_MODE 只支持 {"/".join(SQLITE_JOURNAL_MODES)}，当前值: {journal_mode!r}'
+        )
+    pragmas = [
+        f'PRAGMA journal_mode={journal_mode}',
+        f'PRAGMA synchronous={synchronous}',
+        f'PRAGMA mmap_size={_env_int(environ, "SQLITE_MMAP_SIZE", 256 * 1024 * 1024)}',
+        'PRAGMA temp_store=MEMORY',
+    ]
+    return {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': path,
+        'OPTIONS': {
+            'transaction_mode': 'IMMEDIATE',
+            'timeout': _env_int(environ, 'SQLITE_BUSY_TIMEOUT', 20),
+            'init_command': '; '.join(pragmas),
+        },
+    }
@@ -1,27 +1,77 @@
 import base64
+import hmac
+import logging
 import os
+import re
 
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.core import signing
+from django.core.exceptions import MiddlewareNotUsed
 from django.http import HttpResponse
+from django.utils.crypto import salted_hmac
+
+logger = logging.getLogger(__name__)
+
+
+def _env_bool(name, default='False'):
+    return os.environ.get(name, default).lower() in ('true', '1', 'yes')
 
 
 class BasicAuthMiddleware:
     """
     Basic Auth 认证中间件
     通过 HTTP Basic Authentication 保护整个网站
+
+    所有配置在启动时读取一次：期望的 Authorization 头预先计算好，请求时只做一次常量时间比较；
+    排除路径编译为一个正则。认证成功后可下发签名 Cookie（BASIC_AUTH_COOKIE_AGE 秒内有效），
+    之后的请求先校验 Cookie，有效即放行，不再比较 Authorization 头；
+    Cookie 缺失或失效时才校验 Authorization 头并重新下发 Cookie。
+    未启用且未开启调试头时，中间件在启动时移除自身（MiddlewareNotUsed）。
     """
 
+    sync_capable = True
+    async_capable = True
+
+    COOKIE_NAME = 'basic_auth'
+    COOKIE_SALT = 'core.middleware.BasicAuthMiddleware'
+
     def __init__(self, get_response):
         self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
         # 从环境变量获取认证信息
-        self.username = os.environ.get('BASIC_AUTH_USERNAME', '')
-        self.password = os.environ.get('BASIC_AUTH_PASSWORD', '')
+        username = os.environ.get('BASIC_AUTH_USERNAME', '')
+        password = os.environ.get('BASIC_AUTH_PASSWORD', '')
         # 是否启用 Basic Auth
-        self.enabled = os.environ.get('BASIC_AUTH_ENABLED', 'False').lower() in ('true', '1', 'yes')
+        self.enabled = _env_bool('BASIC_AUTH_ENABLED')
+        # 调试：是否在响应中添加 X-BasicAuth-* 头部显示中间件状态
+        self.debug_headers = _env_bool('BASIC_AUTH_DEBUG_HEADERS')
+
+        if not self.enabled and not self.debug_headers:
+            raise MiddlewareNotUsed('Basic Auth 未启用')
+
+        # 如果未配置用户名或密码，记录警告并放行
+        self.credentials_set = bool(username and password)
+        if self.enabled and not self.credentials_set:
+            logger.warning("BASIC_AUTH_ENABLED=True 但未配置 BASIC_AUTH_USERNAME 或 BASIC_AUTH_PASSWORD，Basic Auth 不生效")
+
+        # 期望的凭证（Base64 部分），请求时与 Authorization 头直接比较，无需解码
+        credentials = f'{username}:{password}'.encode('utf-8')
+        self.expected_token = base64.b64encode(credentials)
+
+        # 签名 Cookie：内容为凭证指纹，修改用户名或密码后旧 Cookie 自动失效。
+        # Cookie 内容可读，指纹用 SECRET_KEY 做 HMAC，不能离线穷举出密码
+        self.cookie_age = int(os.environ.get('BASIC_AUTH_COOKIE_AGE', '43200'))
+        self.fingerprint = salted_hmac(self.COOKIE_SALT, credentials).hexdigest()
+        self.signer = signing.TimestampSigner(salt=self.COOKIE_SALT)
 
         # 关键端点：必须绕过 Basic Auth
-        self.excluded_paths = [
+        excluded_paths = [
             '/payment/notify/',           # 微信支付回调
             '/api/cron/daily-report/',    # Vercel 定时任务
+            '/api/cron/reconcile-payments/',  # 支付对账定时任务
             '/api/cron/test-feishu/',     # 飞书测试端点
             '/MP_verify_ppTG1CEXB5Ni8Hc5.txt',  # 微信域名验证
         ]
@@ -31,69 +81,88 @@ class BasicAuthMiddleware:
         if extra_exclusions:
             # 格式：逗号分隔，例如 "/health/,/metrics/"
             additional_paths = [p.strip() for p in extra_exclusions.split(',') if p.strip()]
-            self.excluded_paths.extend(additional_paths)
+            excluded_paths.extend(additional_paths)
+
+        # 所有排除前缀合并为一个正则，一次匹配完成
+        self.excluded_re = re.compile('|'.join(re.escape(path) for path in excluded_paths))
 
     def _is_excluded_path(self, request_path):
         """检查请求路径是否应绕过 Basic Auth"""
-        for excluded in self.excluded_paths:
-            if request_path.startswith(excluded):
-                return True
-        return False
+        return self.excluded_re.match(request_path) is not None
 
-    def __call__(self, request):
-        # 调试：添加自定义头部显示中间件状态
-        response = None
+    def _check_authorization(self, request):
+        """校验 Authorization 头，格式为 'Basic <base64>'，认证方式不区分大小写"""
+        auth_header = request.META.get('HTTP_AUTHORIZATION', '')
+        auth_type, _, auth_string = auth_header.partition(' ')
+        if auth_type.lower() != 'basic':
+            return False
+        return hmac.compare_digest(auth_string.strip().encode('latin-1', 'replace'), self.expected_token)
+
+    def _check_cookie(self, request):
+        """校验认证成功后下发的签名 Cookie"""
+        if not self.cookie_age:
+            return False
+        value = request.COOKIES.get(self.COOKIE_NAME)
+        if not value:
+            return False
+        try:
+            fingerprint = self.signer.unsign(value, max_age=self.cookie_age)
+        except signing.BadSignature:
+            return False
+        return hmac.compare_digest(fingerprint, self.fingerprint)
 
-        # 如果未启用 Basic Auth，直接放行
+    def _process_request(self, request):
+        """返回 (拦截响应, 调试头部)，拦截响应为 None 表示放行"""
         if not self.enabled:
-            response = self.get_response(request)
-            response['X-BasicAuth-Enabled'] = 'False'
-            response['X-BasicAuth-EnvValue'] = os.environ.get('BASIC_AUTH_ENABLED', 'NOT_SET')
-            return response
+            return None, {'X-BasicAuth-Enabled': 'False'}
 
-        # 如果未配置用户名或密码，记录警告并放行
-        if not self.username or not self.password:
-            print("警告: BASIC_AUTH_ENABLED=True 但未配置 BASIC_AUTH_USERNAME 或 BASIC_AUTH_PASSWORD")
-            response = self.get_response(request)
-            response['X-BasicAuth-Enabled'] = 'True'
-            response['X-BasicAuth-CredentialsSet'] = 'False'
-            return response
+        if not self.credentials_set:
+            return None, {'X-BasicAuth-Enabled': 'True', 'X-BasicAuth-CredentialsSet': 'False'}
 
         # 检查路径是否在排除列表中
         if self._is_excluded_path(request.path):
-            response = self.get_response(request)
-            response['X-BasicAuth-Enabled'] = 'True'
-            response['X-BasicAuth-Excluded'] = 'True'
-            return response
-
-        # 获取 Authorization 头
-        auth_header = request.META.get('HTTP_AUTHORIZATION', '')
-
-        if not auth_header:
-            return self._unauthorized_response()
+            return None, {'X-BasicAuth-Enabled': 'True', 'X-BasicAuth-Excluded': 'True'}
+
+        if self._check_cookie(request):
+            return None, {'X-BasicAuth-Enabled': 'True', 'X-BasicAuth-Authenticated': 'Cookie'}
+
+        if self._check_authorization(request):
+            # 走到这里说明 Cookie 缺失或已失效，重新下发
+            request._basic_auth_set_cookie = bool(self.cookie_age)
+            return None, {'X-BasicAuth-Enabled': 'True', 'X-BasicAuth-Authenticated': 'True'}
+
+        return self._unauthorized_response(), None
+
+    def _process_response(self, request, response, debug_headers):
+        if getattr(request, '_basic_auth_set_cookie', False):
+            response.set_cookie(
+                self.COOKIE_NAME,
+                self.signer.sign(self.fingerprint),
+                max_age=self.cookie_age,
+                secure=request.is_secure(),
+                httponly=True,
+                samesite='Lax',
+            )
+        if self.debug_headers:
+            for header, value in debug_headers.items():
+                response[header] = value
+        return response
 
-        # 解析 Basic Auth
-        try:
-            auth_type, auth_string = auth_header.split(' ', 1)
-            if auth_type.lower() != 'basic':
-                return self._unauthorized_response()
-
-            # 解码 Base64
-            decoded = base64.b64decode(auth_string).decode('utf-8')
-            username, password = decoded.split(':', 1)
-
-            # 验证用户名和密码
-            if username == self.username and password == self.password:
-                # 认证成功，继续处理请求
-                response = self.get_response(request)
-                response['X-BasicAuth-Enabled'] = 'True'
-                response['X-BasicAuth-Authenticated'] = 'True'
-                return response
-            else:
-                return self._unauthorized_response()
-
-        except (ValueError, UnicodeDecodeError):
-            return self._unauthorized_response()
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        denied, debug_headers = self._process_request(request)
+        if denied is not None:
+            return denied
+        response = self.get_response(request)
+        return self._process_response(request, response, debug_headers)
+
+    async def __acall__(self, request):
+        denied, debug_headers = self._process_request(request)
+        if denied is not None:
+            return denied
+        response = await self.get_response(request)
+        return self._process_response(request, response, debug_headers)
 
     def _unauthorized_response(self):
         """返回 401 未授权响应"""
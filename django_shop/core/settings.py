@@ -13,15 +13,17 @@ https://docs.djangoproject.com/en/5.2/ref/settings/
 import os
 from pathlib import Path
 
-import dj_database_url
-from dotenv import load_dotenv
-
-# Load environment variables from .env file
-load_dotenv()
-
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
 
+# Load environment variables from .env file
+# 与 load_dotenv() 默认的查找范围一致：从本文件所在目录逐级向上找第一个 .env；
+# 找不到时（Serverless 部署）不导入 python-dotenv
+_env_file = next((path / '.env' for path in Path(__file__).resolve().parents if (path / '.env').is_file()), None)
+if _env_file is not None:
+    from dotenv import load_dotenv
+    load_dotenv(_env_file)
+
 
 # Quick-start development settings - unsuitable for production
 # See https://docs.djangoproject.com/en/5.2/howto/deployment/checklist/
@@ -48,6 +50,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'shop.metrics.MetricsMiddleware',  # 请求耗时/查询次数指标
+    'shop.tracing.TracingMiddleware',  # 外部调用追踪上下文
     'core.middleware.BasicAuthMiddleware',  # Basic Auth 认证
     'django.middleware.security.SecurityMiddleware',
     'whitenoise.middleware.WhiteNoiseMiddleware',
@@ -87,42 +91,18 @@ database_url = os.environ.get('DATABASE_URL')
 
 if database_url:
     # 生产环境：使用 PostgreSQL (Supabase)
-    # 解析 DATABASE_URL
-    import dj_database_url
+    # 连接复用方式由 DB_PROFILE 选择（serverless / persistent / pooled），见 core/db_profiles.py
+    from core.db_profiles import build_database_config
 
     DATABASES = {
-        'default': dj_database_url.config(
-            default=database_url,
-            conn_max_age=0,  # Serverless 不建议使用持久连接
-        )
+        'default': build_database_config(database_url)
     }
-
-    # Supabase PostgreSQL SSL 配置
-    # Vercel Serverless 需要禁用持久连接
-    DATABASES['default']['CONN_MAX_AGE'] = 0
-    DATABASES['default']['DISABLE_SERVER_SIDE_CURSORS'] = True
-
-    # 添加 SSL 和连接选项
-    if 'OPTIONS' not in DATABASES['default']:
-        DATABASES['default']['OPTIONS'] = {}
-
-    # 如果 URL 中没有 sslmode 参数，添加 SSL 选项
-    if 'sslmode' not in database_url.lower():
-        DATABASES['default']['OPTIONS']['sslmode'] = 'require'
-
-    # 添加连接超时和 keepalive 设置（Serverless 环境必需）
-    DATABASES['default']['OPTIONS']['connect_timeout'] = 10
-    DATABASES['default']['OPTIONS']['keepalives'] = 1
-    DATABASES['default']['OPTIONS']['keepalives_idle'] = 30
-    DATABASES['default']['OPTIONS']['keepalives_interval'] = 10
-    DATABASES['default']['OPTIONS']['keepalives_count'] = 5
 else:
-    # 开发环境：使用本地 SQLite
+    # 开发环境 / 单机部署：使用本地 SQLite（WAL、IMMEDIATE 事务等设置见 core/db_profiles.py）
+    from core.db_profiles import build_sqlite_config
+
     DATABASES = {
-        'default': {
-            'ENGINE': 'django.db.backends.sqlite3',
-            'NAME': BASE_DIR / 'db.sqlite3',
-        }
+        'default': build_sqlite_config(BASE_DIR / 'db.sqlite3')
     }
 
 
@@ -190,12 +170,57 @@ WECHAT_PRIVATE_KEY = os.environ.get('WECHAT_PRIVATE_KEY', '')
 WECHAT_PLATFORM_CERT = os.environ.get('WECHAT_PLATFORM_CERT', '')  # 微信支付平台证书/公钥
 WECHAT_PLATFORM_CERT_SERIAL_NO = os.environ.get('WECHAT_PLATFORM_CERT_SERIAL_NO', '')  # 平台证书序列号
 WECHAT_PAY_NOTIFY_URL = os.environ.get('WECHAT_PAY_NOTIFY_URL', 'https://yourdomain.com/payment/notify/')
+# 微信支付 API 地址，留空使用官方网关；压测/联调时指向本地模拟器（manage.py wechatpay_simulator）
+WECHAT_PAY_API_BASE_URL = os.environ.get('WECHAT_PAY_API_BASE_URL', '')
+# 单个请求内调用微信支付 API 的总时间预算（秒），包括所有重试和退避等待，应小于 Serverless 函数的最长执行时间
+WECHAT_PAY_DEADLINE_SECONDS = float(os.environ.get('WECHAT_PAY_DEADLINE_SECONDS', '8'))
+
+# 微信支付熔断器（见 shop/circuit_breaker.py）：统计窗口内失败率或慢调用率超过阈值后直接失败，
+# 不再等待超时和重试；状态保存在缓存中，多进程/多实例共享
+WECHAT_PAY_BREAKER_ENABLED = os.environ.get('WECHAT_PAY_BREAKER_ENABLED', 'True').lower() in ('true', '1', 'yes')
+WECHAT_PAY_BREAKER_FAILURE_RATE = float(os.environ.get('WECHAT_PAY_BREAKER_FAILURE_RATE', '0.5'))
+WECHAT_PAY_BREAKER_SLOW_CALL_SECONDS = float(os.environ.get('WECHAT_PAY_BREAKER_SLOW_CALL_SECONDS', '3'))
+# 慢调用率阈值，默认与失败率阈值相同
+WECHAT_PAY_BREAKER_SLOW_CALL_RATE = float(
+    os.environ.get('WECHAT_PAY_BREAKER_SLOW_CALL_RATE', WECHAT_PAY_BREAKER_FAILURE_RATE)
+)
+WECHAT_PAY_BREAKER_MIN_CALLS = int(os.environ.get('WECHAT_PAY_BREAKER_MIN_CALLS', '10'))
+WECHAT_PAY_BREAKER_WINDOW_SECONDS = int(os.environ.get('WECHAT_PAY_BREAKER_WINDOW_SECONDS', '60'))
+WECHAT_PAY_BREAKER_OPEN_SECONDS = int(os.environ.get('WECHAT_PAY_BREAKER_OPEN_SECONDS', '30'))
+
+# 缓存（熔断器等需要跨进程/实例共享的状态）
+# locmem:   进程内存，仅适合单进程开发环境
+# database: 数据库缓存表 shop_cache（由迁移 shop/0011_cache_table 创建）
+# redis:    REDIS_URL 指向的 Redis（需安装 redis）
+# 默认：配置了 DATABASE_URL 时使用 database，否则 locmem
+CACHE_BACKEND = os.environ.get('CACHE_BACKEND', 'database' if database_url else 'locmem')
+if CACHE_BACKEND == 'redis':
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': os.environ.get('REDIS_URL', 'redis://127.0.0.1:6379/0'),
+        }
+    }
+elif CACHE_BACKEND == 'database':
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+            'LOCATION': 'shop_cache',
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        }
+    }
 
 # 网站地址
 SITE_URL = os.environ.get('SITE_URL', 'http://localhost:8000')
 
 # 邮件配置（使用 Resend SMTP）
-EMAIL_BACKEND = 'django.core.mail.backends.smtp.EmailBackend'
+# 压测时可设为 django.core.mail.backends.dummy.EmailBackend，避免真实发信
+EMAIL_BACKEND = os.environ.get('EMAIL_BACKEND', 'django.core.mail.backends.smtp.EmailBackend')
 EMAIL_HOST = os.environ.get('EMAIL_HOST', 'smtp.resend.com')
 EMAIL_PORT = int(os.environ.get('EMAIL_PORT', 465))
 EMAIL_USE_SSL = os.environ.get('EMAIL_USE_SSL', 'True').lower() in ('true', '1', 'yes')
@@ -207,9 +232,87 @@ DEFAULT_FROM_EMAIL = os.environ.get('DEFAULT_FROM_EMAIL', 'noreply@example.com')
 # 订单超时时间（分钟）
 ORDER_EXPIRE_MINUTES = 30
 
+# 下单幂等键的保留时间（秒），过期的键会被自动清理（见 shop/idempotency.py）
+IDEMPOTENCY_KEY_TTL = int(os.environ.get('IDEMPOTENCY_KEY_TTL', '86400'))
+
 # 支付测试模式（开启后跳过微信支付，直接模拟支付成功）
 PAYMENT_TEST_MODE = os.environ.get('PAYMENT_TEST_MODE', 'True').lower() in ('true', '1', 'yes')
 
+# 异步支付视图（ASGI 部署时开启，见 shop/async_views.py）
+PAYMENT_ASYNC_VIEWS = os.environ.get('PAYMENT_ASYNC_VIEWS', 'False').lower() in ('true', '1', 'yes')
+
+# 支付状态长轮询的最长挂起时间（秒），仅异步视图支持
+PAYMENT_LONG_POLL_MAX_SECONDS = int(os.environ.get('PAYMENT_LONG_POLL_MAX_SECONDS', '25'))
+
+# 支付对账（见 shop/reconciliation.py，manage.py reconcile_payments 或 /api/cron/reconcile-payments/）
+PAYMENT_RECONCILE_WORKERS = int(os.environ.get('PAYMENT_RECONCILE_WORKERS', '4'))  # 并发查询线程数
+PAYMENT_RECONCILE_RATE = float(os.environ.get('PAYMENT_RECONCILE_RATE', '10'))  # 每秒最多查询次数
+# 每轮的时间预算（秒），定时任务路由需小于 Serverless 函数的最长执行时间
+PAYMENT_RECONCILE_DEADLINE_SECONDS = float(os.environ.get('PAYMENT_RECONCILE_DEADLINE_SECONDS', '8'))
+
+# 性能指标（见 shop/metrics.py，/metrics 输出 Prometheus 文本格式）
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', 'True').lower() in ('true', '1', 'yes')
+# 访问 /metrics 的令牌（Authorization: Bearer <token>），未配置时仅管理员可访问
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+# Serverless 环境下把各实例的指标定期写入数据库，/metrics 合并输出
+METRICS_DB_FLUSH = os.environ.get('METRICS_DB_FLUSH', 'False').lower() in ('true', '1', 'yes')
+METRICS_FLUSH_INTERVAL = int(os.environ.get('METRICS_FLUSH_INTERVAL', '60'))  # 秒
+METRICS_SNAPSHOT_TTL = int(os.environ.get('METRICS_SNAPSHOT_TTL', '86400'))  # 秒，超时未更新的快照会被清理
+
+# 外部调用追踪：超过该耗时（毫秒）或失败的调用写入 OutboundSpan 表（见 shop/tracing.py）
+TRACING_SLOW_SPAN_MS = int(os.environ.get('TRACING_SLOW_SPAN_MS', '1000'))
+TRACING_SPAN_TTL = int(os.environ.get('TRACING_SPAN_TTL', '604800'))  # 秒，超过该时间的记录会被清理
+
+# 日志配置（见 core/log.py）
+# LOG_FORMAT: text / json；LOG_LEVEL 控制 shop、core 模块的日志级别
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'text').lower()
+# 高频日志采样率，格式 "logger前缀=比例"，逗号分隔；只采样 WARNING 以下的日志
+LOG_SAMPLE_RATES = os.environ.get('LOG_SAMPLE_RATES', 'shop.poll=0.1')
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'filters': {
+        'sampling': {
+            '()': 'core.log.SamplingFilter',
+            'rates': LOG_SAMPLE_RATES,
+        },
+    },
+    'formatters': {
+        'text': {
+            'format': '%(asctime)s %(levelname)s %(name)s: %(message)s',
+        },
+        'json': {
+            '()': 'core.log.JsonFormatter',
+        },
+    },
+    'handlers': {
+        'console': {
+            'class': 'logging.StreamHandler',
+            'formatter': 'json' if LOG_FORMAT == 'json' else 'text',
+            'filters': ['sampling'],
+        },
+    },
+    'root': {
+        'handlers': ['console'],
+        'level': 'WARNING',
+    },
+    'loggers': {
+        'django': {
+            'handlers': ['console'],
+            'level': os.environ.get('DJANGO_LOG_LEVEL', 'INFO').upper(),
+            'propagate': False,
+        },
+        'shop': {
+            'level': LOG_LEVEL,
+        },
+        'core': {
+            'level': LOG_LEVEL,
+        },
+    },
+}
+
 # 生产环境安全配置
 if not DEBUG:
     # HTTPS 设置
@@ -1,15 +1,17 @@
 from django.contrib import admin
+from django.core.paginator import Paginator
+from django.db import connections, transaction
+from django.db.models import Exists, OuterRef, Q
 from django.shortcuts import render, redirect
 from django.urls import path
 from django import forms
-from openpyxl import load_workbook
 from django.contrib import messages
 from django.http import HttpResponse
 from django.utils import timezone
-from openpyxl import Workbook
-from openpyxl.styles import Font, Alignment, PatternFill
+from django.utils.functional import cached_property
 
-from .models import Card, Order, Product, PriceTier
+from .card_import import import_cards, iter_excel_contents
+from .models import Card, Order, OutboundSpan, Product, PriceTier
 
 # 自定义 Admin 站点标题
 admin.site.site_header = '数字商店管理后台'
@@ -29,18 +31,39 @@ class PriceTierInline(admin.TabularInline):
 
 @admin.register(Product)
 class ProductAdmin(admin.ModelAdmin):
-    list_display = ('name', 'price', 'has_tiered_pricing_display', 'display_order', 'stock_count', 'created_at', 'updated_at')
+    list_display = (
+        'name', 'price', 'has_tiered_pricing_display', 'display_order',
+        'stock_display', 'sold_display', 'revenue_display', 'created_at', 'updated_at',
+    )
     list_editable = ('display_order',)
     prepopulated_fields = {'slug': ('name',)}
     search_fields = ('name', 'description')
     list_filter = ('created_at',)
     ordering = ['display_order', '-created_at']
     inlines = [PriceTierInline]
+    # 不再额外统计一次未筛选的总数
+    show_full_result_count = False
+
+    def get_queryset(self, request):
+        """列表页一次查询带出库存、销量、销售额，避免逐行查询"""
+        return super().get_queryset(request).with_stats()
 
-    @admin.display(description='阶梯定价', boolean=True)
+    @admin.display(description='阶梯定价', boolean=True, ordering='tiered_pricing')
     def has_tiered_pricing_display(self, obj):
         """显示是否配置了阶梯价格"""
-        return obj.has_tiered_pricing()
+        return obj.tiered_pricing
+
+    @admin.display(description='库存数量', ordering='stock_total')
+    def stock_display(self, obj):
+        return obj.stock_total
+
+    @admin.display(description='已售数量', ordering='sold_total')
+    def sold_display(self, obj):
+        return obj.sold_total
+
+    @admin.display(description='销售额', ordering='revenue_total')
+    def revenue_display(self, obj):
+        return f'¥{obj.revenue_total:.2f}'
 
 
 class CardAdminForm(forms.ModelForm):
@@ -74,6 +97,45 @@ class ExcelImportForm(forms.Form):
     )
 
 
+class EstimatedCountPaginator(Paginator):
+    """大表分页器：未筛选时使用 PostgreSQL 统计信息估算总数
+
+    PostgreSQL 的 COUNT(*) 需要扫描全表，百万级卡密表上要数秒。
+    未加筛选条件时改为读取 pg_class.reltuples（由 ANALYZE/autovacuum 维护），
+    筛选后的结果集通常较小，仍然精确计数。
+    """
+    # 低于该行数时直接精确计数
+    estimate_threshold = 100000
+
+    @cached_property
+    def count(self):
+        estimate = self._estimated_count()
+        if estimate is not None:
+            return estimate
+        return super().count
+
+    def _estimated_count(self):
+        queryset = self.object_list
+        if not hasattr(queryset, 'query') or queryset.query.where:
+            return None
+
+        connection = connections[queryset.db]
+        if connection.vendor != 'postgresql':
+            return None
+
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'SELECT reltuples::bigint FROM pg_class WHERE oid = %s::regclass',
+                [queryset.model._meta.db_table],
+            )
+            row = cursor.fetchone()
+
+        # reltuples 为 -1 表示表还未 ANALYZE
+        if not row or row[0] < self.estimate_threshold:
+            return None
+        return row[0]
+
+
 class ProductStockFilter(admin.SimpleListFilter):
     """按产品库存状态筛选"""
     title = '产品库存状态'
@@ -86,18 +148,16 @@ class ProductStockFilter(admin.SimpleListFilter):
         )
 
     def queryset(self, request, queryset):
+        # 使用 EXISTS 关联子查询，命中 (product, status) 索引，无需预先收集商品 ID
+        product_has_stock = Exists(
+            Card.objects.filter(product_id=OuterRef('product_id'), status='unsold')
+        )
         if self.value() == 'in_stock':
             # 筛选有未售出卡密的产品
-            products_with_stock = Card.objects.filter(
-                status='unsold'
-            ).values_list('product_id', flat=True).distinct()
-            return queryset.filter(product_id__in=products_with_stock)
+            return queryset.filter(product_has_stock)
         elif self.value() == 'out_of_stock':
             # 筛选没有未售出卡密的产品
-            products_with_stock = Card.objects.filter(
-                status='unsold'
-            ).values_list('product_id', flat=True).distinct()
-            return queryset.exclude(product_id__in=products_with_stock)
+            return queryset.filter(~product_has_stock)
         return queryset
 
 
@@ -132,6 +192,10 @@ def export_cards_to_excel(modeladmin, request, queryset):
         )
         return
 
+    # 延迟导入：openpyxl 较重，admin 模块在前台请求启动时也会被加载
+    from openpyxl import Workbook
+    from openpyxl.styles import Font, Alignment, PatternFill
+
     # 创建工作簿
     wb = Workbook()
     ws = wb.active
@@ -182,14 +246,51 @@ def export_cards_to_excel(modeladmin, request, queryset):
     return response
 
 
+# 批量操作每批更新的卡密数量，控制单条 UPDATE 锁定的行数和事务时长
+CARD_ACTION_CHUNK_SIZE = 1000
+
+
+def _iter_pk_chunks(queryset, chunk_size=None):
+    """按主键键集分页遍历查询集，每次返回一批主键（默认每批 CARD_ACTION_CHUNK_SIZE 个）"""
+    chunk_size = chunk_size or CARD_ACTION_CHUNK_SIZE
+    pks = queryset.order_by('pk').values_list('pk', flat=True)
+    last_pk = None
+    while True:
+        page = pks if last_pk is None else pks.filter(pk__gt=last_pk)
+        chunk = list(page[:chunk_size])
+        if not chunk:
+            return
+        yield chunk
+        last_pk = chunk[-1]
+
+
+def _update_cards_in_chunks(queryset, condition, values):
+    """分批执行条件 UPDATE
+
+    每批一个短事务，只有满足 condition 的行会被更新。
+
+    Returns:
+        (选中数量, 实际更新数量)
+    """
+    selected = updated = 0
+    for chunk in _iter_pk_chunks(queryset):
+        with transaction.atomic():
+            updated += Card.objects.filter(pk__in=chunk, **condition).update(**values)
+        selected += len(chunk)
+    return selected, updated
+
+
 @admin.action(description='批量设置为已售出')
 def mark_as_sold(modeladmin, request, queryset):
     """批量将卡密标记为已售出（不关联订单）"""
     # 只更新未售出的卡密
-    unsold_cards = queryset.filter(status='unsold')
-    count = unsold_cards.count()
+    selected, updated = _update_cards_in_chunks(
+        queryset,
+        condition={'status': 'unsold'},
+        values={'status': 'sold'},
+    )
 
-    if count == 0:
+    if updated == 0:
         modeladmin.message_user(
             request,
             '选中的卡密中没有未售出的，无需更新',
@@ -197,55 +298,41 @@ def mark_as_sold(modeladmin, request, queryset):
         )
         return
 
-    # 批量更新状态
-    unsold_cards.update(status='sold')
-
-    modeladmin.message_user(
-        request,
-        f'成功将{count}个卡密设置为已售出。注意：这些卡密未关联订单，仅标记状态。',
-        level='success'
-    )
+    message = f'成功将{updated}个卡密设置为已售出。注意：这些卡密未关联订单，仅标记状态。'
+    if selected > updated:
+        message += f'（跳过{selected - updated}个已售出的卡密）'
+    modeladmin.message_user(request, message, level='success')
 
 
 @admin.action(description='批量设置为未售出')
 def mark_as_unsold(modeladmin, request, queryset):
     """批量将卡密标记为未售出（安全检查）"""
-    # 只更新已售出的卡密
-    sold_cards = queryset.filter(status='sold')
-    count = sold_cards.count()
+    # 只更新已售出且未关联订单的卡密，已关联订单的卡密需要在订单管理中处理
+    selected, updated = _update_cards_in_chunks(
+        queryset,
+        condition={'status': 'sold', 'order__isnull': True},
+        values={'status': 'unsold'},
+    )
 
-    if count == 0:
+    if updated == 0:
         modeladmin.message_user(
             request,
-            '选中的卡密中没有已售出的，无需更新',
+            '选中的卡密中没有可改回未售出的卡密（需为已售出且未关联订单）',
             level='warning'
         )
         return
 
-    # 检查是否有关联订单（防止误操作）
-    cards_with_orders = sold_cards.filter(order__isnull=False)
-    if cards_with_orders.exists():
-        modeladmin.message_user(
-            request,
-            f'错误：选中的{cards_with_orders.count()}个卡密已关联订单，不能改回未售出状态。请在订单管理中处理。',
-            level='error'
-        )
-        return
-
-    # 批量更新状态
-    sold_cards.update(status='unsold')
-
-    modeladmin.message_user(
-        request,
-        f'成功将{count}个卡密设置为未售出',
-        level='success'
-    )
+    message = f'成功将{updated}个卡密设置为未售出'
+    if selected > updated:
+        message += f'。跳过{selected - updated}个未售出或已关联订单的卡密，已关联订单的卡密请在订单管理中处理。'
+    modeladmin.message_user(request, message, level='success')
 
 
 @admin.register(Card)
 class CardAdmin(admin.ModelAdmin):
     form = CardAdminForm
     list_display = ('id', 'product', 'status', 'short_content', 'order', 'created_at')
+    list_select_related = ('product', 'order')
     list_filter = ('status', 'product', ProductStockFilter, OrderStatusFilter)
     search_fields = ('content', 'product__name')
     autocomplete_fields = ['order']
@@ -253,6 +340,10 @@ class CardAdmin(admin.ModelAdmin):
     ordering = ['-created_at']
     readonly_fields = ('created_at',)
 
+    # 百万级卡密表：未筛选时估算总数，筛选后不再额外统计全表总数
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
     # 批量操作
     actions = [export_cards_to_excel, mark_as_sold, mark_as_unsold]
 
@@ -300,27 +391,15 @@ class CardAdmin(admin.ModelAdmin):
                     return redirect('.')
 
                 try:
-                    # 加载 Excel 文件
-                    workbook = load_workbook(excel_file, read_only=True)
-                    sheet = workbook.active
-
-                    # 读取卡密（从第二行开始，第一列）
-                    cards_to_create = []
-                    for row in sheet.iter_rows(min_row=2, max_col=1, values_only=True):
-                        card_content = row[0]
-                        if card_content:  # 跳过空行
-                            card_content = str(card_content).strip()
-                            if card_content:
-                                cards_to_create.append(Card(
-                                    product=product,
-                                    content=card_content,
-                                    status='unsold'
-                                ))
-
-                    # 批量创建卡密
-                    if cards_to_create:
-                        Card.objects.bulk_create(cards_to_create)
-                        messages.success(request, f'成功导入 {len(cards_to_create)} 个卡密到商品「{product.name}」')
+                    result = import_cards(product, iter_excel_contents(excel_file))
+
+                    if result['created']:
+                        message = f'成功导入 {result["created"]} 个卡密到商品「{product.name}」'
+                        if result['duplicates']:
+                            message += f'，跳过 {result["duplicates"]} 个重复卡密'
+                        messages.success(request, message)
+                    elif result['duplicates']:
+                        messages.warning(request, f'文件中的 {result["duplicates"]} 个卡密均已存在，未导入新卡密')
                     else:
                         messages.warning(request, '未找到有效的卡密数据')
 
@@ -345,11 +424,103 @@ class CardAdmin(admin.ModelAdmin):
     change_list_template = 'admin/card_change_list.html'
 
 
+class PaymentStateFilter(admin.SimpleListFilter):
+    """按支付进度筛选（组合支付状态、订单状态和过期时间）"""
+    title = '支付进度'
+    parameter_name = 'payment_state'
+
+    def lookups(self, request, model_admin):
+        return (
+            ('awaiting', '待支付（未过期）'),
+            ('timed_out', '超时未支付'),
+            ('paid_unfulfilled', '已支付未发货'),
+            ('fulfilled', '已支付已发货'),
+        )
+
+    def queryset(self, request, queryset):
+        now = timezone.now()
+        if self.value() == 'awaiting':
+            return queryset.filter(payment_status='unpaid', expires_at__gt=now)
+        elif self.value() == 'timed_out':
+            return queryset.filter(
+                Q(payment_status='expired') | Q(payment_status='unpaid', expires_at__lte=now)
+            )
+        elif self.value() == 'paid_unfulfilled':
+            return queryset.filter(payment_status='paid').exclude(status='completed')
+        elif self.value() == 'fulfilled':
+            return queryset.filter(payment_status='paid', status='completed')
+        return queryset
+
+
 @admin.register(Order)
 class OrderAdmin(admin.ModelAdmin):
-    list_display = ('id', 'email', 'quantity', 'total_amount', 'status', 'created_at')
-    list_filter = ('status', 'created_at')
-    search_fields = ('email', 'out_trade_no')
+    list_display = (
+        'id', 'email', 'product', 'quantity', 'total_amount',
+        'payment_status', 'status', 'paid_at', 'created_at',
+    )
+    list_select_related = ('product',)
+    list_filter = ('payment_status', PaymentStateFilter, 'status', 'created_at')
+    date_hierarchy = 'paid_at'
+    search_fields = ('email', 'out_trade_no', 'transaction_id')
+    search_help_text = (
+        '纯数字：按订单ID或微信交易号精确查找；ORDER_ 开头：按商户订单号前缀查找；'
+        '邮箱：精确查找，末尾加 * 按前缀查找'
+    )
     readonly_fields = ('created_at',)
     list_editable = ('status',)
     ordering = ['-created_at']
+
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+    def get_search_results(self, request, queryset, search_term):
+        """只使用能命中索引的精确/前缀匹配，替代默认的 icontains 全表扫描"""
+        term = search_term.strip()
+        if not term:
+            return queryset, False
+
+        if term.isdigit():
+            # 订单ID 或 微信支付交易号
+            condition = Q(transaction_id=term)
+            if len(term) <= 18:
+                condition |= Q(pk=int(term))
+            return queryset.filter(condition), False
+
+        if term.upper().startswith('ORDER_'):
+            # 商户订单号（前缀匹配同样覆盖完整订单号）
+            return queryset.filter(out_trade_no__startswith=term.upper()), False
+
+        if term.endswith('*'):
+            # 邮箱前缀
+            prefix = term.rstrip('*')
+            if not prefix:
+                return queryset, False
+            return queryset.filter(email__startswith=prefix), False
+
+        if '@' in term:
+            # 完整邮箱：兼容大小写不同的录入
+            return queryset.filter(email__in={term, term.lower()}), False
+
+        return queryset.filter(email__startswith=term), False
+
+
+@admin.register(OutboundSpan)
+class OutboundSpanAdmin(admin.ModelAdmin):
+    """外部调用慢记录（只读），按依赖和操作查看尾延迟"""
+    list_display = (
+        'started_at', 'service', 'operation', 'attempt', 'duration_ms',
+        'retry_sleep_ms', 'outcome', 'status_code', 'order', 'request_path',
+    )
+    list_select_related = ('order',)
+    list_filter = ('service', 'operation', 'outcome')
+    date_hierarchy = 'started_at'
+    search_fields = ('=request_id', '=order__id')
+    ordering = ['-started_at']
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
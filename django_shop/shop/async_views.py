@@ -0,0 +1,231 @@
+"""支付相关异步视图（ASGI 部署使用）
+
+与 views.py 中的同步视图行为一致，区别在于：
+- 调用微信支付和飞书使用异步 HTTP 客户端（httpx），等待和重试退避期间不占用线程；
+- 只有订单履约的数据库事务通过 sync_to_async 放到线程中执行；
+- 支付状态查询支持长轮询（?wait=秒数），单个进程可同时挂起大量轮询请求。
+
+通过 settings.PAYMENT_ASYNC_VIEWS 启用，并使用 ASGI 服务器运行 core.asgi:application，例如：
+    gunicorn core.asgi:application -k uvicorn.workers.UvicornWorker
+"""
+import asyncio
+import logging
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.http import JsonResponse
+from django.shortcuts import aget_object_or_404, redirect
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST
+
+from . import idempotency
+from .deadline import Deadline
+from .fulfillment import (
+    ALREADY_PAID,
+    CONFLICT,
+    FULFILLED,
+    OUT_OF_STOCK,
+    fulfill_order,
+    send_fulfillment_notifications_async,
+)
+from .models import Card, Order, Product
+from .tracing import bind_order
+from .views import (
+    _build_pending_order,
+    _idempotency_key,
+    _idempotent_response,
+    _parse_purchase,
+    _payment_error_response,
+    _stock_error_response,
+    _test_mode_response,
+)
+from .wechat_pay import AsyncWeChatPayClient, verify_notify
+
+logger = logging.getLogger(__name__)
+poll_logger = logging.getLogger('shop.poll')
+
+# 长轮询期间两次检查订单状态的间隔（秒）
+LONG_POLL_INTERVAL = 3
+
+
+@require_POST
+async def buy_product(request, slug):
+    """创建订单并跳转支付页面（异步版本，幂等键处理与同步版本一致）"""
+    email, quantity, error_response = _parse_purchase(request)
+    if error_response:
+        return error_response
+    key, error_response = _idempotency_key(request)
+    if error_response:
+        return error_response
+    if key is None:
+        return (await _checkout(request, slug, email, quantity))[0]
+
+    digest = idempotency.request_hash(slug, email, quantity)
+    record = await sync_to_async(idempotency.lookup)(key)
+    if record is None:
+        claimed, record = await sync_to_async(idempotency.claim)(key, digest)
+        if claimed:
+            try:
+                response, order = await _checkout(request, slug, email, quantity)
+            except BaseException:
+                await sync_to_async(idempotency.release)(key)
+                raise
+            if order is not None:
+                await sync_to_async(idempotency.complete)(key, order)
+            else:
+                await sync_to_async(idempotency.release)(key)
+            return response
+    if record is not None and record.order_id is None and record.request_hash == digest:
+        # 第一个请求还在调用微信下单，在事件循环中等待，不占用线程
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + idempotency.WAIT_SECONDS
+        while record is not None and record.order_id is None and loop.time() < deadline:
+            await asyncio.sleep(idempotency.WAIT_INTERVAL)
+            record = await sync_to_async(idempotency.lookup)(key)
+    return _idempotent_response(request, record, digest)
+
+
+async def _checkout(request, slug, email, quantity):
+    """检查库存、创建订单并生成支付二维码，返回 (response, 成功创建的订单或 None)"""
+    product = await aget_object_or_404(Product, slug=slug)
+
+    # 检查库存
+    stock_count = await Card.objects.filter(product=product, status='unsold').acount()
+    error_response = _stock_error_response(request, stock_count, quantity)
+    if error_response:
+        return error_response, None
+
+    # 创建订单（待支付状态），单价需要查询阶梯价格
+    order = await sync_to_async(_build_pending_order)(product, email, quantity)
+    await order.asave()
+
+    # 测试模式：直接模拟支付成功（分配卡密在事务中执行）
+    if getattr(settings, 'PAYMENT_TEST_MODE', False):
+        response = await sync_to_async(_test_mode_response)(request, order)
+        return response, order if response.status_code == 302 else None
+
+    # 生产模式：生成支付二维码
+    # 本请求内所有微信支付调用（含重试）共用同一个时间预算
+    deadline = Deadline(settings.WECHAT_PAY_DEADLINE_SECONDS)
+    try:
+        async with AsyncWeChatPayClient(timeout=deadline.timeout()) as wechat_client:
+            # 创建支付订单（最多尝试3次，预算用完即停止）
+            order.qr_code_url = await wechat_client.create_native_order(order, max_retries=3, deadline=deadline)
+        await order.asave(update_fields=['qr_code_url'])
+    except Exception as e:
+        return _payment_error_response(request, e), None
+
+    # 跳转到支付页面
+    return redirect('shop:payment_page', order_id=order.id), order
+
+
+@csrf_exempt
+@require_POST
+async def wechat_payment_notify(request):
+    """接收微信支付回调通知 (V3 API，异步版本)"""
+    try:
+        headers = {
+            'Wechatpay-Signature': request.META.get('HTTP_WECHATPAY_SIGNATURE', ''),
+            'Wechatpay-Timestamp': request.META.get('HTTP_WECHATPAY_TIMESTAMP', ''),
+            'Wechatpay-Nonce': request.META.get('HTTP_WECHATPAY_NONCE', ''),
+            'Wechatpay-Serial': request.META.get('HTTP_WECHATPAY_SERIAL', ''),
+            'Wechatpay-Signature-Type': request.META.get('HTTP_WECHATPAY_SIGNATURE_TYPE', ''),
+        }
+
+        # 验证签名并解密；证书模式首次加载可能读取数据库缓存，放到线程中执行
+        result = await sync_to_async(verify_notify)(headers, request.body)
+
+        if not result:
+            return JsonResponse({'code': 'FAIL', 'message': '签名验证失败'})
+
+        if result.get('event_type') != 'TRANSACTION.SUCCESS':
+            return JsonResponse({'code': 'SUCCESS', 'message': '非成功通知'})
+
+        resource = result.get('resource', {})
+        if resource.get('trade_state') != 'SUCCESS':
+            return JsonResponse({'code': 'SUCCESS', 'message': '支付未成功'})
+
+        # 分配卡密并更新订单
+        order, cards_list, fulfillment = await sync_to_async(fulfill_order)(
+            {'out_trade_no': resource.get('out_trade_no')},
+            transaction_id=resource.get('transaction_id'),
+            cancel_on_shortage=True,
+        )
+
+        if fulfillment == ALREADY_PAID:
+            return JsonResponse({'code': 'SUCCESS', 'message': '订单已处理'})
+
+        if fulfillment == OUT_OF_STOCK:
+            return JsonResponse({'code': 'SUCCESS', 'message': f'库存不足，需要 {order.quantity} 件，仅剩 {len(cards_list)} 件'})
+
+        if fulfillment == CONFLICT:
+            # 返回失败，微信稍后重新投递回调
+            return JsonResponse({'code': 'FAIL', 'message': '卡密分配冲突，请重试'})
+
+        await send_fulfillment_notifications_async(order, cards_list, '微信回调')
+        return JsonResponse({'code': 'SUCCESS', 'message': '成功'})
+
+    except Exception as e:
+        logger.error("支付回调处理失败: %s", e, exc_info=True)
+        return JsonResponse({'code': 'FAIL', 'message': str(e)})
+
+
+async def _query_and_fulfill(wechat_client, order, deadline):
+    """向微信查询订单状态，支付成功则履约，返回最新的订单对象"""
+    try:
+        result = await wechat_client.query_order(order.out_trade_no, deadline=deadline)
+    except Exception as e:
+        poll_logger.warning("查询订单状态失败: 订单#%s, 错误=%s", order.id, e)
+        return order
+
+    if result.get('trade_state') != 'SUCCESS':
+        return order
+
+    order, cards_list, fulfillment = await sync_to_async(fulfill_order)(
+        {'pk': order.pk},
+        transaction_id=result.get('transaction_id', ''),
+    )
+    if fulfillment == FULFILLED:
+        logger.info("订单 %s 支付成功，已分配 %s 个卡密", order.id, order.quantity)
+        await send_fulfillment_notifications_async(order, cards_list, '主动查询')
+    return order
+
+
+async def check_payment_status(request, order_id):
+    """AJAX 检查支付状态（异步版本）
+
+    支持长轮询：?wait=N 表示订单未支付时最多挂起 N 秒（不超过 PAYMENT_LONG_POLL_MAX_SECONDS），
+    期间等待微信回调或定期主动查询，支付成功后立即返回。
+    """
+    order = await aget_object_or_404(Order, id=order_id)
+
+    try:
+        wait = min(float(request.GET.get('wait', 0)), settings.PAYMENT_LONG_POLL_MAX_SECONDS)
+    except ValueError:
+        wait = 0
+
+    if order.payment_status == 'unpaid':
+        bind_order(order.id)
+        # 挂起时间之外再留一次查询的预算，最后一次查询也能在截止时间内完成
+        budget = settings.WECHAT_PAY_DEADLINE_SECONDS
+        deadline = Deadline(wait + budget)
+        try:
+            async with AsyncWeChatPayClient(timeout=deadline.timeout(cap=budget)) as wechat_client:
+                while True:
+                    order = await _query_and_fulfill(wechat_client, order, deadline)
+                    remaining = deadline.remaining - budget
+                    if order.payment_status != 'unpaid' or remaining <= 0:
+                        break
+                    await asyncio.sleep(min(LONG_POLL_INTERVAL, remaining))
+                    # 回调可能已在其他请求中完成履约
+                    order = await Order.objects.aget(pk=order_id)
+                    if order.payment_status != 'unpaid':
+                        break
+        except Exception as e:
+            poll_logger.warning("查询订单状态失败: 订单#%s, 错误=%s", order_id, e, exc_info=True)
+
+    return JsonResponse({
+        'payment_status': order.payment_status,
+        'is_paid': order.payment_status == 'paid',
+        'order_id': order.id,
+    })
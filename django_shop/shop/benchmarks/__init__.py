@@ -0,0 +1,7 @@
+"""热点函数微基准测试
+
+用例定义在 cases.py，执行器在 runner.py，通过 manage.py benchmark 运行。
+"""
+from .runner import (  # noqa: F401
+    Benchmark, BenchmarkResult, compare_results, git_commit, register, registry, run_benchmark,
+)
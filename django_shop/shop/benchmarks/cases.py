@@ -0,0 +1,229 @@
+"""基准用例
+
+所有用例在 manage.py benchmark 打开的事务内准备数据，运行结束后整体回滚。
+会修改数据的用例（发货、导入）每次调用都在保存点内执行并回滚，保证每次调用的初始状态相同。
+"""
+import io
+import itertools
+import uuid
+from contextlib import ExitStack
+from datetime import timedelta
+from decimal import Decimal
+
+from django.contrib import admin
+from django.core import mail
+from django.db import transaction
+from django.test import RequestFactory, override_settings
+from django.utils import timezone
+
+from ..models import Card, Order, PriceTier, Product
+from .runner import register
+
+# 批量写入的行数
+BATCH_SIZE = 5000
+
+# 合成数据种子，与手工生成的数据（默认种子 42）区分
+BENCHMARK_SEED = 0
+
+
+class BenchmarkContext:
+    """用例共享的数据和配置"""
+
+    def __init__(self, stats_orders=1_000_000, export_cards=5000):
+        self.stats_orders = stats_orders
+        self.export_cards = export_cards
+        self.stack = ExitStack()
+        self.factory = RequestFactory()
+        self._sequence = itertools.count()
+
+    def close(self):
+        self.stack.close()
+
+    def override_settings(self, **options):
+        """在整个压测期间生效的设置覆盖"""
+        self.stack.enter_context(override_settings(**options))
+
+    def create_product(self, cards=0, tiers=True):
+        n = next(self._sequence)
+        product = Product.objects.create(
+            name=f'基准测试商品{n}', slug=f'benchmark-{n}-{uuid.uuid4().hex[:8]}',
+            description='基准测试商品使用说明', price=Decimal('10.00'),
+        )
+        if tiers:
+            PriceTier.objects.bulk_create([
+                PriceTier(product=product, min_quantity=1, max_quantity=9, unit_price=Decimal('10.00'), display_order=0),
+                PriceTier(product=product, min_quantity=10, max_quantity=99, unit_price=Decimal('9.00'), display_order=1),
+                PriceTier(product=product, min_quantity=100, max_quantity=None, unit_price=Decimal('8.00'), display_order=2),
+            ])
+        if cards:
+            Card.objects.bulk_create(
+                (Card(product=product, content=f'BENCH-{n}-{i:07d}-XXXX-XXXX') for i in range(cards)),
+                batch_size=BATCH_SIZE,
+            )
+        return product
+
+    def create_order(self, product, quantity=1, **fields):
+        now = timezone.now()
+        defaults = {
+            'email': 'benchmark@example.com',
+            'quantity': quantity,
+            'unit_price_used': Decimal('10.00'),
+            'total_amount': Decimal('10.00') * quantity,
+            'out_trade_no': f'BENCH_{uuid.uuid4().hex}',
+            'expires_at': now + timedelta(minutes=30),
+        }
+        defaults.update(fields)
+        return Order.objects.create(product=product, **defaults)
+
+
+def _in_savepoint(func):
+    """在保存点内执行并回滚，用于会修改数据的用例"""
+    def wrapper():
+        savepoint = transaction.savepoint()
+        try:
+            func()
+        finally:
+            transaction.savepoint_rollback(savepoint)
+    return wrapper
+
+
+# ----------------------------------------------------------------------
+# 定价
+# ----------------------------------------------------------------------
+
+@register('price_for_quantity', group='pricing')
+def price_for_quantity(ctx):
+    product = ctx.create_product()
+    quantities = itertools.cycle([1, 5, 10, 50, 100, 500])
+    return lambda: product.get_price_for_quantity(next(quantities))
+
+
+# ----------------------------------------------------------------------
+# 发货
+# ----------------------------------------------------------------------
+
+def _allocation_case(quantity):
+    def setup(ctx):
+        from ..fulfillment import fulfill_order
+
+        product = ctx.create_product(cards=quantity)
+        order = ctx.create_order(product, quantity)
+        return _in_savepoint(lambda: fulfill_order({'pk': order.pk}, transaction_id='BENCHMARK'))
+    return setup
+
+
+for _quantity, _max_number in ((1, 1000), (100, 200), (1000, 50)):
+    register(f'allocate_cards_{_quantity}', group='fulfillment', max_number=_max_number)(
+        _allocation_case(_quantity)
+    )
+
+
+@register('generate_qr_code', group='views', max_number=200)
+def generate_qr_code(ctx):
+    from ..views import generate_qr_code as view
+
+    order = ctx.create_order(
+        ctx.create_product(tiers=False), qr_code_url='weixin://wxpay/bizpayurl?pr=BENCHMARK0001',
+    )
+    request = ctx.factory.get(f'/payment/qrcode/{order.pk}/')
+    return lambda: view(request, order.pk)
+
+
+@register('send_card_email', group='notifications', max_number=500)
+def send_card_email(ctx):
+    from ..email_utils import send_card_email as send
+
+    ctx.override_settings(EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend')
+    product = ctx.create_product(cards=10, tiers=False)
+    order = ctx.create_order(product, 10)
+    cards = list(Card.objects.select_related('product').filter(product=product))
+
+    def run():
+        mail.outbox = []
+        send(order, cards)
+    return run
+
+
+@register('build_daily_report_card', group='notifications', max_number=10000)
+def build_daily_report_card(ctx):
+    from ..feishu_utils import build_daily_report_card as build
+
+    stats = {
+        'date': timezone.localdate().isoformat(),
+        'total_orders': 1234,
+        'total_revenue': 12345.6,
+        'product_sales': [
+            {'product_name': f'商品{i}', 'product_id': i, 'quantity': 10 + i, 'revenue': 100.0 + i}
+            for i in range(20)
+        ],
+        'low_stock_products': [
+            {'product_name': f'商品{i}', 'product_id': i, 'stock_count': i} for i in range(5)
+        ],
+    }
+    return lambda: build(stats)
+
+
+# ----------------------------------------------------------------------
+# 统计
+# ----------------------------------------------------------------------
+
+@register('get_today_stats', group='stats', max_number=20)
+def get_today_stats(ctx):
+    from ..stats_service import get_today_stats as stats
+    from ..synthetic_data import SyntheticDataGenerator
+
+    # 与 generate_synthetic_data 相同的数据形态：订单分布在最近一年，越近越多
+    SyntheticDataGenerator(
+        products=20, cards=0, orders=ctx.stats_orders, months=12, seed=BENCHMARK_SEED,
+        batch_size=BATCH_SIZE,
+    ).generate()
+    return stats
+
+
+# ----------------------------------------------------------------------
+# Excel 导入导出
+# ----------------------------------------------------------------------
+
+@register('excel_export_cards', group='admin', max_number=20)
+def excel_export_cards(ctx):
+    from ..admin import export_cards_to_excel
+
+    product = ctx.create_product(cards=ctx.export_cards, tiers=False)
+    queryset = Card.objects.filter(product=product)
+    request = ctx.factory.post('/admin/shop/card/')
+    return lambda: export_cards_to_excel(admin.site._registry[Card], request, queryset)
+
+
+@register('excel_import_cards', group='admin', max_number=20)
+def excel_import_cards(ctx):
+    from openpyxl import Workbook
+
+    from ..card_import import import_cards, iter_excel_contents
+
+    workbook = Workbook()
+    sheet = workbook.active
+    sheet.append(['卡密'])
+    for i in range(ctx.export_cards):
+        sheet.append([f'IMPORT-{i:07d}-XXXX-XXXX'])
+    buffer = io.BytesIO()
+    workbook.save(buffer)
+    data = buffer.getvalue()
+
+    product = ctx.create_product(tiers=False)
+    return _in_savepoint(lambda: import_cards(product, iter_excel_contents(io.BytesIO(data))))
+
+
+# ----------------------------------------------------------------------
+# 微信支付
+# ----------------------------------------------------------------------
+
+@register('wechatpay_client_init', group='wechat', max_number=500)
+def wechatpay_client_init(ctx):
+    from ..wechat_pay import WeChatPayClient
+    from ..wechat_simulator import SimulatorKeys, generate_private_key_pem
+
+    keys = SimulatorKeys(generate_private_key_pem(), generate_private_key_pem(), uuid.uuid4().hex)
+    ctx.override_settings(**{
+        key: value for key, value in keys.env('http://127.0.0.1:9100').items() if key.startswith('WECHAT_')
+    })
+    return WeChatPayClient
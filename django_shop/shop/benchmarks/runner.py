@@ -0,0 +1,163 @@
+"""微基准测试执行器
+
+每个用例是一个 setup 函数：在压测事务内准备数据，返回要反复执行的无参函数。
+执行器对每个用例分别测量：
+- 耗时：预热一次后自动确定每轮次数（每轮至少 min_time 秒），重复 repeat 轮取中位数；
+- 查询：单次调用执行的 SQL 条数；
+- 内存：单次调用在 tracemalloc 下的峰值内存和调用后仍未释放的内存。
+三项测量分开进行，tracemalloc 的开销不计入耗时。
+"""
+import gc
+import statistics
+import subprocess
+import time
+import tracemalloc
+from dataclasses import asdict, dataclass
+
+from django.conf import settings
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+
+@dataclass
+class Benchmark:
+    name: str
+    group: str
+    setup: callable
+    max_number: int = 1000  # 单轮最多执行次数，重型用例调小
+
+
+# 用例注册表（按注册顺序执行）
+registry = {}
+
+
+def register(name, group='', max_number=1000):
+    """注册基准用例的装饰器"""
+    def decorator(setup):
+        registry[name] = Benchmark(name, group, setup, max_number)
+        return setup
+    return decorator
+
+
+@dataclass
+class BenchmarkResult:
+    name: str
+    group: str
+    number: int
+    repeat: int
+    ops_per_sec: float
+    median_ms: float
+    min_ms: float
+    stdev_ms: float
+    queries_per_op: int
+    peak_kib: float
+    retained_kib: float
+    setup_seconds: float
+
+    def to_dict(self):
+        return asdict(self)
+
+
+def _autorange(func, min_time, max_number):
+    """与 timeit.Timer.autorange 相同的思路：次数按 1、2、5、10... 增长直到单轮耗时超过 min_time"""
+    number = 1
+    while True:
+        for factor in (1, 2, 5):
+            candidate = number * factor
+            started = time.perf_counter()
+            for _ in range(candidate):
+                func()
+            if time.perf_counter() - started >= min_time or candidate >= max_number:
+                return min(candidate, max_number)
+        number *= 10
+
+
+def run_benchmark(benchmark, context, repeat=5, min_time=0.2):
+    """执行一个用例，返回 BenchmarkResult"""
+    setup_started = time.perf_counter()
+    func = benchmark.setup(context)
+    setup_seconds = time.perf_counter() - setup_started
+
+    # 预热：填充模板缓存、导入延迟加载的模块
+    func()
+
+    with CaptureQueriesContext(connection) as queries:
+        func()
+    queries_per_op = len(queries.captured_queries)
+
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        func()
+        # 循环引用在下次 GC 前不会释放，先回收再统计未释放内存
+        gc.collect()
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    number = _autorange(func, min_time, benchmark.max_number)
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for _ in range(number):
+            func()
+        timings.append((time.perf_counter() - started) / number)
+
+    median = statistics.median(timings)
+    return BenchmarkResult(
+        name=benchmark.name,
+        group=benchmark.group,
+        number=number,
+        repeat=repeat,
+        ops_per_sec=round(1 / median, 2) if median else 0.0,
+        median_ms=round(median * 1000, 4),
+        min_ms=round(min(timings) * 1000, 4),
+        stdev_ms=round(statistics.pstdev(timings) * 1000, 4),
+        queries_per_op=queries_per_op,
+        peak_kib=round((peak - before) / 1024, 1),
+        retained_kib=round((current - before) / 1024, 1),
+        setup_seconds=round(setup_seconds, 3),
+    )
+
+
+def compare_results(results, baseline, threshold=0.1):
+    """与基线比较
+
+    Args:
+        results: 本次结果 {name: result_dict}
+        baseline: 基线结果 {name: result_dict}
+        threshold: 吞吐量下降或内存增长超过该比例视为退化
+
+    Returns:
+        [(name, 指标, 基线值, 本次值, 变化比例, 是否退化)]
+    """
+    rows = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if not base:
+            continue
+        for metric, higher_is_better in (('ops_per_sec', True), ('queries_per_op', False), ('peak_kib', False)):
+            old, new = base.get(metric, 0), result.get(metric, 0)
+            change = (new - old) / old if old else 0.0
+            if metric == 'queries_per_op':
+                # 查询次数是确定值，任何增加都算退化
+                regressed = new > old
+            elif higher_is_better:
+                regressed = change < -threshold
+            else:
+                # 小于 64 KiB 的内存波动不计
+                regressed = change > threshold and new - old > 64
+            rows.append((name, metric, old, new, change, regressed))
+    return rows
+
+
+def git_commit():
+    """当前代码的提交号，写入基准和压测结果，不在 git 仓库中时返回空字符串"""
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, timeout=5,
+            cwd=settings.BASE_DIR,
+        ).stdout.strip()
+    except (OSError, subprocess.SubprocessError):
+        return ''
@@ -0,0 +1,174 @@
+"""卡密批量导入服务
+
+PostgreSQL 使用 COPY ... FROM STDIN 将卡密写入临时表，再用一条 INSERT ... SELECT
+完成去重合并；SQLite 等其他数据库退回到 ORM 分批 bulk_create。
+"""
+import csv
+import io
+from typing import Any, Dict, Iterable
+
+from django.db import connections, router, transaction
+from django.utils import timezone
+
+from .models import Card
+
+# ORM 路径每批写入的行数（SQLite 单条语句的参数个数有限）
+ORM_BATCH_SIZE = 500
+
+# COPY 路径使用的临时表名（ON COMMIT DROP，事务结束后自动删除）
+STAGING_TABLE = 'shop_card_import_staging'
+
+
+def import_cards(product, contents: Iterable[str], using: str = None, method: str = None) -> Dict[str, Any]:
+    """批量导入卡密
+
+    会跳过空白行、文件内重复的卡密以及该商品下已存在的卡密。
+
+    Args:
+        product: 目标商品
+        contents: 卡密内容（可迭代对象，支持生成器）
+        using: 数据库别名（默认按路由选择写库）
+        method: 强制指定导入方式 'copy' / 'orm'（默认按数据库类型自动选择）
+
+    Returns:
+        导入结果字典：total（有效行数）、created（新建数量）、duplicates（跳过的重复数量）、method
+    """
+    using = using or router.db_for_write(Card)
+    connection = connections[using]
+
+    if method is None:
+        method = 'copy' if connection.vendor == 'postgresql' else 'orm'
+
+    if method == 'copy':
+        if connection.vendor != 'postgresql':
+            raise ValueError('COPY 导入仅支持 PostgreSQL 数据库')
+        return _import_cards_copy(product, contents, using)
+    return _import_cards_orm(product, contents, using)
+
+
+def iter_excel_contents(file) -> Iterable[str]:
+    """读取 .xlsx 文件第一列的卡密（从第二行开始），空行和重复卡密由 import_cards 过滤"""
+    # 延迟导入：openpyxl 较重，只有导入卡密时需要
+    from openpyxl import load_workbook
+
+    workbook = load_workbook(file, read_only=True)
+    try:
+        for row in workbook.active.iter_rows(min_row=2, max_col=1, values_only=True):
+            yield row[0]
+    finally:
+        workbook.close()
+
+
+def _clean_contents(contents: Iterable[str]):
+    """去掉首尾空白并跳过空行"""
+    for content in contents:
+        if content is None:
+            continue
+        content = str(content).strip()
+        if content:
+            yield content
+
+
+def _import_cards_orm(product, contents: Iterable[str], using: str) -> Dict[str, Any]:
+    """ORM 导入路径（SQLite 兜底）"""
+    rows = list(_clean_contents(contents))
+    total = len(rows)
+    # 文件内去重，保持原始顺序
+    unique_contents = list(dict.fromkeys(rows))
+    created = 0
+
+    with transaction.atomic(using=using):
+        for start in range(0, len(unique_contents), ORM_BATCH_SIZE):
+            batch = unique_contents[start:start + ORM_BATCH_SIZE]
+
+            # 过滤该商品下已存在的卡密
+            existing = set(
+                Card.objects.using(using)
+                .filter(product=product, content__in=batch)
+                .values_list('content', flat=True)
+            )
+            new_cards = [
+                Card(product=product, content=content, status='unsold')
+                for content in batch
+                if content not in existing
+            ]
+            if new_cards:
+                Card.objects.using(using).bulk_create(new_cards, batch_size=ORM_BATCH_SIZE)
+                created += len(new_cards)
+
+    return {
+        'total': total,
+        'created': created,
+        'duplicates': total - created,
+        'method': 'orm',
+    }
+
+
+def _import_cards_copy(product, contents: Iterable[str], using: str) -> Dict[str, Any]:
+    """PostgreSQL COPY 导入路径"""
+    connection = connections[using]
+    card_table = connection.ops.quote_name(Card._meta.db_table)
+    staging_table = connection.ops.quote_name(STAGING_TABLE)
+
+    # 以 CSV 格式写入缓冲区，卡密中的换行、逗号、引号由 csv 模块转义
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    total_rows = 0
+    for content in _clean_contents(contents):
+        writer.writerow([content])
+        total_rows += 1
+    buffer.seek(0)
+
+    with transaction.atomic(using=using):
+        with connection.cursor() as cursor:
+            # 外层已有事务时临时表可能尚未删除，先清空再使用
+            cursor.execute(
+                f'CREATE TEMPORARY TABLE IF NOT EXISTS {staging_table} (content text NOT NULL) ON COMMIT DROP'
+            )
+            cursor.execute(f'TRUNCATE {staging_table}')
+            _copy_from_buffer(cursor, f'COPY {staging_table} (content) FROM STDIN WITH (FORMAT csv)', buffer)
+
+            # 一条语句完成：文件内去重 + 过滤已存在卡密 + 插入 + 统计
+            cursor.execute(
+                f"""
+                WITH staged AS (
+                    SELECT DISTINCT content FROM {staging_table}
+                ),
+                inserted AS (
+                    INSERT INTO {card_table} (product_id, content, status, created_at)
+                    SELECT %s, staged.content, 'unsold', %s
+                    FROM staged
+                    WHERE NOT EXISTS (
+                        SELECT 1 FROM {card_table} existing
+                        WHERE existing.product_id = %s AND existing.content = staged.content
+                    )
+                    RETURNING 1
+                )
+                SELECT COUNT(*) FROM inserted
+                """,
+                [product.pk, timezone.now(), product.pk],
+            )
+            created = cursor.fetchone()[0]
+
+    return {
+        'total': total_rows,
+        'created': created,
+        'duplicates': total_rows - created,
+        'method': 'copy',
+    }
+
+
+def _copy_from_buffer(cursor, sql: str, buffer: io.StringIO):
+    """兼容 psycopg2 与 psycopg 3 的 COPY FROM STDIN"""
+    raw_cursor = cursor.cursor
+    if hasattr(raw_cursor, 'copy_expert'):
+        # psycopg2
+        raw_cursor.copy_expert(sql, buffer)
+    else:
+        # psycopg 3
+        with raw_cursor.copy(sql) as copy:
+            while True:
+                chunk = buffer.read(65536)
+                if not chunk:
+                    break
+                copy.write(chunk)
@@ -0,0 +1,232 @@
+"""外部依赖熔断器
+
+依赖（微信支付）大面积超时或报错时，继续按完整超时和重试去调用只会占满所有工作进程。
+熔断器统计最近一段时间的失败率和慢调用率：
+
+- 关闭（closed）：正常调用，记录每次调用的结果和耗时；
+- 打开（open）：调用数达到 min_calls 且失败率或慢调用率超过阈值后打开，open_seconds 内直接失败，不发请求；
+- 半开（half-open）：打开时间到期后只放行一个探测请求，成功则关闭并清空统计，失败则重新打开。
+
+状态保存在 Django 缓存中，多进程 / Serverless 多实例共用（缓存配置见 core/settings.py 的 CACHES）。
+统计按固定时间窗口分桶，取当前和上一个窗口之和；数据库缓存的 incr 不是原子操作，
+并发时计数可能略少，对熔断判断影响不大。缓存不可用时熔断器不生效（放行所有调用）。
+
+数据库缓存每次操作都是几条 SQL，正常调用尽量少访问缓存：
+- 调用前读取一次 open_until，调用后记录结果时复用，不再重复读取；
+- 成功调用先在进程内累计，每 SUCCESS_FLUSH_SECONDS 秒或记录失败/慢调用时一并写入缓存。
+依赖正常时每次调用只有一次缓存读取；进程退出时未写入的成功次数丢失，失败率会略微偏高。
+"""
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+
+logger = logging.getLogger(__name__)
+
+CALLS = 'calls'
+FAILURES = 'failures'
+SLOW = 'slow'
+
+# 进程内累计的成功调用写入缓存的最小间隔（秒）
+SUCCESS_FLUSH_SECONDS = 10
+
+# 未读取 open_until 时的占位（None 表示熔断器关闭）
+_UNKNOWN = object()
+
+_pending_lock = threading.Lock()
+# 窗口键 -> 尚未写入缓存的成功调用数
+_pending_calls = {}
+# 熔断器名称 -> 上次写入成功调用数的时间
+_last_flush = {}
+
+
+class CircuitOpenError(Exception):
+    """熔断器打开，未发起调用"""
+
+
+class CircuitBreaker:
+    """基于缓存的熔断器
+
+    Args:
+        name: 依赖名称，用作缓存键前缀
+        failure_rate: 失败率阈值（0~1）
+        slow_call_seconds: 耗时超过该值的调用记为慢调用
+        slow_call_rate: 慢调用率阈值（0~1）
+        min_calls: 统计窗口内至少有这么多次调用才判断是否打开
+        window_seconds: 统计窗口长度（秒）
+        open_seconds: 打开后多久进入半开状态（秒）
+        cache_alias: 使用的缓存
+    """
+
+    def __init__(self, name, failure_rate=0.5, slow_call_seconds=3.0, slow_call_rate=0.5, min_calls=10,
+                 window_seconds=60, open_seconds=30, cache_alias='default', clock=time.time):
+        self.name = name
+        self.failure_rate = failure_rate
+        self.slow_call_seconds = slow_call_seconds
+        self.slow_call_rate = slow_call_rate
+        self.min_calls = min_calls
+        self.window_seconds = window_seconds
+        self.open_seconds = open_seconds
+        self.cache = caches[cache_alias]
+        self.clock = clock
+        # before_call 读到的 open_until，供紧接着的 record 复用
+        self._open_until = _UNKNOWN
+
+    # ------------------------------------------------------------------
+    # 缓存键
+    # ------------------------------------------------------------------
+
+    def _key(self, suffix):
+        return f'circuit:{self.name}:{suffix}'
+
+    def _window_keys(self, kind, now):
+        bucket = int(now // self.window_seconds)
+        return self._key(f'{kind}:{bucket}'), self._key(f'{kind}:{bucket - 1}')
+
+    # ------------------------------------------------------------------
+    # 调用前后
+    # ------------------------------------------------------------------
+
+    def before_call(self):
+        """调用前检查，熔断器打开时抛出 CircuitOpenError"""
+        self._open_until = _UNKNOWN
+        try:
+            open_until = self._open_until = self.cache.get(self._key('open_until'))
+            if open_until is None:
+                return
+            if self.clock() < open_until:
+                raise CircuitOpenError(f'{self.name} 熔断中，{open_until - self.clock():.0f} 秒后重试')
+            # 半开：只有抢到探测锁的请求可以调用，锁在一次调用的最长时间后自动释放
+            if not self.cache.add(self._key('probe'), 1, timeout=max(1, int(self.open_seconds))):
+                raise CircuitOpenError(f'{self.name} 熔断恢复探测中')
+            logger.info("熔断器半开，发送探测请求: %s", self.name)
+        except CircuitOpenError:
+            raise
+        except Exception as e:
+            logger.warning("熔断器状态读取失败，放行调用: %s, %s", self.name, e)
+
+    def record(self, success, duration):
+        """记录一次调用的结果和耗时（秒）"""
+        try:
+            self._record(success, duration)
+        except Exception as e:
+            logger.warning("熔断器状态写入失败: %s, %s", self.name, e)
+
+    def _record(self, success, duration):
+        now = self.clock()
+        slow = duration >= self.slow_call_seconds
+        open_until, self._open_until = self._open_until, _UNKNOWN
+        if open_until is _UNKNOWN:
+            open_until = self.cache.get(self._key('open_until'))
+        if open_until is not None:
+            if now < open_until:
+                # 打开前已发出的调用，结果不再计入
+                return
+            # 半开状态的探测结果直接决定关闭或重新打开
+            if success and not slow:
+                self.reset()
+                logger.warning("熔断器关闭，依赖已恢复: %s", self.name)
+            else:
+                self._open(now, '探测失败')
+            return
+
+        if success and not slow:
+            self._count_success(now)
+            return
+        self._flush_successes(now)
+        self._incr(CALLS, now)
+        if not success:
+            self._incr(FAILURES, now)
+        if slow:
+            self._incr(SLOW, now)
+
+        counts = self.counts(now)
+        if counts[CALLS] < self.min_calls:
+            return
+        failure_rate = counts[FAILURES] / counts[CALLS]
+        slow_rate = counts[SLOW] / counts[CALLS]
+        if failure_rate >= self.failure_rate or slow_rate >= self.slow_call_rate:
+            self._open(now, f'{counts[CALLS]} 次调用中失败 {counts[FAILURES]} 次、慢调用 {counts[SLOW]} 次')
+
+    def _incr(self, kind, now):
+        self._incr_key(self._window_keys(kind, now)[0])
+
+    def _incr_key(self, key, delta=1):
+        # 窗口键保留两个窗口长度，之后自然过期
+        self.cache.add(key, 0, timeout=self.window_seconds * 2)
+        try:
+            self.cache.incr(key, delta)
+        except ValueError:
+            # add 与 incr 之间键过期
+            self.cache.set(key, delta, timeout=self.window_seconds * 2)
+
+    def _count_success(self, now):
+        """成功调用先计入进程内的计数，到达写入间隔时写入缓存"""
+        key = self._window_keys(CALLS, now)[0]
+        with _pending_lock:
+            _pending_calls[key] = _pending_calls.get(key, 0) + 1
+            due = now - _last_flush.get(self.name, 0) >= SUCCESS_FLUSH_SECONDS
+        if due:
+            self._flush_successes(now)
+
+    def _flush_successes(self, now):
+        """把进程内累计的成功调用数写入缓存，早于上一个窗口的计数直接丢弃"""
+        prefix = self._key(f'{CALLS}:')
+        with _pending_lock:
+            _last_flush[self.name] = now
+            pending = {key: _pending_calls.pop(key) for key in list(_pending_calls) if key.startswith(prefix)}
+        for key in self._window_keys(CALLS, now):
+            if pending.get(key):
+                self._incr_key(key, pending[key])
+
+    def _open(self, now, reason):
+        self.cache.set(self._key('open_until'), now + self.open_seconds, timeout=None)
+        self.cache.delete(self._key('probe'))
+        logger.warning("熔断器打开 %s 秒: %s, %s", self.open_seconds, self.name, reason)
+
+    # ------------------------------------------------------------------
+    # 查询和重置
+    # ------------------------------------------------------------------
+
+    def counts(self, now=None):
+        """当前统计窗口内的调用数、失败数、慢调用数"""
+        now = self.clock() if now is None else now
+        keys = {kind: self._window_keys(kind, now) for kind in (CALLS, FAILURES, SLOW)}
+        values = self.cache.get_many([key for pair in keys.values() for key in pair])
+        return {kind: sum(values.get(key, 0) for key in pair) for kind, pair in keys.items()}
+
+    def state(self):
+        """closed / open / half-open"""
+        open_until = self.cache.get(self._key('open_until'))
+        if open_until is None:
+            return 'closed'
+        return 'open' if self.clock() < open_until else 'half-open'
+
+    def reset(self):
+        now = self.clock()
+        prefix = self._key(f'{CALLS}:')
+        with _pending_lock:
+            _last_flush.pop(self.name, None)
+            for key in [key for key in _pending_calls if key.startswith(prefix)]:
+                del _pending_calls[key]
+        keys = [self._key('open_until'), self._key('probe')]
+        for kind in (CALLS, FAILURES, SLOW):
+            keys.extend(self._window_keys(kind, now))
+        self.cache.delete_many(keys)
+
+
+def wechat_pay_breaker():
+    """微信支付熔断器（参数见 settings.WECHAT_PAY_BREAKER_*），未启用时返回 None"""
+    if not settings.WECHAT_PAY_BREAKER_ENABLED:
+        return None
+    return CircuitBreaker(
+        'wechat_pay',
+        failure_rate=settings.WECHAT_PAY_BREAKER_FAILURE_RATE,
+        slow_call_seconds=settings.WECHAT_PAY_BREAKER_SLOW_CALL_SECONDS,
+        slow_call_rate=settings.WECHAT_PAY_BREAKER_SLOW_CALL_RATE,
+        min_calls=settings.WECHAT_PAY_BREAKER_MIN_CALLS,
+        window_seconds=settings.WECHAT_PAY_BREAKER_WINDOW_SECONDS,
+        open_seconds=settings.WECHAT_PAY_BREAKER_OPEN_SECONDS,
+    )
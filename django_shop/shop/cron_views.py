@@ -1,4 +1,5 @@
 """定时任务视图（用于 Vercel Cron Jobs）"""
+import logging
 import time
 
 from django.http import JsonResponse, HttpResponseForbidden
@@ -6,9 +7,13 @@ from django.views.decorators.http import require_GET
 from django.views.decorators.csrf import csrf_exempt
 from django.conf import settings
 
+from . import idempotency
+from .reconciliation import reconcile_payments
 from .stats_service import get_today_stats
 from .feishu_utils import send_daily_report
 
+logger = logging.getLogger(__name__)
+
 # 防抖机制：防止短时间内重复请求
 _last_test_time = {}
 _DEBOUNCE_SECONDS = 5
@@ -49,9 +54,7 @@ def daily_report_cron(request):
         })
 
     except Exception as e:
-        print(f"定时任务执行失败: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.error("定时任务执行失败: %s", e, exc_info=True)
 
         return JsonResponse({
             'success': False,
@@ -59,6 +62,36 @@ def daily_report_cron(request):
         }, status=500)
 
 
+@csrf_exempt
+@require_GET
+def reconcile_payments_cron(request):
+    """支付对账定时任务：向微信查询待支付订单，补发回调丢失的订单
+
+    与每日报告相同，只接受 vercel-cron/* User-Agent 的请求。
+    每轮在 PAYMENT_RECONCILE_DEADLINE_SECONDS 内结束，未查询完的订单留给下一轮。
+    每轮顺带清理过期的下单幂等键（测试模式也清理）。
+    """
+    user_agent = request.META.get('HTTP_USER_AGENT', '')
+    if not user_agent.startswith('vercel-cron/'):
+        return HttpResponseForbidden('Forbidden: Invalid User-Agent')
+
+    idempotency.purge_expired(force=True)
+
+    if settings.PAYMENT_TEST_MODE:
+        return JsonResponse({'success': True, 'message': '测试模式，跳过对账'})
+
+    try:
+        result = reconcile_payments()
+        return JsonResponse({'success': True, **result.to_dict()})
+
+    except Exception as e:
+        logger.error("支付对账失败: %s", e, exc_info=True)
+        return JsonResponse({
+            'success': False,
+            'error': str(e)
+        }, status=500)
+
+
 @csrf_exempt
 @require_GET
 def test_feishu_notification(request):
@@ -68,9 +101,6 @@ def test_feishu_notification(request):
     - 测试订单通知: /api/cron/test-feishu/?type=order
     - 测试销售日报: /api/cron/test-feishu/?type=daily (默认)
     """
-    import logging
-    logger = logging.getLogger(__name__)
-
     # 简单的密钥保护
     secret_key = request.GET.get('secret')
     expected_secret = getattr(settings, 'CRON_SECRET_KEY', None)
@@ -84,7 +114,7 @@ def test_feishu_notification(request):
 
         # 获取测试类型
         notification_type = request.GET.get('type', 'order')  # 默认测试订单通知
-        logger.info(f"[测试接口-{request_id}] 开始执行，类型={notification_type}")
+        logger.info("[测试接口-%s] 开始执行，类型=%s", request_id, notification_type)
 
         # 防抖检查：防止短时间内重复请求
         now = time.time()
@@ -93,7 +123,7 @@ def test_feishu_notification(request):
         if cache_key in _last_test_time:
             time_diff = now - _last_test_time[cache_key]
             if time_diff < _DEBOUNCE_SECONDS:
-                logger.warning(f"[测试接口-{request_id}] 检测到{time_diff:.1f}秒内的重复请求，已忽略")
+                logger.warning("[测试接口-%s] 检测到%.1f秒内的重复请求，已忽略", request_id, time_diff)
                 return JsonResponse({
                     'success': False,
                     'message': f'请求太频繁，请{_DEBOUNCE_SECONDS - time_diff:.1f}秒后再试',
@@ -118,9 +148,9 @@ def test_feishu_notification(request):
                     'error': '没有找到已支付的订单用于测试'
                 }, status=404)
 
-            logger.info(f"[测试接口-{request_id}] 准备发送订单#{recent_order.id}的通知")
+            logger.info("[测试接口-%s] 准备发送订单#%s的通知", request_id, recent_order.id)
             result = send_order_notification(recent_order)
-            logger.info(f"[测试接口-{request_id}] 订单#{recent_order.id}通知发送完成")
+            logger.info("[测试接口-%s] 订单#%s通知发送完成", request_id, recent_order.id)
 
             return JsonResponse({
                 'success': True,
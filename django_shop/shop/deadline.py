@@ -0,0 +1,58 @@
+"""请求级截止时间
+
+一个请求内的所有外部调用共用同一个 Deadline：每次尝试的超时取剩余时间，
+剩余时间不足以完成下一次尝试（含退避等待）时停止重试，不再叠加多层重试。
+
+用法:
+    deadline = Deadline(settings.WECHAT_PAY_DEADLINE_SECONDS)
+    code_url = client.create_native_order(order, deadline=deadline)
+    logger.info("下单耗时 %.2fs", deadline.elapsed)
+"""
+import time
+
+
+class DeadlineExceeded(Exception):
+    """剩余时间不足，未发起（或放弃）外部调用"""
+
+
+class Deadline:
+    """截止时间（单调时钟）
+
+    Args:
+        seconds: 总预算（秒）
+        min_attempt: 一次尝试至少需要的时间（秒），剩余时间低于该值时不再发起调用
+    """
+
+    def __init__(self, seconds, min_attempt=1.0, clock=time.monotonic):
+        self.seconds = seconds
+        self.min_attempt = min_attempt
+        self._clock = clock
+        self._started = clock()
+        self._expires = self._started + seconds
+
+    @property
+    def elapsed(self):
+        return self._clock() - self._started
+
+    @property
+    def remaining(self):
+        return max(0.0, self._expires - self._clock())
+
+    @property
+    def expired(self):
+        return self.remaining < self.min_attempt
+
+    def timeout(self, cap=None):
+        """本次调用的超时时间：剩余时间（不超过 cap），不足 min_attempt 时抛出 DeadlineExceeded"""
+        remaining = self.remaining
+        if remaining < self.min_attempt:
+            raise DeadlineExceeded(f'请求时间预算 {self.seconds}s 已用完（已用 {self.elapsed:.2f}s）')
+        return min(remaining, cap) if cap else remaining
+
+    def allows_retry(self, backoff):
+        """等待 backoff 秒后是否还来得及再尝试一次"""
+        return self.remaining - backoff >= self.min_attempt
+
+    def child(self, seconds):
+        """预算不超过 seconds 且不晚于本截止时间的子截止时间"""
+        return Deadline(min(seconds, self.remaining), self.min_attempt, self._clock)
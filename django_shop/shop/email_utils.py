@@ -3,6 +3,8 @@ from django.core.mail import send_mail
 from django.template.loader import render_to_string
 from django.conf import settings
 
+from .tracing import trace_span
+
 
 def send_card_email(order, cards):
     """发送卡密到用户邮箱
@@ -48,11 +50,12 @@ def send_card_email(order, cards):
 数字商店
     """
 
-    send_mail(
-        subject=subject,
-        message=plain_message,
-        from_email=settings.DEFAULT_FROM_EMAIL,
-        recipient_list=[order.email],
-        html_message=html_message,
-        fail_silently=False,
-    )
+    with trace_span('smtp', 'card_email', order_id=order.id):
+        send_mail(
+            subject=subject,
+            message=plain_message,
+            from_email=settings.DEFAULT_FROM_EMAIL,
+            recipient_list=[order.email],
+            html_message=html_message,
+            fail_silently=False,
+        )
@@ -1,25 +1,20 @@
 """飞书消息推送工具"""
 import json
-import requests
+import logging
 from django.conf import settings
 from typing import Dict, List, Any
 
+from .tracing import trace_span
 
-def send_feishu_message(webhook_url: str, msg_type: str, content: Dict[str, Any]) -> Dict:
-    """发送飞书消息基础函数
+logger = logging.getLogger(__name__)
 
-    Args:
-        webhook_url: 飞书 Webhook URL
-        msg_type: 消息类型 (text, post, interactive)
-        content: 消息内容
+FEISHU_HEADERS = {
+    'Content-Type': 'application/json; charset=utf-8'
+}
 
-    Returns:
-        响应结果字典
-    """
-    headers = {
-        'Content-Type': 'application/json; charset=utf-8'
-    }
 
+def _build_payload(msg_type: str, content: Dict[str, Any]) -> Dict[str, Any]:
+    """构建飞书 Webhook 请求体"""
     payload = {
         'msg_type': msg_type,
     }
@@ -29,33 +24,69 @@ def send_feishu_message(webhook_url: str, msg_type: str, content: Dict[str, Any]
     else:
         payload['content'] = content
 
-    try:
-        response = requests.post(
-            webhook_url,
-            data=json.dumps(payload).encode('utf-8'),
-            headers=headers,
-            timeout=10
-        )
-        response.raise_for_status()
-        result = response.json()
+    return payload
+
 
-        # 检查飞书API返回的状态码
-        if result.get('code') != 0:
-            error_msg = result.get('msg', '未知错误')
-            raise Exception(f"飞书API返回错误: code={result.get('code')}, msg={error_msg}")
+def _check_result(result: Dict) -> Dict:
+    """检查飞书API返回的状态码"""
+    if result.get('code') != 0:
+        error_msg = result.get('msg', '未知错误')
+        raise Exception(f"飞书API返回错误: code={result.get('code')}, msg={error_msg}")
+    return result
+
+
+def send_feishu_message(webhook_url: str, msg_type: str, content: Dict[str, Any]) -> Dict:
+    """发送飞书消息基础函数
+
+    Args:
+        webhook_url: 飞书 Webhook URL
+        msg_type: 消息类型 (text, post, interactive)
+        content: 消息内容
+
+    Returns:
+        响应结果字典
+    """
+    # 延迟导入：requests 只在真正发送通知时需要，避免拖慢冷启动
+    import requests
 
-        return result
+    try:
+        with trace_span('feishu', msg_type) as span:
+            response = requests.post(
+                webhook_url,
+                data=json.dumps(_build_payload(msg_type, content)).encode('utf-8'),
+                headers=FEISHU_HEADERS,
+                timeout=10
+            )
+            span.status_code = response.status_code
+        response.raise_for_status()
+        return _check_result(response.json())
     except requests.exceptions.Timeout as e:
-        print(f"飞书消息发送超时: {e}")
+        logger.warning("飞书消息发送超时: %s", e)
         raise
     except requests.exceptions.RequestException as e:
-        print(f"飞书消息发送网络错误: {e}")
+        logger.warning("飞书消息发送网络错误: %s", e)
         raise
     except Exception as e:
-        print(f"飞书消息发送失败: {e}")
+        logger.warning("飞书消息发送失败: %s", e)
         raise
 
 
+async def send_feishu_message_async(webhook_url: str, msg_type: str, content: Dict[str, Any]) -> Dict:
+    """send_feishu_message 的异步版本（httpx），供 ASGI 异步视图使用"""
+    import httpx
+
+    with trace_span('feishu', msg_type) as span:
+        async with httpx.AsyncClient(timeout=10) as client:
+            response = await client.post(
+                webhook_url,
+                content=json.dumps(_build_payload(msg_type, content)).encode('utf-8'),
+                headers=FEISHU_HEADERS,
+            )
+        span.status_code = response.status_code
+    response.raise_for_status()
+    return _check_result(response.json())
+
+
 def build_daily_report_card(stats_data: Dict[str, Any]) -> Dict[str, Any]:
     """构建每日销售报告消息卡片
 
@@ -262,14 +293,12 @@ def send_order_notification(order):
     Args:
         order: Order 对象
     """
-    import logging
     import uuid
     import time
-    logger = logging.getLogger(__name__)
 
     # 生成唯一消息ID
     msg_id = f"{order.id}-{int(time.time())}-{str(uuid.uuid4())[:8]}"
-    logger.info(f"[飞书通知] send_order_notification 被调用，订单#{order.id}，消息ID={msg_id}")
+    logger.info("[飞书通知] send_order_notification 被调用，订单#%s，消息ID=%s", order.id, msg_id)
 
     # 获取商品库存信息
     stock_count = order.product.stock_count()
@@ -283,7 +312,32 @@ def send_order_notification(order):
 
     # 发送到飞书
     webhook_url = settings.FEISHU_WEBHOOK_URL
-    logger.info(f"[飞书通知] 准备发送HTTP请求到飞书，订单#{order.id}，消息ID={msg_id}")
+    logger.info("[飞书通知] 准备发送HTTP请求到飞书，订单#%s，消息ID=%s", order.id, msg_id)
     result = send_feishu_message(webhook_url, 'interactive', card)
-    logger.info(f"[飞书通知] 飞书HTTP请求完成，订单#{order.id}，消息ID={msg_id}，响应={result}")
+    logger.info("[飞书通知] 飞书HTTP请求完成，订单#%s，消息ID=%s，响应=%s", order.id, msg_id, result)
+    return result
+
+
+async def send_order_notification_async(order):
+    """send_order_notification 的异步版本
+
+    Args:
+        order: Order 对象（需已通过 select_related 加载 product）
+    """
+    import uuid
+    import time
+
+    from .models import Card
+
+    msg_id = f"{order.id}-{int(time.time())}-{str(uuid.uuid4())[:8]}"
+
+    stock_count = await Card.objects.filter(product_id=order.product_id, status='unsold').acount()
+    stock_info = {
+        'product_name': order.product.name,
+        'stock_count': stock_count
+    }
+
+    card = build_order_notification_card(order, stock_info, msg_id)
+    result = await send_feishu_message_async(settings.FEISHU_WEBHOOK_URL, 'interactive', card)
+    logger.info("[飞书通知] 飞书HTTP请求完成，订单#%s，消息ID=%s，响应=%s", order.id, msg_id, result)
     return result
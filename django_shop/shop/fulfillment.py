@@ -0,0 +1,157 @@
+"""订单履约：支付成功后分配卡密并发送通知
+
+微信回调、主动查询和测试模式共用同一套履约逻辑（同步/异步视图均调用这里）。
+"""
+import logging
+
+from django.db import transaction
+
+from .models import Card, Order
+from .order_state import PAYABLE_STATUSES, mark_cancelled, mark_paid
+from .tracing import bind_order
+
+logger = logging.getLogger(__name__)
+
+# fulfill_order 的处理结果
+FULFILLED = 'fulfilled'
+ALREADY_PAID = 'already_paid'
+OUT_OF_STOCK = 'out_of_stock'
+# 选中的卡密反复被并发事务抢先售出（并非缺货），订单保持未支付，由回调重试或下次查询处理
+CONFLICT = 'conflict'
+
+# 卡密分配冲突时最多重新选择的次数（含第一次）
+ALLOCATE_ATTEMPTS = 2
+
+
+def fulfill_order(order_filter, transaction_id, cancel_on_shortage=False, **extra_fields):
+    """将订单标记为已支付并分配卡密
+
+    不对订单加行锁：先分配卡密，再用条件 UPDATE 把订单从未支付转为已支付（见 order_state.py）。
+    并发的回调和轮询中只有一个能完成转换，其余的在同一事务内回滚已分配的卡密并返回 ALREADY_PAID。
+
+    Args:
+        order_filter: 定位订单的查询条件，例如 {'out_trade_no': ...} 或 {'pk': ...}
+        transaction_id: 微信支付交易号
+        cancel_on_shortage: 库存不足时是否将订单标记为已取消
+        extra_fields: 需要一并更新的订单字段（例如测试模式的 qr_code_url）
+
+    Returns:
+        (order, cards, result)，result 为 FULFILLED / ALREADY_PAID / OUT_OF_STOCK / CONFLICT
+    """
+    order = Order.objects.select_related('product').get(**order_filter)
+    # 之后的邮件、飞书调用记录关联到该订单
+    bind_order(order.id)
+
+    # 防止重复处理：已处理的订单不再进入事务
+    if order.payment_status not in PAYABLE_STATUSES:
+        return order, [], ALREADY_PAID
+
+    with transaction.atomic():
+        cards = _allocate_cards(order)
+        if cards is None:
+            return order, [], CONFLICT
+
+        if len(cards) < order.quantity:
+            if cancel_on_shortage:
+                # 库存不足，需要退款（这里简化处理）
+                mark_cancelled(order)
+            return order, cards, OUT_OF_STOCK
+
+        # 卡密已在同一事务内分配，paid -> completed 合并到同一条 UPDATE
+        paid = mark_paid(order, transaction_id, status='completed', **extra_fields)
+        if not paid:
+            # 其他请求已抢先完成支付，释放本次分配的卡密
+            transaction.set_rollback(True)
+
+    if not paid:
+        order.refresh_from_db()
+        return order, [], ALREADY_PAID
+    return order, cards, FULFILLED
+
+
+def _allocate_cards(order):
+    """为订单锁定并售出卡密，库存不足时不修改任何卡密，返回已找到的卡密；分配冲突时返回 None
+
+    PostgreSQL 用 SKIP LOCKED 跳过其他事务正在分配的卡密；SQLite 没有行锁，
+    依靠 IMMEDIATE 事务串行化写入（见 core/db_profiles.py）。两种数据库都用带 status='unsold'
+    条件的 UPDATE 兜底：实际更新行数不足说明卡密已被其他事务售出，回滚到保存点后重新选择，
+    ALLOCATE_ATTEMPTS 次都冲突时返回 None，不能当作缺货取消已支付的订单。
+    """
+    for attempt in range(1, ALLOCATE_ATTEMPTS + 1):
+        cards = list(
+            Card.objects
+            .select_for_update(skip_locked=True)
+            .filter(product_id=order.product_id, status='unsold')
+            [:order.quantity]
+        )
+        if len(cards) < order.quantity:
+            return cards
+
+        with transaction.atomic():
+            updated = (
+                Card.objects
+                .filter(pk__in=[card.pk for card in cards], status='unsold')
+                .update(status='sold', order=order)
+            )
+            if updated < len(cards):
+                logger.warning(
+                    "卡密分配冲突: 订单#%s, 需要%s张, 实际更新%s张（第 %s/%s 次）",
+                    order.id, len(cards), updated, attempt, ALLOCATE_ATTEMPTS,
+                )
+                transaction.set_rollback(True)
+                continue
+        break
+    else:
+        return None
+
+    for card in cards:
+        card.status = 'sold'
+        card.order = order
+        # 卡密都属于订单商品，复用已加载的商品对象，邮件渲染时不再逐个查询
+        card.product = order.product
+    return cards
+
+
+def send_fulfillment_notifications(order, cards, source):
+    """发送卡密邮件和飞书订单通知，失败只记录日志，不影响支付流程
+
+    Args:
+        order: 已履约的订单
+        cards: 分配的卡密列表
+        source: 触发来源（用于日志），例如 '微信回调'、'主动查询'、'测试模式'
+    """
+    from .email_utils import send_card_email
+    from .feishu_utils import send_order_notification
+
+    try:
+        send_card_email(order, cards)
+    except Exception as e:
+        logger.error("[%s] 邮件发送失败: 订单#%s, 错误=%s", source, order.id, e, exc_info=True)
+
+    try:
+        result = send_order_notification(order)
+        logger.info("[%s] 飞书通知发送成功: 订单#%s, 响应=%s", source, order.id, result)
+    except Exception as e:
+        logger.error("[%s] 飞书通知发送失败: 订单#%s, 错误=%s", source, order.id, e, exc_info=True)
+
+
+async def send_fulfillment_notifications_async(order, cards, source):
+    """send_fulfillment_notifications 的异步版本
+
+    飞书通知使用异步 HTTP 客户端；SMTP 没有异步实现，放到线程池中执行。
+    """
+    from asgiref.sync import sync_to_async
+
+    from .email_utils import send_card_email
+    from .feishu_utils import send_order_notification_async
+
+    try:
+        await sync_to_async(send_card_email, thread_sensitive=False)(order, cards)
+    except Exception as e:
+        logger.error("[%s] 邮件发送失败: 订单#%s, 错误=%s", source, order.id, e, exc_info=True)
+
+    try:
+        result = await send_order_notification_async(order)
+        logger.info("[%s] 飞书通知发送成功: 订单#%s, 响应=%s", source, order.id, result)
+    except Exception as e:
+        logger.error("[%s] 飞书通知发送失败: 订单#%s, 错误=%s", source, order.id, e, exc_info=True)
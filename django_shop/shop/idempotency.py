@@ -0,0 +1,127 @@
+"""下单幂等键
+
+双击“购买”或移动端重试 POST 时，同一个幂等键只创建一个订单、只调用一次微信下单：
+
+- 商品页表单带一个随机的隐藏字段 idempotency_key，API 客户端可以用 Idempotency-Key 请求头；
+- 第一个请求插入 IdempotencyKey（key 唯一索引）占位，下单成功后写入订单；
+- 重复请求按 key 一次索引查询（连同订单）直接返回第一次的跳转，不再访问微信；
+- 第一个请求仍在处理时，重复请求等待它完成（最多 WAIT_SECONDS）；
+- 下单失败时删除占位，同一个键可以重新提交。
+
+过期的键和长时间没有写入订单的占位（进程中途退出）在下单时顺带清理，每个进程每 PURGE_INTERVAL 秒最多一次
+（新进程的第一次下单即清理，Serverless 实例存活时间短也能清理到）；支付对账定时任务每轮也清理一次。
+"""
+import hashlib
+import logging
+import re
+import threading
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .models import IdempotencyKey
+
+logger = logging.getLogger(__name__)
+
+HEADER = 'HTTP_IDEMPOTENCY_KEY'
+FORM_FIELD = 'idempotency_key'
+KEY_PATTERN = re.compile(r'^[A-Za-z0-9_.:-]{8,64}$')
+
+# 重复请求等待第一个请求完成的最长时间（秒）和检查间隔
+WAIT_SECONDS = 10
+WAIT_INTERVAL = 0.25
+# 占位超过该时间仍未写入订单，视为第一个请求已中断
+STALE_CLAIM = timedelta(minutes=5)
+# 每个进程清理过期键的最小间隔（秒）
+PURGE_INTERVAL = 600
+
+_last_purge = 0.0
+_purge_lock = threading.Lock()
+
+
+def get_key(request):
+    """读取幂等键（请求头优先），没有时返回 None，格式不对时抛出 ValueError"""
+    key = request.META.get(HEADER) or request.POST.get(FORM_FIELD)
+    if not key:
+        return None
+    if not KEY_PATTERN.match(key):
+        raise ValueError('Idempotency-Key 格式无效（8~64 位字母、数字或 _.:-）')
+    return key
+
+
+def request_hash(slug, email, quantity):
+    """请求内容摘要：同一个键换了商品、邮箱或数量时拒绝"""
+    return hashlib.sha256(f'{slug}\n{email}\n{quantity}'.encode()).hexdigest()
+
+
+def lookup(key):
+    """按键查询未过期的记录（连同订单，一次查询）"""
+    return IdempotencyKey.objects.select_related('order').filter(key=key, expires_at__gt=timezone.now()).first()
+
+
+def claim(key, digest):
+    """占用幂等键，成功返回 (True, None)，已被占用返回 (False, 已有记录)"""
+    purge_expired()
+    now = timezone.now()
+    record = IdempotencyKey(key=key, request_hash=digest, expires_at=now + timedelta(seconds=settings.IDEMPOTENCY_KEY_TTL))
+    for _ in range(2):
+        try:
+            with transaction.atomic():
+                record.save(force_insert=True)
+            return True, None
+        except IntegrityError:
+            existing = lookup(key)
+            if existing is not None:
+                return False, existing
+            # 同名的键已过期但还没清理
+            IdempotencyKey.objects.filter(key=key, expires_at__lte=now).delete()
+    return False, lookup(key)
+
+
+def complete(key, order):
+    """下单成功，把订单写入幂等键"""
+    IdempotencyKey.objects.filter(key=key).update(order=order)
+
+
+def release(key):
+    """下单失败，删除占位，允许用同一个键重新提交"""
+    IdempotencyKey.objects.filter(key=key, order__isnull=True).delete()
+
+
+def wait_for_order(key, timeout=WAIT_SECONDS):
+    """等待第一个请求写入订单，返回记录；占位被删除（下单失败）或超时返回当时的记录（可能为 None）"""
+    deadline = time.monotonic() + timeout
+    while True:
+        record = lookup(key)
+        if record is None or record.order_id or time.monotonic() >= deadline:
+            return record
+        time.sleep(WAIT_INTERVAL)
+
+
+def purge_expired(force=False):
+    """删除过期的键和中断的占位，返回删除的行数"""
+    global _last_purge
+
+    now = time.monotonic()
+    if not force and now - _last_purge < PURGE_INTERVAL:
+        return 0
+    if not _purge_lock.acquire(blocking=False):
+        return 0
+    try:
+        _last_purge = now
+        current = timezone.now()
+        deleted, _ = IdempotencyKey.objects.filter(
+            Q(expires_at__lte=current) | Q(order__isnull=True, created_at__lt=current - STALE_CLAIM)
+        ).delete()
+        if deleted:
+            logger.info("清理过期幂等键 %s 个", deleted)
+        return deleted
+    except Exception as e:
+        logger.warning("清理幂等键失败: %s", e)
+        return 0
+    finally:
+        _purge_lock.release()
@@ -0,0 +1,369 @@
+"""端到端压测：浏览、下单、支付状态轮询和支付回调的混合负载
+
+由 manage.py loadtest 调用。被测实例通过 HTTP 访问（runserver / gunicorn / uvicorn 均可），
+微信支付由进程内的模拟器（shop.wechat_simulator）承担：
+压测线程调用模拟器把订单标记为已支付，再自己构造签名回调 POST 到被测实例，
+回调与状态轮询同时发出，用来暴露重复发货等并发问题。
+压测结束后直接查询数据库做一致性检查（超卖、重复分配、支付丢失）。
+"""
+import math
+import random
+import re
+import threading
+import time
+from collections import defaultdict
+
+from django.db import connection
+from django.db.models import Count, F, Q
+
+from .models import Card, Order, Product
+
+LOADTEST_EMAIL_DOMAIN = 'loadtest.example'
+
+_ORDER_URL = re.compile(r'/(?:payment|order)/(?P<id>\d+)/')
+
+
+def percentile(sorted_values, q):
+    """最近秩百分位数，sorted_values 须已排序"""
+    if not sorted_values:
+        return 0.0
+    index = max(0, min(len(sorted_values) - 1, math.ceil(q / 100 * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def summarize_latencies(values):
+    """耗时列表（秒）→ 毫秒统计"""
+    values = sorted(values)
+    if not values:
+        return {'p50_ms': 0.0, 'p95_ms': 0.0, 'p99_ms': 0.0, 'max_ms': 0.0, 'mean_ms': 0.0}
+    return {
+        'p50_ms': round(percentile(values, 50) * 1000, 2),
+        'p95_ms': round(percentile(values, 95) * 1000, 2),
+        'p99_ms': round(percentile(values, 99) * 1000, 2),
+        'max_ms': round(values[-1] * 1000, 2),
+        'mean_ms': round(sum(values) / len(values) * 1000, 2),
+    }
+
+
+def parse_mix(value):
+    """解析 'browse=3,checkout=1' 格式的场景权重"""
+    mix = {}
+    for item in value.split(','):
+        name, sep, weight = item.partition('=')
+        name = name.strip()
+        if not sep or name not in LoadTestRunner.SCENARIOS:
+            raise ValueError(f'无效的场景配置: {item}（可选: {", ".join(LoadTestRunner.SCENARIOS)}）')
+        mix[name] = float(weight)
+    if not any(weight > 0 for weight in mix.values()):
+        raise ValueError('至少一个场景的权重需要大于 0')
+    return mix
+
+
+class LatencyRecorder:
+    """按操作记录耗时和错误，线程安全"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(lambda: defaultdict(int))
+
+    def record(self, operation, seconds, error=None):
+        with self.lock:
+            self.latencies[operation].append(seconds)
+            if error:
+                self.errors[operation][error] += 1
+
+    def summary(self, elapsed):
+        operations = {}
+        with self.lock:
+            for operation, values in sorted(self.latencies.items()):
+                errors = dict(self.errors.get(operation, {}))
+                error_count = sum(errors.values())
+                operations[operation] = {
+                    'count': len(values),
+                    'errors': error_count,
+                    'error_rate': round(error_count / len(values), 4),
+                    'error_kinds': errors,
+                    'throughput_rps': round(len(values) / elapsed, 2) if elapsed else 0.0,
+                    **summarize_latencies(values),
+                }
+        return operations
+
+
+class LoadTestRunner:
+    """多线程压测执行器，每个线程模拟一个持续操作的用户（独立的 Cookie 和连接）"""
+
+    SCENARIOS = ('browse', 'checkout')
+
+    def __init__(self, base_url, simulator, products, concurrency=10, duration=30, sessions=0,
+                 mix=None, max_quantity=1, polls_before_pay=2, max_polls=10, poll_interval=0.5,
+                 duplicate_notify_rate=0.1, request_timeout=30, auth=None):
+        self.base_url = base_url.rstrip('/')
+        self.simulator = simulator
+        self.products = products
+        self.concurrency = concurrency
+        self.duration = duration
+        self.sessions = sessions
+        self.mix = mix or {'browse': 3, 'checkout': 1}
+        self.max_quantity = max_quantity
+        self.polls_before_pay = polls_before_pay
+        self.max_polls = max_polls
+        self.poll_interval = poll_interval
+        self.duplicate_notify_rate = duplicate_notify_rate
+        self.request_timeout = request_timeout
+        self.auth = auth
+
+        self.recorder = LatencyRecorder()
+        self.stop = threading.Event()
+        self.lock = threading.Lock()
+        self.started_sessions = 0
+        self.counters = defaultdict(int)
+
+    # ------------------------------------------------------------------
+    # 调度
+    # ------------------------------------------------------------------
+
+    def run(self):
+        """执行压测，返回 (耗时, 计数器)"""
+        threads = [
+            threading.Thread(target=self._worker, args=(n,), name=f'loadtest-{n}', daemon=True)
+            for n in range(self.concurrency)
+        ]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        if self.sessions:
+            for thread in threads:
+                thread.join()
+        else:
+            self.stop.wait(self.duration)
+            self.stop.set()
+            for thread in threads:
+                thread.join(self.request_timeout + self.max_polls * self.poll_interval)
+        return time.perf_counter() - start, dict(self.counters)
+
+    def _next_session(self):
+        with self.lock:
+            if self.stop.is_set() or (self.sessions and self.started_sessions >= self.sessions):
+                return None
+            self.started_sessions += 1
+            number = self.started_sessions
+        names = list(self.mix)
+        return number, random.choices(names, weights=[self.mix[name] for name in names])[0]
+
+    def _count(self, key):
+        with self.lock:
+            self.counters[key] += 1
+
+    def _worker(self, worker_number):
+        import httpx
+
+        client = httpx.Client(
+            base_url=self.base_url, auth=self.auth, timeout=self.request_timeout, follow_redirects=False,
+        )
+        try:
+            while True:
+                session = self._next_session()
+                if session is None:
+                    break
+                number, scenario = session
+                self._count(f'sessions_{scenario}')
+                try:
+                    getattr(self, f'_scenario_{scenario}')(client, worker_number, number)
+                except Exception as e:
+                    self.recorder.record(f'{scenario}_session', 0.0, type(e).__name__)
+        finally:
+            client.close()
+            # 每个线程单独持有数据库连接，结束时关闭
+            connection.close()
+
+    # ------------------------------------------------------------------
+    # HTTP
+    # ------------------------------------------------------------------
+
+    def _request(self, client, operation, method, url, expected=(200,), **kwargs):
+        """发送请求并记录耗时，返回 response；网络错误返回 None"""
+        start = time.perf_counter()
+        try:
+            response = client.request(method, url, **kwargs)
+        except Exception as e:
+            self.recorder.record(operation, time.perf_counter() - start, type(e).__name__)
+            return None
+        error = None if response.status_code in expected else f'HTTP {response.status_code}'
+        self.recorder.record(operation, time.perf_counter() - start, error)
+        return response
+
+    # ------------------------------------------------------------------
+    # 场景
+    # ------------------------------------------------------------------
+
+    def _scenario_browse(self, client, worker_number, number):
+        self._request(client, 'product_list', 'GET', '/')
+        product = random.choice(self.products)
+        self._request(client, 'product_detail', 'GET', f'/product/{product.slug}/')
+
+    def _scenario_checkout(self, client, worker_number, number):
+        product = random.choice(self.products)
+        session_start = time.perf_counter()
+
+        # 详情页下发 csrftoken Cookie
+        if self._request(client, 'product_detail', 'GET', f'/product/{product.slug}/') is None:
+            return
+        response = self._request(
+            client, 'buy', 'POST', f'/buy/{product.slug}/',
+            expected=(302,),
+            data={
+                'email': f'lt-{worker_number}-{number}@{LOADTEST_EMAIL_DOMAIN}',
+                'quantity': random.randint(1, self.max_quantity),
+            },
+            headers={'X-CSRFToken': client.cookies.get('csrftoken', '')},
+        )
+        if response is None:
+            return
+        match = _ORDER_URL.search(response.headers.get('location', ''))
+        if response.status_code != 302 or not match:
+            self._count('checkout_rejected')
+            return
+        order_id = int(match.group('id'))
+        if '/order/' in match.group(0):
+            # 被测实例开启了 PAYMENT_TEST_MODE，下单即完成
+            self._count('checkout_paid')
+            self.recorder.record('checkout_e2e', time.perf_counter() - session_start)
+            return
+
+        # 用户打开支付页后开始轮询
+        for _ in range(self.polls_before_pay):
+            self._poll(client, order_id)
+            time.sleep(self.poll_interval)
+
+        out_trade_no = Order.objects.values_list('out_trade_no', flat=True).get(pk=order_id)
+        status, _ = self.simulator.pay(out_trade_no, deliver=False)
+        if status != 200:
+            self._count('pay_failed')
+            return
+
+        # 回调与轮询同时到达：两条路径都会尝试发货
+        notifier = threading.Thread(target=self._notify, args=(out_trade_no,))
+        notifier.start()
+        paid = self._poll(client, order_id)
+        notifier.join()
+        if random.random() < self.duplicate_notify_rate:
+            # 微信会重复投递回调，重复回调不能再次发货
+            self._count('duplicate_notifies')
+            self._notify(out_trade_no)
+
+        polls = 0
+        while not paid and polls < self.max_polls:
+            time.sleep(self.poll_interval)
+            paid = self._poll(client, order_id)
+            polls += 1
+
+        if paid:
+            self._count('checkout_paid')
+            self.recorder.record('checkout_e2e', time.perf_counter() - session_start)
+        else:
+            self._count('checkout_unpaid')
+            self.recorder.record('checkout_e2e', time.perf_counter() - session_start, 'not_paid')
+
+    def _poll(self, client, order_id):
+        response = self._request(client, 'poll', 'GET', f'/payment/status/{order_id}/')
+        if response is None or response.status_code != 200:
+            return False
+        try:
+            return bool(response.json().get('is_paid'))
+        except ValueError:
+            return False
+
+    def _notify(self, out_trade_no):
+        import httpx
+
+        body, headers = self.simulator.build_notify(self.simulator.orders[out_trade_no])
+        start = time.perf_counter()
+        try:
+            response = httpx.post(
+                f'{self.base_url}/payment/notify/', content=body.encode(), headers=headers,
+                timeout=self.request_timeout,
+            )
+            error = None
+            if response.status_code != 200:
+                error = f'HTTP {response.status_code}'
+            elif response.json().get('code') != 'SUCCESS':
+                error = 'FAIL'
+        except Exception as e:
+            error = type(e).__name__
+        self.recorder.record('notify', time.perf_counter() - start, error)
+
+
+def count_sold_without_order(products):
+    """被测商品中已售但没有关联订单的卡密数量（压测前后各统计一次）"""
+    return Card.objects.filter(product__in=products, status='sold', order__isnull=True).count()
+
+
+def check_consistency(since, simulator, products, sold_without_order_before=0):
+    """检查压测订单的发货一致性
+
+    Args:
+        since: 压测开始时间，只检查之后创建的压测订单
+        simulator: 压测使用的模拟器，用来比对已支付但未发货的订单
+        products: 被测商品，卡密只统计这些商品的
+        sold_without_order_before: 压测开始前 count_sold_without_order 的结果，
+            后台手动标记为已售的卡密不算作压测问题
+    """
+    orders = Order.objects.filter(created_at__gte=since, email__endswith='@' + LOADTEST_EMAIL_DOMAIN)
+
+    status_counts = {
+        f'{row["payment_status"]}/{row["status"]}': row['n']
+        for row in orders.values('payment_status', 'status').annotate(n=Count('id'))
+    }
+
+    # 已支付订单的卡密数量与购买数量不一致：重复发货或卡密被其他订单覆盖
+    allocation_mismatch = list(
+        orders.filter(payment_status='paid')
+        .annotate(card_count=Count('cards'))
+        .exclude(card_count=F('quantity'))
+        .values_list('id', flat=True)[:50]
+    )
+    # 未支付却分配了卡密
+    unpaid_with_cards = list(
+        orders.exclude(payment_status='paid')
+        .filter(cards__isnull=False)
+        .values_list('id', flat=True).distinct()[:50]
+    )
+    # 同一条卡密内容发给了多个订单（卡密被重复导入时可能发生）
+    duplicate_contents = (
+        Card.objects.filter(order__in=orders)
+        .values('content')
+        .annotate(n=Count('id'))
+        .filter(n__gt=1)
+        .count()
+    )
+    # 压测期间新增的已售但没有关联订单的卡密
+    sold_without_order = max(count_sold_without_order(products) - sold_without_order_before, 0)
+
+    # 模拟器中已支付、数据库中未支付也未因缺货取消：支付丢失
+    paid_trade_nos = [
+        no for no, order in list(simulator.orders.items()) if order.trade_state == 'SUCCESS'
+    ]
+    lost_payments = 0
+    for start in range(0, len(paid_trade_nos), 500):
+        lost_payments += orders.filter(
+            out_trade_no__in=paid_trade_nos[start:start + 500]
+        ).exclude(Q(payment_status='paid') | Q(status='cancelled')).count()
+
+    stock = {
+        row['slug']: row['stock']
+        for row in Product.objects.with_stats().values('slug', stock=F('stock_total'))
+    }
+
+    passed = not (allocation_mismatch or unpaid_with_cards or duplicate_contents
+                  or sold_without_order or lost_payments)
+    return {
+        'passed': passed,
+        'orders': status_counts,
+        'allocation_mismatch_order_ids': allocation_mismatch,
+        'unpaid_with_cards_order_ids': unpaid_with_cards,
+        'duplicate_card_contents': duplicate_contents,
+        'sold_cards_without_order': sold_without_order,
+        'lost_payments': lost_payments,
+        'remaining_stock': stock,
+    }
@@ -0,0 +1,157 @@
+"""热点函数微基准测试
+
+用法:
+    python manage.py benchmark                         # 运行全部用例，与基线比较（如果存在）
+    python manage.py benchmark --only allocate --only price
+    python manage.py benchmark --stats-orders 50000    # 缩小统计用例的数据量，快速运行
+    python manage.py benchmark --save-baseline         # 把本次结果保存为基线
+    python manage.py benchmark --fail-on-regression    # 相对基线退化时返回非零状态（用于 CI）
+
+用例定义在 shop/benchmarks/cases.py。所有数据在事务中准备，结束后回滚，不会在数据库中留下数据。
+基线与机器相关，默认保存在 benchmark-results/baseline.json（不提交到仓库）。
+"""
+import fnmatch
+import json
+import platform
+from datetime import datetime
+from pathlib import Path
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+from shop.benchmarks import compare_results, git_commit, registry, run_benchmark
+from shop.benchmarks.cases import BenchmarkContext
+
+
+class _Rollback(Exception):
+    """用于在压测结束后回滚事务"""
+
+
+class Command(BaseCommand):
+    help = '热点函数微基准测试：吞吐量、内存分配和查询次数，并与基线比较'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--only', action='append', help='只运行名称匹配的用例（子串或通配符），可重复指定')
+        parser.add_argument('--list', action='store_true', help='列出所有用例')
+        parser.add_argument('--repeat', type=int, default=5, help='每个用例重复的轮数')
+        parser.add_argument('--min-time', type=float, default=0.2, help='每轮最短耗时（秒）')
+        parser.add_argument('--stats-orders', type=int, default=1_000_000, help='统计用例的订单总数')
+        parser.add_argument('--export-cards', type=int, default=5000, help='Excel 导入导出用例的卡密数量')
+        parser.add_argument('--output', help='结果 JSON 路径，默认 benchmark-results/benchmark-<时间>.json')
+        parser.add_argument('--baseline', default=str(Path(settings.BASE_DIR) / 'benchmark-results' / 'baseline.json'),
+                            help='基线文件路径')
+        parser.add_argument('--save-baseline', action='store_true', help='把本次结果保存为基线')
+        parser.add_argument('--threshold', type=float, default=0.1, help='吞吐量下降/内存增长超过该比例视为退化')
+        parser.add_argument('--fail-on-regression', action='store_true', help='出现退化时返回非零状态')
+
+    def handle(self, *args, **options):
+        # 导入时注册用例
+        import shop.benchmarks.cases  # noqa: F401
+
+        if options['list']:
+            for benchmark in registry.values():
+                self.stdout.write(f'{benchmark.group:<14}{benchmark.name}')
+            return
+
+        benchmarks = [
+            benchmark for benchmark in registry.values()
+            if not options['only'] or any(
+                pattern in benchmark.name or fnmatch.fnmatch(benchmark.name, pattern) for pattern in options['only']
+            )
+        ]
+        if not benchmarks:
+            raise CommandError('没有匹配的用例，使用 --list 查看全部用例')
+        if options['repeat'] < 1:
+            raise CommandError('--repeat 必须大于 0')
+
+        self.stdout.write(f'数据库: {connection.vendor}，{len(benchmarks)} 个用例，每个重复 {options["repeat"]} 轮')
+        self.stdout.write(
+            f'{"用例":<26}{"ops/s":>12}{"中位数":>12}{"波动":>8}{"查询":>6}{"峰值内存":>12}{"未释放":>10}'
+        )
+        results = self._run(benchmarks, options)
+
+        output = {
+            'meta': {
+                'created_at': datetime.now().isoformat(timespec='seconds'),
+                'git_commit': git_commit(),
+                'python': platform.python_version(),
+                'machine': platform.machine(),
+                'database': connection.vendor,
+                'stats_orders': options['stats_orders'],
+                'export_cards': options['export_cards'],
+            },
+            'results': results,
+        }
+        output_path = Path(options['output'] or Path(settings.BASE_DIR) / 'benchmark-results'
+                           / f'benchmark-{datetime.now():%Y%m%d-%H%M%S}.json')
+        output_path.parent.mkdir(parents=True, exist_ok=True)
+        output_path.write_text(json.dumps(output, ensure_ascii=False, indent=2))
+        self.stdout.write(f'结果已保存: {output_path}')
+
+        baseline_path = Path(options['baseline'])
+        regressions = []
+        if baseline_path.exists() and not options['save_baseline']:
+            regressions = self._compare(results, baseline_path, options['threshold'])
+
+        if options['save_baseline']:
+            baseline = json.loads(baseline_path.read_text()) if baseline_path.exists() else {'results': {}}
+            # 只运行部分用例时保留其他用例的基线
+            baseline['meta'] = output['meta']
+            baseline['results'].update(results)
+            baseline_path.parent.mkdir(parents=True, exist_ok=True)
+            baseline_path.write_text(json.dumps(baseline, ensure_ascii=False, indent=2))
+            self.stdout.write(self.style.SUCCESS(f'基线已更新: {baseline_path}'))
+
+        if regressions and options['fail_on_regression']:
+            raise CommandError(f'{len(regressions)} 项指标相对基线退化')
+
+    def _run(self, benchmarks, options):
+        results = {}
+        context = BenchmarkContext(stats_orders=options['stats_orders'], export_cards=options['export_cards'])
+        try:
+            with transaction.atomic():
+                for benchmark in benchmarks:
+                    try:
+                        # 每个用例一个保存点：用例失败时只回滚它自己的数据，
+                        # PostgreSQL 上外层事务也不会进入 aborted 状态而拖垮后面的用例
+                        with transaction.atomic():
+                            result = run_benchmark(benchmark, context, options['repeat'], options['min_time'])
+                    except Exception as e:
+                        self.stdout.write(self.style.ERROR(f'{benchmark.name:<26}失败: {e}'))
+                        continue
+                    results[benchmark.name] = result.to_dict()
+                    spread = result.stdev_ms / result.median_ms if result.median_ms else 0
+                    self.stdout.write(
+                        f'{result.name:<26}{result.ops_per_sec:>12,.1f}{result.median_ms:>10.3f}ms'
+                        f'{spread:>8.1%}{result.queries_per_op:>6}{result.peak_kib:>10.1f}KiB'
+                        f'{result.retained_kib:>8.1f}KiB'
+                    )
+                raise _Rollback()
+        except _Rollback:
+            pass
+        finally:
+            context.close()
+        return results
+
+    def _compare(self, results, baseline_path, threshold):
+        try:
+            baseline = json.loads(baseline_path.read_text())
+        except ValueError as e:
+            raise CommandError(f'无法读取基线 {baseline_path}: {e}')
+
+        rows = compare_results(results, baseline.get('results', {}), threshold)
+        self.stdout.write(f'\n对比基线 {baseline_path}（{baseline.get("meta", {}).get("git_commit") or "未知提交"}）')
+        regressions = []
+        for name, metric, old, new, change, regressed in rows:
+            if metric != 'ops_per_sec' and not regressed:
+                continue
+            line = f'{name:<26}{metric:<16}{old:>12,.2f} → {new:>12,.2f}  {change:+.1%}'
+            if regressed:
+                regressions.append(line)
+                self.stdout.write(self.style.ERROR(line + '  退化'))
+            elif change > threshold:
+                self.stdout.write(self.style.SUCCESS(line))
+            else:
+                self.stdout.write(line)
+        return regressions
@@ -0,0 +1,79 @@
+"""卡密导入吞吐量压测
+
+用法:
+    python manage.py benchmark_card_import --rows 100000
+    python manage.py benchmark_card_import --rows 100000 --method orm --method copy
+
+压测在事务中执行并在结束后回滚，不会在数据库中留下数据。
+"""
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+from shop.card_import import import_cards
+from shop.models import Product
+
+
+class _Rollback(Exception):
+    """用于在压测结束后回滚事务"""
+
+
+class Command(BaseCommand):
+    help = '测试卡密批量导入吞吐量（COPY 与 ORM 路径）'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=50000, help='每轮导入的卡密数量')
+        parser.add_argument('--duplicate-ratio', type=float, default=0.1,
+                            help='与已有卡密重复的比例（0~1），用于覆盖去重逻辑')
+        parser.add_argument('--method', action='append', choices=['orm', 'copy'],
+                            help='导入方式，可重复指定；默认按数据库类型测试可用的全部方式')
+
+    def handle(self, *args, **options):
+        rows = options['rows']
+        duplicate_ratio = options['duplicate_ratio']
+        if rows < 1:
+            raise CommandError('--rows 必须大于 0')
+        if not 0 <= duplicate_ratio < 1:
+            raise CommandError('--duplicate-ratio 必须在 0~1 之间')
+
+        methods = options['method']
+        if not methods:
+            methods = ['orm', 'copy'] if connection.vendor == 'postgresql' else ['orm']
+        if 'copy' in methods and connection.vendor != 'postgresql':
+            raise CommandError('COPY 导入仅支持 PostgreSQL 数据库')
+
+        self.stdout.write(f'数据库: {connection.vendor}，每轮 {rows} 行，重复比例 {duplicate_ratio:.0%}')
+
+        for method in methods:
+            elapsed, result = self._run(method, rows, duplicate_ratio)
+            throughput = result['total'] / elapsed if elapsed else 0
+            self.stdout.write(self.style.SUCCESS(
+                f'[{method}] {result["total"]} 行，新建 {result["created"]}，'
+                f'跳过重复 {result["duplicates"]}，耗时 {elapsed:.2f}s，{throughput:,.0f} 行/秒'
+            ))
+
+    def _run(self, method, rows, duplicate_ratio):
+        """在回滚事务中执行一轮导入，返回 (耗时, 导入结果)"""
+        duplicate_rows = int(rows * duplicate_ratio)
+        contents = [f'BENCH-{i:010d}-XXXX-XXXX' for i in range(rows)]
+
+        try:
+            with transaction.atomic():
+                product = Product.objects.create(
+                    name=f'导入压测商品-{method}',
+                    slug=f'benchmark-import-{method}-{int(time.time())}',
+                    price=1,
+                )
+                # 预先写入一部分卡密，使本轮导入覆盖"过滤已存在卡密"的路径
+                if duplicate_rows:
+                    import_cards(product, contents[:duplicate_rows], method='orm')
+
+                started = time.perf_counter()
+                result = import_cards(product, contents, method=method)
+                elapsed = time.perf_counter() - started
+                raise _Rollback()
+        except _Rollback:
+            pass
+
+        return elapsed, result
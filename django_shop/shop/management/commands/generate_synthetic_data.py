@@ -0,0 +1,82 @@
+"""生成大规模合成数据
+
+用法:
+    python manage.py generate_synthetic_data --products 20 --cards 2000000 --orders 1000000
+    python manage.py generate_synthetic_data --seed 7 --end-date 2026-01-31 --months 6
+    python manage.py generate_synthetic_data --clear            # 删除合成数据
+
+合成商品的 slug 以 synthetic-<seed>- 开头，订单邮箱为 *@synthetic.example，
+可用 --clear 删除后重新生成。相同的 --seed 和 --end-date 生成完全相同的数据。
+"""
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from shop.synthetic_data import SyntheticDataGenerator, clear_synthetic_data
+
+
+class Command(BaseCommand):
+    help = '生成商品、阶梯价格、卡密和订单合成数据，用于基准测试和执行计划检查'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--products', type=int, default=20, help='商品数量')
+        parser.add_argument('--cards', type=int, default=1_000_000, help='未售出卡密总数（按商品热度分配）')
+        parser.add_argument('--orders', type=int, default=1_000_000, help='订单总数，已支付订单另外生成对应的已售卡密')
+        parser.add_argument('--months', type=int, default=12, help='订单时间跨度（月）')
+        parser.add_argument('--seed', type=int, default=42, help='随机种子')
+        parser.add_argument('--end-date', help='订单截止日期 YYYY-MM-DD，默认当前时间；需要完全可复现时指定')
+        parser.add_argument('--batch-size', type=int, default=10000, help='每批写入的行数')
+        parser.add_argument('--clear', action='store_true', help='删除所有合成数据后退出')
+
+    def handle(self, *args, **options):
+        if options['products'] < 1 or options['orders'] < 0 or options['cards'] < 0:
+            raise CommandError('--products 必须大于 0，--orders/--cards 不能为负数')
+
+        end_date = None
+        if options['end_date']:
+            from datetime import date
+
+            try:
+                end_date = date.fromisoformat(options['end_date'])
+            except ValueError:
+                raise CommandError('--end-date 格式应为 YYYY-MM-DD')
+
+        if options['clear']:
+            orders, products = clear_synthetic_data()
+            self.stdout.write(f'已删除 {products} 个合成商品和 {orders} 个订单')
+            return
+
+        def progress(orders, cards):
+            elapsed = time.perf_counter() - started
+            self.stdout.write(f'  订单 {orders:,}/{options["orders"]:,}，已售卡密 {cards:,}，{elapsed:.0f}s')
+
+        generator = SyntheticDataGenerator(
+            products=options['products'],
+            cards=options['cards'],
+            orders=options['orders'],
+            months=options['months'],
+            seed=options['seed'],
+            end_date=end_date,
+            batch_size=options['batch_size'],
+            progress=progress if options['verbosity'] >= 2 or options['orders'] >= 100_000 else None,
+        )
+        self.stdout.write(
+            f'数据库: {connection.vendor}，种子 {options["seed"]}，{options["products"]} 个商品，'
+            f'{options["orders"]:,} 个订单，{options["cards"]:,} 个未售卡密'
+        )
+        started = time.perf_counter()
+        try:
+            result = generator.generate()
+        except ValueError as e:
+            raise CommandError(str(e))
+        elapsed = time.perf_counter() - started
+
+        rows = result['orders'] + result['sold_cards'] + result['unsold_cards']
+        self.stdout.write(self.style.SUCCESS(
+            f'完成：{result["products"]} 个商品，{result["orders"]:,} 个订单，'
+            f'{result["sold_cards"]:,} 个已售卡密，{result["unsold_cards"]:,} 个未售卡密，'
+            f'耗时 {elapsed:.1f}s（{rows / elapsed if elapsed else 0:,.0f} 行/秒）'
+        ))
+        if connection.vendor == 'postgresql':
+            self.stdout.write('建议执行 ANALYZE 更新统计信息后再检查执行计划')
@@ -0,0 +1,213 @@
+"""端到端压测：浏览、下单、支付状态轮询和支付回调
+
+用法:
+    # 1. 被测实例使用模拟器配置启动（simulator.env 由 wechatpay_simulator 或本命令首次运行生成）
+    set -a; . .wechatpay_simulator/simulator.env; set +a; python manage.py runserver --noreload
+    # 2. 另一个终端运行压测（本命令在进程内启动模拟器，端口需与 simulator.env 一致）
+    python manage.py loadtest --concurrency 20 --duration 60
+    python manage.py loadtest --sessions 500 --mix browse=1,checkout=1 --baseline loadtest-results/before.json
+
+被测实例与本命令需要连接同一个数据库：压测结束后直接查询订单和卡密做一致性检查。
+压测订单的邮箱为 lt-*@loadtest.example，可在后台按邮箱筛选清理。
+结果写入 JSON 文件，可通过 --baseline 与之前的结果比较。
+"""
+import json
+from datetime import datetime
+from pathlib import Path
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from shop.benchmarks import git_commit
+from shop.loadtest import LoadTestRunner, check_consistency, count_sold_without_order, parse_mix
+from shop.models import Product
+from shop.wechat_simulator import FaultConfig, SimulatorKeys, WeChatPaySimulator, format_env, start_simulator
+
+
+class Command(BaseCommand):
+    help = '端到端压测（浏览、下单、轮询、回调），输出延迟分位数、吞吐量、错误率和发货一致性检查'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--base-url', default=settings.SITE_URL, help='被测实例地址')
+        parser.add_argument('--concurrency', type=int, default=10, help='并发用户（线程）数')
+        parser.add_argument('--duration', type=float, default=30, help='压测时长（秒）')
+        parser.add_argument('--sessions', type=int, default=0, help='总会话数，指定后忽略 --duration')
+        parser.add_argument('--mix', default='browse=3,checkout=1', help='场景权重')
+        parser.add_argument('--product', action='append', help='参与压测的商品 slug，可重复指定；默认全部有库存的商品')
+        parser.add_argument('--max-quantity', type=int, default=1, help='每单购买数量上限（随机 1~N）')
+        parser.add_argument('--polls-before-pay', type=int, default=2, help='支付前的轮询次数')
+        parser.add_argument('--max-polls', type=int, default=10, help='支付后等待发货的最多轮询次数')
+        parser.add_argument('--poll-interval', type=float, default=0.5, help='轮询间隔（秒）')
+        parser.add_argument('--duplicate-notify-rate', type=float, default=0.1, help='重复投递回调的比例')
+        parser.add_argument('--timeout', type=float, default=30, help='单个请求超时（秒）')
+        parser.add_argument('--basic-auth', help='被测实例开启 Basic Auth 时的 用户名:密码')
+        parser.add_argument('--simulator-host', default='127.0.0.1')
+        parser.add_argument('--simulator-port', type=int, default=9100)
+        parser.add_argument('--key-dir', default=str(Path(settings.BASE_DIR) / '.wechatpay_simulator'))
+        parser.add_argument('--wechat-latency-ms', type=float, default=0, help='模拟器固定延迟')
+        parser.add_argument('--wechat-jitter-ms', type=float, default=0, help='模拟器随机附加延迟')
+        parser.add_argument('--wechat-error-rate', type=float, default=0, help='模拟器 500 错误比例')
+        parser.add_argument('--output', help='结果 JSON 路径，默认 loadtest-results/loadtest-<时间>.json')
+        parser.add_argument('--baseline', help='与之前的结果 JSON 比较')
+
+    def handle(self, *args, **options):
+        try:
+            mix = parse_mix(options['mix'])
+        except ValueError as e:
+            raise CommandError(str(e))
+        if options['concurrency'] < 1:
+            raise CommandError('--concurrency 必须大于 0')
+        if not 0 <= options['duplicate_notify_rate'] <= 1:
+            raise CommandError('--duplicate-notify-rate 必须在 0~1 之间')
+
+        products = Product.objects.with_stats().filter(stock_total__gt=0)
+        if options['product']:
+            products = products.filter(slug__in=options['product'])
+        products = list(products)
+        if not products:
+            raise CommandError('没有可压测的商品（需要有库存），可先运行 generate_synthetic_data 或导入卡密')
+        stock_before = sum(product.stock_total for product in products)
+
+        keys = SimulatorKeys.load_or_create(options['key_dir'])
+        simulator = WeChatPaySimulator(keys, FaultConfig(
+            latency_ms=options['wechat_latency_ms'],
+            jitter_ms=options['wechat_jitter_ms'],
+            error_rate=options['wechat_error_rate'],
+        ))
+        try:
+            server = start_simulator(simulator, options['simulator_host'], options['simulator_port'])
+        except OSError as e:
+            raise CommandError(
+                f'模拟器无法监听 {options["simulator_host"]}:{options["simulator_port"]}（{e}），'
+                '如果 wechatpay_simulator 正在运行请先停止'
+            )
+        env_file = Path(options['key_dir']) / 'simulator.env'
+        if not env_file.exists():
+            env_file.write_text(format_env(keys.env(
+                server.base_url, notify_url=f'{options["base_url"].rstrip("/")}/payment/notify/',
+            )))
+            self.stdout.write(self.style.WARNING(f'已生成 {env_file}，被测实例需使用该配置启动'))
+
+        auth = tuple(options['basic_auth'].split(':', 1)) if options['basic_auth'] else None
+        runner = LoadTestRunner(
+            options['base_url'], simulator, products,
+            concurrency=options['concurrency'],
+            duration=options['duration'],
+            sessions=options['sessions'],
+            mix=mix,
+            max_quantity=options['max_quantity'],
+            polls_before_pay=options['polls_before_pay'],
+            max_polls=options['max_polls'],
+            poll_interval=options['poll_interval'],
+            duplicate_notify_rate=options['duplicate_notify_rate'],
+            request_timeout=options['timeout'],
+            auth=auth,
+        )
+
+        self.stdout.write(
+            f'压测 {options["base_url"]}：{options["concurrency"]} 并发，'
+            + (f'{options["sessions"]} 个会话' if options['sessions'] else f'{options["duration"]:g} 秒')
+            + f'，场景 {mix}，{len(products)} 个商品共 {stock_before} 件库存'
+        )
+        sold_without_order_before = count_sold_without_order(products)
+        started_at = timezone.now()
+        try:
+            elapsed, counters = runner.run()
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        operations = runner.recorder.summary(elapsed)
+        requests = sum(op['count'] for name, op in operations.items() if name != 'checkout_e2e')
+        errors = sum(op['errors'] for name, op in operations.items() if name != 'checkout_e2e')
+        results = {
+            'meta': {
+                'started_at': started_at.isoformat(),
+                'git_commit': git_commit(),
+                'base_url': options['base_url'],
+                'database': settings.DATABASES['default']['ENGINE'].rsplit('.', 1)[-1],
+                'options': {
+                    key: options[key] for key in (
+                        'concurrency', 'duration', 'sessions', 'mix', 'max_quantity', 'polls_before_pay',
+                        'max_polls', 'poll_interval', 'duplicate_notify_rate', 'wechat_latency_ms',
+                        'wechat_jitter_ms', 'wechat_error_rate',
+                    )
+                },
+            },
+            'summary': {
+                'elapsed_seconds': round(elapsed, 3),
+                'requests': requests,
+                'throughput_rps': round(requests / elapsed, 2) if elapsed else 0.0,
+                'error_rate': round(errors / requests, 4) if requests else 0.0,
+                'orders_paid': counters.get('checkout_paid', 0),
+                'orders_per_second': round(counters.get('checkout_paid', 0) / elapsed, 2) if elapsed else 0.0,
+                'counters': counters,
+            },
+            'operations': operations,
+            'consistency': check_consistency(started_at, simulator, products, sold_without_order_before),
+            'simulator': simulator.snapshot(),
+        }
+
+        self._print(results)
+        output = Path(options['output'] or Path(settings.BASE_DIR) / 'loadtest-results'
+                      / f'loadtest-{datetime.now():%Y%m%d-%H%M%S}.json')
+        output.parent.mkdir(parents=True, exist_ok=True)
+        output.write_text(json.dumps(results, ensure_ascii=False, indent=2, default=str))
+        self.stdout.write(f'结果已保存: {output}')
+
+        if options['baseline']:
+            self._compare(results, options['baseline'])
+
+        if not results['consistency']['passed']:
+            raise CommandError('发货一致性检查未通过，详见结果文件 consistency 字段')
+
+    def _print(self, results):
+        summary = results['summary']
+        self.stdout.write(
+            f'\n耗时 {summary["elapsed_seconds"]:.1f}s，{summary["requests"]} 个请求，'
+            f'{summary["throughput_rps"]:.1f} req/s，错误率 {summary["error_rate"]:.2%}，'
+            f'完成支付 {summary["orders_paid"]} 单（{summary["orders_per_second"]:.2f} 单/秒）'
+        )
+        self.stdout.write(f'{"操作":<16}{"次数":>8}{"错误率":>9}{"p50":>10}{"p95":>10}{"p99":>10}{"req/s":>9}')
+        for name, op in results['operations'].items():
+            self.stdout.write(
+                f'{name:<16}{op["count"]:>8}{op["error_rate"]:>9.2%}{op["p50_ms"]:>9.1f}ms'
+                f'{op["p95_ms"]:>8.1f}ms{op["p99_ms"]:>8.1f}ms{op["throughput_rps"]:>9.1f}'
+            )
+
+        consistency = results['consistency']
+        style = self.style.SUCCESS if consistency['passed'] else self.style.ERROR
+        self.stdout.write(style(
+            f'一致性检查{"通过" if consistency["passed"] else "未通过"}：'
+            f'卡密数量不符 {len(consistency["allocation_mismatch_order_ids"])}，'
+            f'未支付却有卡密 {len(consistency["unpaid_with_cards_order_ids"])}，'
+            f'重复卡密 {consistency["duplicate_card_contents"]}，'
+            f'无订单的已售卡密 {consistency["sold_cards_without_order"]}，'
+            f'支付丢失 {consistency["lost_payments"]}'
+        ))
+
+    def _compare(self, results, baseline_path):
+        try:
+            baseline = json.loads(Path(baseline_path).read_text())
+        except (OSError, ValueError) as e:
+            raise CommandError(f'无法读取基线结果 {baseline_path}: {e}')
+
+        def delta(new, old):
+            return f'{(new - old) / old:+.1%}' if old else 'n/a'
+
+        self.stdout.write(f'\n对比基线 {baseline_path}（{baseline["meta"].get("git_commit") or "未知提交"}）')
+        old, new = baseline['summary'], results['summary']
+        self.stdout.write(
+            f'吞吐量 {old["throughput_rps"]} → {new["throughput_rps"]} req/s '
+            f'({delta(new["throughput_rps"], old["throughput_rps"])})，'
+            f'错误率 {old["error_rate"]:.2%} → {new["error_rate"]:.2%}'
+        )
+        for name, op in results['operations'].items():
+            base = baseline['operations'].get(name)
+            if not base:
+                continue
+            self.stdout.write(
+                f'{name:<16}p50 {delta(op["p50_ms"], base["p50_ms"]):>8}  '
+                f'p95 {delta(op["p95_ms"], base["p95_ms"]):>8}  p99 {delta(op["p99_ms"], base["p99_ms"]):>8}'
+            )
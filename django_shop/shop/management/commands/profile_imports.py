@@ -0,0 +1,107 @@
+"""冷启动导入耗时分析
+
+在子进程中使用 `python -X importtime` 模拟一次冷启动（加载 WSGI 应用并处理一个前台请求），
+按模块汇总导入耗时。
+
+用法:
+    python manage.py profile_imports
+    python manage.py profile_imports --top 30 --sort self
+    python manage.py profile_imports --path /product/demo/ --package shop
+"""
+import re
+import subprocess
+import sys
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+# 子进程中执行的冷启动脚本：加载 WSGI 应用并通过 RequestFactory 处理一个请求
+COLD_START_SCRIPT = '''
+import os, sys, time
+sys.path.insert(0, {base_dir!r})
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', {settings_module!r})
+started = time.perf_counter()
+from django.core.wsgi import get_wsgi_application
+application = get_wsgi_application()
+loaded = time.perf_counter()
+from django.test import RequestFactory
+from django.urls import resolve
+request_path = {path!r}
+if request_path:
+    try:
+        match = resolve(request_path)
+    except Exception as exc:
+        sys.stdout.write('RESOLVE_ERROR %s\\n' % exc)
+    else:
+        try:
+            match.func(RequestFactory().get(request_path), *match.args, **match.kwargs)
+        except Exception as exc:
+            sys.stdout.write('REQUEST_ERROR %s\\n' % exc)
+finished = time.perf_counter()
+sys.stdout.write('TIMING %.6f %.6f\\n' % (loaded - started, finished - started))
+'''
+
+IMPORTTIME_LINE = re.compile(r'^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)')
+
+
+class Command(BaseCommand):
+    help = '分析冷启动时各模块的导入耗时'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--top', type=int, default=20, help='显示耗时最多的前 N 个模块')
+        parser.add_argument('--sort', choices=['cumulative', 'self'], default='cumulative',
+                            help='排序方式：cumulative 包含子模块，self 仅模块自身')
+        parser.add_argument('--path', default='/', help='冷启动后处理的请求路径，传空字符串则只加载应用')
+        parser.add_argument('--package', default='', help='只显示指定包（前缀）下的模块，例如 shop 或 django')
+
+    def handle(self, *args, **options):
+        script = COLD_START_SCRIPT.format(
+            base_dir=str(settings.BASE_DIR),
+            settings_module=settings.SETTINGS_MODULE,
+            path=options['path'],
+        )
+        process = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c', script],
+            capture_output=True,
+            text=True,
+            cwd=str(settings.BASE_DIR),
+        )
+        if process.returncode != 0:
+            raise CommandError(f'冷启动子进程执行失败:\n{process.stderr[-2000:]}')
+
+        modules = []
+        for line in process.stderr.splitlines():
+            match = IMPORTTIME_LINE.match(line)
+            if match:
+                self_us, cumulative_us, indent, name = match.groups()
+                modules.append({
+                    'name': name,
+                    'self': int(self_us),
+                    'cumulative': int(cumulative_us),
+                    'top_level': len(indent) <= 1,
+                })
+
+        timing = None
+        for line in process.stdout.splitlines():
+            if line.startswith('TIMING '):
+                timing = [float(value) for value in line.split()[1:]]
+            elif line.startswith(('RESOLVE_ERROR', 'REQUEST_ERROR')):
+                self.stderr.write(line)
+
+        total_import_us = sum(module['cumulative'] for module in modules if module['top_level'])
+        self.stdout.write(f'导入模块数: {len(modules)}，导入总耗时: {total_import_us / 1000:.1f} ms')
+        if timing:
+            self.stdout.write(f'加载 WSGI 应用: {timing[0] * 1000:.1f} ms，含首个请求: {timing[1] * 1000:.1f} ms')
+
+        package = options['package']
+        if package:
+            modules = [m for m in modules if m['name'] == package or m['name'].startswith(package + '.')]
+
+        modules.sort(key=lambda m: m[options['sort']], reverse=True)
+
+        self.stdout.write('')
+        self.stdout.write(f'{"累计(ms)":>10} {"自身(ms)":>10}  模块')
+        for module in modules[:options['top']]:
+            self.stdout.write(
+                f'{module["cumulative"] / 1000:>10.1f} {module["self"] / 1000:>10.1f}  {module["name"]}'
+            )
@@ -0,0 +1,60 @@
+"""支付对账：向微信查询待支付订单，补发回调丢失的订单
+
+用法:
+    python manage.py reconcile_payments
+    python manage.py reconcile_payments --workers 8 --rate 20 --deadline 0   # 不限时，查完所有待支付订单
+    python manage.py reconcile_payments --dry-run                           # 只查询，不发货
+
+生产环境由 Vercel Cron 每 5 分钟调用 /api/cron/reconcile-payments/，参数见 settings.PAYMENT_RECONCILE_*。
+"""
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from shop.reconciliation import DEFAULT_GRACE, DEFAULT_MIN_AGE, reconcile_payments
+
+
+class Command(BaseCommand):
+    help = '向微信查询未支付订单的支付状态，已支付的订单走正常发货流程'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100, help='每批读取的订单数')
+        parser.add_argument('--workers', type=int, default=settings.PAYMENT_RECONCILE_WORKERS, help='并发查询线程数')
+        parser.add_argument('--rate', type=float, default=settings.PAYMENT_RECONCILE_RATE,
+                            help='每秒最多查询次数，0 表示不限')
+        parser.add_argument('--deadline', type=float, default=settings.PAYMENT_RECONCILE_DEADLINE_SECONDS,
+                            help='本轮时间预算（秒），0 表示不限')
+        parser.add_argument('--min-age', type=int, default=int(DEFAULT_MIN_AGE.total_seconds()),
+                            help='只查询创建超过该秒数的订单')
+        parser.add_argument('--grace', type=int, default=int(DEFAULT_GRACE.total_seconds() // 60),
+                            help='已过期但仍需查询的时间（分钟）')
+        parser.add_argument('--dry-run', action='store_true', help='只查询，不发货')
+
+    def handle(self, *args, **options):
+        if options['batch_size'] < 1 or options['workers'] < 1:
+            raise CommandError('--batch-size 和 --workers 必须大于 0')
+        if settings.PAYMENT_TEST_MODE:
+            self.stdout.write(self.style.WARNING('PAYMENT_TEST_MODE 已开启，查询结果不代表真实支付'))
+
+        result = reconcile_payments(
+            deadline_seconds=options['deadline'],
+            batch_size=options['batch_size'],
+            workers=options['workers'],
+            rate=options['rate'],
+            min_age=timedelta(seconds=options['min_age']),
+            grace=timedelta(minutes=options['grace']),
+            dry_run=options['dry_run'],
+        )
+
+        action = '可补发货' if options['dry_run'] else '补发货'
+        self.stdout.write(
+            f'查询 {result.checked} 单：{action} {result.fulfilled}，已由回调处理 {result.already_paid}，'
+            f'库存不足 {result.out_of_stock}，未支付 {result.not_paid}，失败 {result.errors}，耗时 {result.elapsed:.2f}s'
+        )
+        if result.fulfilled_orders:
+            self.stdout.write(f'{action}订单: {", ".join(map(str, result.fulfilled_orders))}')
+        if result.remaining:
+            self.stdout.write(self.style.WARNING('时间预算用完或熔断器打开，剩余订单留给下一轮'))
+        if result.errors:
+            raise CommandError(f'{result.errors} 个订单查询或发货失败，详见日志')
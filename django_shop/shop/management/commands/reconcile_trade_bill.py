@@ -0,0 +1,78 @@
+"""交易账单对账：下载微信支付日账单，与订单表比对
+
+用法:
+    python manage.py reconcile_trade_bill                          # 对账昨天（北京时间）
+    python manage.py reconcile_trade_bill --date 2026-01-10
+    python manage.py reconcile_trade_bill --date 2026-01-10 --file tradebill.csv.gz   # 使用已下载的账单
+    python manage.py reconcile_trade_bill --json
+
+发现差异时以非零状态退出，便于定时任务告警。
+"""
+import json
+from datetime import date, timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from shop.deadline import Deadline
+from shop.trade_bill import TradeBillError, reconcile_trade_bill
+
+ISSUE_LABELS = {
+    'missing_orders': '账单已支付、本地无订单',
+    'unfulfilled': '账单已支付、本地未发货',
+    'amount_mismatch': '金额不一致',
+    'transaction_mismatch': '微信订单号不一致',
+    'missing_in_bill': '本地已支付、账单无记录',
+}
+
+
+class Command(BaseCommand):
+    help = '下载微信支付交易账单并与订单表比对'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--date', type=date.fromisoformat, help='账单日期 YYYY-MM-DD，默认昨天')
+        parser.add_argument('--file', help='本地账单文件（CSV 或 GZIP），不从微信下载')
+        parser.add_argument('--timeout', type=float, default=120, help='申请和下载账单的总时间预算（秒）')
+        parser.add_argument('--json', action='store_true', help='以 JSON 输出完整报告')
+
+    def handle(self, *args, **options):
+        bill_date = options['date'] or timezone.localdate() - timedelta(days=1)
+
+        if options['file']:
+            with open(options['file'], 'rb') as f:
+                content = f.read()
+            hash_type, hash_value = None, None
+        else:
+            from shop.wechat_pay import WeChatPayClient
+
+            deadline = Deadline(options['timeout'])
+            try:
+                content, hash_type, hash_value = WeChatPayClient(timeout=deadline.timeout()).download_trade_bill(
+                    bill_date, deadline=deadline,
+                )
+            except Exception as e:
+                raise CommandError(f'账单下载失败: {e}')
+
+        try:
+            report = reconcile_trade_bill(bill_date, content, hash_type, hash_value)
+        except TradeBillError as e:
+            raise CommandError(f'账单解析失败: {e}')
+
+        if options['json']:
+            self.stdout.write(json.dumps(report.to_dict(), ensure_ascii=False, indent=2, default=str))
+        else:
+            self.stdout.write(
+                f'{report.bill_date} 账单 {report.rows} 笔：支付 {report.payments}，退款 {report.refunds}'
+            )
+            for name, label in ISSUE_LABELS.items():
+                items = getattr(report, name)
+                if not items:
+                    continue
+                self.stdout.write(self.style.WARNING(f'{label}: {len(items)}'))
+                for item in items:
+                    self.stdout.write('  ' + ', '.join(f'{key}={value}' for key, value in item.items()))
+
+        if report.issue_count:
+            raise CommandError(f'对账发现 {report.issue_count} 处差异')
+        if not options['json']:
+            self.stdout.write(self.style.SUCCESS('对账一致'))
@@ -0,0 +1,76 @@
+"""启动本地微信支付 V3 模拟器
+
+用法:
+    python manage.py wechatpay_simulator --port 9100
+    python manage.py wechatpay_simulator --auto-pay 2 --latency-ms 80 --jitter-ms 40 --error-rate 0.02
+
+首次启动在 --key-dir 下生成平台密钥、商户密钥和 APIv3 密钥，并写出 simulator.env。
+把 simulator.env 的内容合并到 .env（或导出为环境变量）后重启应用，
+WeChatPayClient 的请求就会发往模拟器，回调投递到 --notify-url。
+"""
+from pathlib import Path
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from shop.wechat_simulator import (
+    FaultConfig, SimulatorKeys, SimulatorServer, WeChatPaySimulator, format_env,
+)
+
+
+class Command(BaseCommand):
+    help = '启动本地微信支付 V3 模拟器（Native 下单、查询、关单、签名回调），用于压测和联调'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1')
+        parser.add_argument('--port', type=int, default=9100)
+        parser.add_argument('--key-dir', default=str(Path(settings.BASE_DIR) / '.wechatpay_simulator'),
+                            help='密钥和 simulator.env 保存目录，多次启动复用同一套密钥')
+        parser.add_argument('--notify-url', default=f'{settings.SITE_URL.rstrip("/")}/payment/notify/',
+                            help='写入 simulator.env 的回调地址')
+        parser.add_argument('--auto-pay', type=float, default=-1,
+                            help='下单后 N 秒自动支付并投递回调，默认不自动支付')
+        parser.add_argument('--latency-ms', type=float, default=0, help='每个请求的固定延迟')
+        parser.add_argument('--jitter-ms', type=float, default=0, help='随机附加延迟上限')
+        parser.add_argument('--error-rate', type=float, default=0, help='返回 500 SYSTEM_ERROR 的比例（0~1）')
+        parser.add_argument('--timeout-rate', type=float, default=0, help='挂起不响应的比例（0~1）')
+        parser.add_argument('--timeout-seconds', type=float, default=35, help='挂起时长')
+        parser.add_argument('--notify-delay', type=float, default=0, help='支付成功后延迟投递回调（秒）')
+        parser.add_argument('--no-verify-signature', action='store_true',
+                            help='不校验请求签名（应用使用自己的商户私钥时）')
+
+    def handle(self, *args, **options):
+        for name in ('error_rate', 'timeout_rate'):
+            if not 0 <= options[name] <= 1:
+                raise CommandError(f'--{name.replace("_", "-")} 必须在 0~1 之间')
+
+        keys = SimulatorKeys.load_or_create(options['key_dir'])
+        faults = FaultConfig(
+            latency_ms=options['latency_ms'],
+            jitter_ms=options['jitter_ms'],
+            error_rate=options['error_rate'],
+            timeout_rate=options['timeout_rate'],
+            timeout_seconds=options['timeout_seconds'],
+            notify_delay=options['notify_delay'],
+            auto_pay_after=options['auto_pay'],
+        )
+        simulator = WeChatPaySimulator(keys, faults, verify_signature=not options['no_verify_signature'])
+
+        try:
+            server = SimulatorServer((options['host'], options['port']), simulator)
+        except OSError as e:
+            raise CommandError(f'无法监听 {options["host"]}:{options["port"]}: {e}')
+
+        env_file = Path(options['key_dir']) / 'simulator.env'
+        env_file.write_text(format_env(keys.env(server.base_url, notify_url=options['notify_url'])))
+
+        self.stdout.write(self.style.SUCCESS(f'微信支付模拟器已启动: {server.base_url}'))
+        self.stdout.write(f'应用配置: {env_file}（合并到 .env 后重启应用）')
+        self.stdout.write(f'模拟支付: curl -X POST {server.base_url}/simulator/pay/<out_trade_no>')
+        self.stdout.write(f'运行状态: curl {server.base_url}/simulator/orders')
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            self.stdout.write('\n' + str(simulator.snapshot()))
+        finally:
+            server.server_close()
@@ -0,0 +1,293 @@
+"""请求级性能指标
+
+MetricsMiddleware 记录每个视图的耗时、ORM 查询次数和耗时、响应大小；
+外部服务（微信支付、SMTP、飞书）调用耗时由 shop/tracing.py 的 trace_span 记录到 OUTBOUND_DURATION。
+指标在进程内聚合，通过 /metrics 以 Prometheus 文本格式输出。
+
+Serverless 环境下每个函数实例的内存指标互相独立且随时被回收，
+开启 METRICS_DB_FLUSH 后各实例定期把累计值写入 MetricSnapshot 表，
+/metrics 输出时合并所有实例的快照。
+"""
+import hmac
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+from datetime import timedelta
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connection
+from django.http import HttpResponse, HttpResponseForbidden
+from django.utils import timezone
+
+from .models import MetricSnapshot
+
+logger = logging.getLogger(__name__)
+
+# 耗时分桶（秒）
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+# 查询次数分桶
+QUERY_COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200)
+# 响应大小分桶（字节）
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576)
+
+
+class Histogram:
+    """Prometheus 直方图：按标签组合累计分桶计数、总和和次数"""
+
+    def __init__(self, name, documentation, label_names, buckets):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets)
+        # 标签值元组 -> [各分桶计数..., 总和, 次数]
+        self.values = {}
+
+    def observe(self, labels, value):
+        series = self.values.get(labels)
+        if series is None:
+            series = self.values[labels] = [0] * len(self.buckets) + [0.0, 0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[i] += 1
+        series[-2] += value
+        series[-1] += 1
+
+    def merge(self, labels, series):
+        current = self.values.get(labels)
+        if current is None:
+            self.values[labels] = list(series)
+        else:
+            for i, value in enumerate(series):
+                current[i] += value
+
+    def render(self):
+        lines = [
+            f'# HELP {self.name} {self.documentation}',
+            f'# TYPE {self.name} histogram',
+        ]
+        for labels, series in sorted(self.values.items()):
+            label_text = ','.join(
+                f'{name}="{_escape_label(value)}"' for name, value in zip(self.label_names, labels)
+            )
+            prefix = label_text + ',' if label_text else ''
+            for bound, count in zip(self.buckets, series):
+                lines.append(f'{self.name}_bucket{{{prefix}le="{bound}"}} {count}')
+            lines.append(f'{self.name}_bucket{{{prefix}le="+Inf"}} {series[-1]}')
+            lines.append(f'{self.name}_sum{{{label_text}}} {series[-2]:.6f}')
+            lines.append(f'{self.name}_count{{{label_text}}} {series[-1]}')
+        return lines
+
+
+def _escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class MetricsRegistry:
+    """进程内指标注册表（线程安全）"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {}
+
+    def histogram(self, name, documentation, label_names, buckets):
+        histogram = Histogram(name, documentation, label_names, buckets)
+        self.histograms[name] = histogram
+        return histogram
+
+    def observe(self, histogram, labels, value):
+        with self.lock:
+            histogram.observe(labels, value)
+
+    def snapshot(self):
+        """导出为可 JSON 序列化的结构：{指标名: [[标签值...], [分桶计数..., 总和, 次数]]}"""
+        with self.lock:
+            return {
+                name: [[list(labels), list(series)] for labels, series in histogram.values.items()]
+                for name, histogram in self.histograms.items()
+            }
+
+    def render(self, snapshots=None):
+        """输出 Prometheus 文本格式；snapshots 不为空时输出这些快照的合并结果"""
+        if snapshots is None:
+            with self.lock:
+                lines = []
+                for histogram in self.histograms.values():
+                    lines.extend(histogram.render())
+            return '\n'.join(lines) + '\n'
+
+        merged = {
+            name: Histogram(h.name, h.documentation, h.label_names, h.buckets)
+            for name, h in self.histograms.items()
+        }
+        for snapshot in snapshots:
+            for name, series_list in snapshot.items():
+                histogram = merged.get(name)
+                if histogram is None:
+                    continue
+                for labels, series in series_list:
+                    if len(series) == len(histogram.buckets) + 2:
+                        histogram.merge(tuple(labels), series)
+        lines = []
+        for histogram in merged.values():
+            lines.extend(histogram.render())
+        return '\n'.join(lines) + '\n'
+
+
+registry = MetricsRegistry()
+
+REQUEST_DURATION = registry.histogram(
+    'shop_request_duration_seconds', '视图处理耗时（秒）',
+    ('view', 'method', 'status'), DURATION_BUCKETS,
+)
+REQUEST_DB_QUERIES = registry.histogram(
+    'shop_request_db_queries', '每个请求的 ORM 查询次数',
+    ('view',), QUERY_COUNT_BUCKETS,
+)
+REQUEST_DB_DURATION = registry.histogram(
+    'shop_request_db_duration_seconds', '每个请求的 ORM 查询总耗时（秒）',
+    ('view',), DURATION_BUCKETS,
+)
+RESPONSE_SIZE = registry.histogram(
+    'shop_response_size_bytes', '响应体大小（字节，流式响应不计）',
+    ('view',), SIZE_BUCKETS,
+)
+OUTBOUND_DURATION = registry.histogram(
+    'shop_outbound_duration_seconds', '外部服务调用耗时（秒）',
+    ('service', 'operation', 'outcome'), DURATION_BUCKETS,
+)
+
+
+class _QueryTimer:
+    """connection.execute_wrapper 回调：统计本请求的查询次数和耗时"""
+
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.count += 1
+            self.duration += time.perf_counter() - start
+
+
+def _view_name(request):
+    match = getattr(request, 'resolver_match', None)
+    if match is None:
+        return '<unresolved>'
+    return match.view_name or match._func_path
+
+
+# ---------------------------------------------------------------------------
+# 数据库快照（Serverless 多实例汇总）
+# ---------------------------------------------------------------------------
+
+WORKER_ID = f'{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}'
+# 新进程的第一个请求就写入快照，存活时间不到 METRICS_FLUSH_INTERVAL 的 Serverless 实例也能汇总到
+_last_flush = 0.0
+_flush_lock = threading.Lock()
+
+
+def flush_to_db(force=False):
+    """把本进程的累计指标写入 MetricSnapshot（每个进程一行），并清理过期快照"""
+    global _last_flush
+
+    if not settings.METRICS_DB_FLUSH:
+        return False
+    now = time.monotonic()
+    if not force and now - _last_flush < settings.METRICS_FLUSH_INTERVAL:
+        return False
+    if not _flush_lock.acquire(blocking=False):
+        return False
+    try:
+        _last_flush = now
+        MetricSnapshot.objects.update_or_create(
+            worker_id=WORKER_ID,
+            defaults={'data': registry.snapshot()},
+        )
+        expired_before = timezone.now() - timedelta(seconds=settings.METRICS_SNAPSHOT_TTL)
+        MetricSnapshot.objects.filter(updated_at__lt=expired_before).delete()
+        return True
+    except Exception as e:
+        logger.warning("指标快照写入失败: %s", e)
+        return False
+    finally:
+        _flush_lock.release()
+
+
+class MetricsMiddleware:
+    """记录视图耗时、ORM 查询次数/耗时和响应大小
+
+    同步视图通过 connection.execute_wrapper 统计查询；异步视图的查询在线程池中执行，
+    只记录耗时和响应大小。
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not settings.METRICS_ENABLED:
+            raise MiddlewareNotUsed('指标采集未启用')
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def _record(self, request, response, duration, query_timer):
+        view = _view_name(request)
+        registry.observe(REQUEST_DURATION, (view, request.method, str(response.status_code)), duration)
+        if query_timer is not None:
+            registry.observe(REQUEST_DB_QUERIES, (view,), query_timer.count)
+            registry.observe(REQUEST_DB_DURATION, (view,), query_timer.duration)
+        if not response.streaming:
+            registry.observe(RESPONSE_SIZE, (view,), len(response.content))
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        query_timer = _QueryTimer()
+        start = time.perf_counter()
+        with connection.execute_wrapper(query_timer):
+            response = self.get_response(request)
+        self._record(request, response, time.perf_counter() - start, query_timer)
+        flush_to_db()
+        return response
+
+    async def __acall__(self, request):
+        start = time.perf_counter()
+        response = await self.get_response(request)
+        self._record(request, response, time.perf_counter() - start, None)
+        return response
+
+
+def _is_authorized(request):
+    """METRICS_TOKEN（只接受 Authorization: Bearer 头，查询参数会进入访问日志）或已登录的管理员"""
+    token = settings.METRICS_TOKEN
+    if token:
+        auth_type, _, supplied = request.META.get('HTTP_AUTHORIZATION', '').partition(' ')
+        if auth_type == 'Bearer' and supplied and hmac.compare_digest(supplied.encode(), token.encode()):
+            return True
+    user = getattr(request, 'user', None)
+    return bool(user and user.is_active and user.is_staff)
+
+
+def metrics_view(request):
+    """Prometheus 指标输出"""
+    if not _is_authorized(request):
+        return HttpResponseForbidden('Forbidden')
+
+    if settings.METRICS_DB_FLUSH:
+        flush_to_db(force=True)
+        snapshots = MetricSnapshot.objects.values_list('data', flat=True)
+        body = registry.render(list(snapshots))
+    else:
+        body = registry.render()
+
+    return HttpResponse(body, content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -0,0 +1,21 @@
+# Generated by Django 5.2.9 on 2026-10-19 19:13
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0005_order_unit_price_used_pricetier'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='card',
+            index=models.Index(fields=['product', 'status'], name='shop_card_product_status_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='card',
+            index=models.Index(fields=['-created_at'], name='shop_card_created_at_idx'),
+        ),
+    ]
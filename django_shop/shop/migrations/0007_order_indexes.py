@@ -0,0 +1,39 @@
+# Generated by Django 5.2.9 on 2026-10-19 19:13
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0006_card_indexes'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='order',
+            name='email',
+            field=models.EmailField(db_index=True, max_length=254, verbose_name='买家邮箱'),
+        ),
+        migrations.AlterField(
+            model_name='order',
+            name='transaction_id',
+            field=models.CharField(blank=True, db_index=True, max_length=64, null=True, verbose_name='微信支付交易号'),
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['-created_at'], name='shop_order_created_at_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['paid_at'], name='shop_order_paid_at_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['payment_status', 'created_at'], name='shop_order_pay_status_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['status', 'created_at'], name='shop_order_status_idx'),
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 5.2.9 on 2026-10-19 19:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0007_order_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MetricSnapshot',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('worker_id', models.CharField(max_length=100, unique=True, verbose_name='进程标识')),
+                ('data', models.JSONField(default=dict, verbose_name='累计指标')),
+                ('updated_at', models.DateTimeField(auto_now=True, db_index=True, verbose_name='更新时间')),
+            ],
+            options={
+                'verbose_name': '指标快照',
+                'verbose_name_plural': '指标快照',
+            },
+        ),
+    ]
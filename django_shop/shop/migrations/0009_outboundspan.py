@@ -0,0 +1,38 @@
+# Generated by Django 5.2.9 on 2026-10-19 19:22
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0008_metricsnapshot'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OutboundSpan',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('service', models.CharField(choices=[('wechat', '微信支付'), ('smtp', '邮件'), ('feishu', '飞书')], max_length=20, verbose_name='依赖')),
+                ('operation', models.CharField(max_length=50, verbose_name='操作')),
+                ('attempt', models.PositiveSmallIntegerField(default=1, verbose_name='尝试次数')),
+                ('duration_ms', models.FloatField(verbose_name='耗时(毫秒)')),
+                ('retry_sleep_ms', models.FloatField(default=0, verbose_name='重试前等待(毫秒)')),
+                ('outcome', models.CharField(choices=[('ok', '成功'), ('error', '失败'), ('timeout', '超时')], max_length=10, verbose_name='结果')),
+                ('status_code', models.PositiveSmallIntegerField(blank=True, null=True, verbose_name='HTTP 状态码')),
+                ('error', models.CharField(blank=True, max_length=500, verbose_name='错误信息')),
+                ('request_id', models.CharField(blank=True, db_index=True, max_length=32, verbose_name='请求ID')),
+                ('request_path', models.CharField(blank=True, max_length=200, verbose_name='请求路径')),
+                ('started_at', models.DateTimeField(verbose_name='开始时间')),
+                ('order', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='outbound_spans', to='shop.order', verbose_name='关联订单')),
+            ],
+            options={
+                'verbose_name': '外部调用记录',
+                'verbose_name_plural': '外部调用记录',
+                'ordering': ['-started_at'],
+                'indexes': [models.Index(fields=['service', 'operation', '-started_at'], name='shop_span_service_op_idx'), models.Index(fields=['-started_at'], name='shop_span_started_at_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,32 @@
+"""创建数据库缓存表
+
+配置了 DATABASE_URL 时默认使用数据库缓存（core/settings.py 的 CACHE_BACKEND），
+随迁移创建缓存表，部署时不需要再手动执行 createcachetable。表已存在时跳过。
+"""
+from django.core.management.commands.createcachetable import Command as CreateCacheTableCommand
+from django.db import migrations
+
+# 与 core/settings.py 中数据库缓存的 LOCATION 一致
+CACHE_TABLE = 'shop_cache'
+
+
+def create_cache_table(apps, schema_editor):
+    command = CreateCacheTableCommand()
+    command.verbosity = 0
+    command.create_table(schema_editor.connection.alias, CACHE_TABLE, dry_run=False)
+
+
+def drop_cache_table(apps, schema_editor):
+    if CACHE_TABLE in schema_editor.connection.introspection.table_names():
+        schema_editor.execute(f'DROP TABLE {schema_editor.quote_name(CACHE_TABLE)}')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0010_idempotencykey'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_cache_table, drop_cache_table),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 5.2.9 on 2026-10-19 20:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0011_cache_table'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='card',
+            index=models.Index(fields=['product', 'content'], name='shop_card_product_content_idx'),
+        ),
+    ]
@@ -1,6 +1,46 @@
 from decimal import Decimal
 
 from django.db import models
+from django.db.models import Count, Exists, OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce
+
+
+class ProductQuerySet(models.QuerySet):
+    """商品查询集"""
+
+    def with_stats(self):
+        """附加库存、已售数量、销售额和阶梯价格标记
+
+        使用相关子查询而不是 JOIN 聚合，避免卡密和订单两张表相乘放大结果行数。
+        注解字段：stock_total、sold_total、revenue_total、tiered_pricing
+        """
+        unsold_cards = (
+            Card.objects
+            .filter(product=OuterRef('pk'), status='unsold')
+            .order_by()
+            .values('product')
+            .annotate(total=Count('pk'))
+            .values('total')
+        )
+        completed_orders = (
+            Order.objects
+            .filter(product=OuterRef('pk'), payment_status='paid', status='completed')
+            .order_by()
+            .values('product')
+        )
+        return self.annotate(
+            stock_total=Coalesce(Subquery(unsold_cards), 0),
+            sold_total=Coalesce(
+                Subquery(completed_orders.annotate(total=Sum('quantity')).values('total')),
+                0,
+            ),
+            revenue_total=Coalesce(
+                Subquery(completed_orders.annotate(total=Sum('total_amount')).values('total')),
+                Decimal('0.00'),
+                output_field=models.DecimalField(max_digits=12, decimal_places=2),
+            ),
+            tiered_pricing=Exists(PriceTier.objects.filter(product=OuterRef('pk'))),
+        )
 
 
 class Product(models.Model):
@@ -16,6 +56,8 @@ class Product(models.Model):
     created_at = models.DateTimeField('创建时间', auto_now_add=True)
     updated_at = models.DateTimeField('更新时间', auto_now=True)
 
+    objects = ProductQuerySet.as_manager()
+
     class Meta:
         verbose_name = '商品'
         verbose_name_plural = '商品'
@@ -23,12 +65,16 @@ class Product(models.Model):
 
     def stock_count(self):
         """返回该商品的未售卡密数量"""
+        if hasattr(self, 'stock_total'):
+            # 已通过 with_stats() 注解
+            return self.stock_total
         return self.cards.filter(status='unsold').count()
     stock_count.short_description = '库存数量'
 
     def sold_count(self):
         """返回该商品已完成订单的购买总数量"""
-        from django.db.models import Sum
+        if hasattr(self, 'sold_total'):
+            return self.sold_total
         result = self.orders.filter(
             payment_status='paid',
             status='completed'
@@ -57,6 +103,8 @@ class Product(models.Model):
 
     def has_tiered_pricing(self):
         """检查是否配置了阶梯价格"""
+        if hasattr(self, 'tiered_pricing'):
+            return self.tiered_pricing
         return self.price_tiers.exists()
 
     def get_price_tiers_display(self):
@@ -86,7 +134,7 @@ class Order(models.Model):
     # 商品关联
     product = models.ForeignKey(Product, on_delete=models.PROTECT, related_name='orders', verbose_name='商品', null=True, blank=True)
 
-    email = models.EmailField('买家邮箱')
+    email = models.EmailField('买家邮箱', db_index=True)
     quantity = models.PositiveIntegerField('购买数量', default=1)
     total_amount = models.DecimalField('订单金额', max_digits=10, decimal_places=2, default=Decimal('0.00'))
     unit_price_used = models.DecimalField(
@@ -103,7 +151,7 @@ class Order(models.Model):
     # 支付相关字段
     payment_status = models.CharField('支付状态', max_length=20, choices=PAYMENT_STATUS_CHOICES, default='unpaid')
     out_trade_no = models.CharField('商户订单号', max_length=64, unique=True, db_index=True, blank=True)
-    transaction_id = models.CharField('微信支付交易号', max_length=64, blank=True, null=True)
+    transaction_id = models.CharField('微信支付交易号', max_length=64, blank=True, null=True, db_index=True)
     qr_code_url = models.URLField('支付二维码链接', blank=True, null=True, max_length=500)
     paid_at = models.DateTimeField('支付时间', blank=True, null=True)
     expires_at = models.DateTimeField('订单过期时间', blank=True, null=True)
@@ -112,6 +160,12 @@ class Order(models.Model):
         verbose_name = '订单'
         verbose_name_plural = '订单'
         ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['-created_at'], name='shop_order_created_at_idx'),
+            models.Index(fields=['paid_at'], name='shop_order_paid_at_idx'),
+            models.Index(fields=['payment_status', 'created_at'], name='shop_order_pay_status_idx'),
+            models.Index(fields=['status', 'created_at'], name='shop_order_status_idx'),
+        ]
 
     def __str__(self):
         return f"订单 #{self.pk} - {self.email}"
@@ -188,6 +242,81 @@ class Card(models.Model):
         verbose_name = '卡密'
         verbose_name_plural = '卡密'
         ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['product', 'status'], name='shop_card_product_status_idx'),
+            models.Index(fields=['-created_at'], name='shop_card_created_at_idx'),
+            # 批量导入按 (商品, 内容) 过滤已存在的卡密
+            models.Index(fields=['product', 'content'], name='shop_card_product_content_idx'),
+        ]
 
     def __str__(self):
         return f"{self.product.name} - {self.get_status_display()}"
+
+
+class MetricSnapshot(models.Model):
+    """进程指标快照（Serverless 多实例汇总 /metrics 使用，见 shop/metrics.py）"""
+    worker_id = models.CharField('进程标识', max_length=100, unique=True)
+    data = models.JSONField('累计指标', default=dict)
+    updated_at = models.DateTimeField('更新时间', auto_now=True, db_index=True)
+
+    class Meta:
+        verbose_name = '指标快照'
+        verbose_name_plural = '指标快照'
+
+    def __str__(self):
+        return self.worker_id
+
+
+class OutboundSpan(models.Model):
+    """外部依赖慢调用/失败调用记录（见 shop/tracing.py）"""
+    SERVICE_CHOICES = [
+        ('wechat', '微信支付'),
+        ('smtp', '邮件'),
+        ('feishu', '飞书'),
+    ]
+    OUTCOME_CHOICES = [
+        ('ok', '成功'),
+        ('error', '失败'),
+        ('timeout', '超时'),
+    ]
+
+    service = models.CharField('依赖', max_length=20, choices=SERVICE_CHOICES)
+    operation = models.CharField('操作', max_length=50)
+    attempt = models.PositiveSmallIntegerField('尝试次数', default=1)
+    duration_ms = models.FloatField('耗时(毫秒)')
+    retry_sleep_ms = models.FloatField('重试前等待(毫秒)', default=0)
+    outcome = models.CharField('结果', max_length=10, choices=OUTCOME_CHOICES)
+    status_code = models.PositiveSmallIntegerField('HTTP 状态码', null=True, blank=True)
+    error = models.CharField('错误信息', max_length=500, blank=True)
+    order = models.ForeignKey(Order, on_delete=models.SET_NULL, null=True, blank=True, related_name='outbound_spans', verbose_name='关联订单')
+    request_id = models.CharField('请求ID', max_length=32, blank=True, db_index=True)
+    request_path = models.CharField('请求路径', max_length=200, blank=True)
+    started_at = models.DateTimeField('开始时间')
+
+    class Meta:
+        verbose_name = '外部调用记录'
+        verbose_name_plural = '外部调用记录'
+        ordering = ['-started_at']
+        indexes = [
+            models.Index(fields=['service', 'operation', '-started_at'], name='shop_span_service_op_idx'),
+            models.Index(fields=['-started_at'], name='shop_span_started_at_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.service}.{self.operation} {self.duration_ms:.0f}ms"
+
+
+class IdempotencyKey(models.Model):
+    """下单幂等键（见 shop/idempotency.py）：同一个键的重复提交返回第一次创建的订单"""
+    key = models.CharField('幂等键', max_length=64, unique=True)
+    request_hash = models.CharField('请求摘要', max_length=64)
+    order = models.ForeignKey(Order, on_delete=models.CASCADE, null=True, blank=True, related_name='idempotency_keys', verbose_name='关联订单')
+    created_at = models.DateTimeField('创建时间', auto_now_add=True)
+    expires_at = models.DateTimeField('过期时间', db_index=True)
+
+    class Meta:
+        verbose_name = '幂等键'
+        verbose_name_plural = '幂等键'
+
+    def __str__(self):
+        return self.key
@@ -0,0 +1,58 @@
+"""订单状态机
+
+每个状态转换是一条带前置状态条件的 UPDATE（compare-and-set），不需要先 SELECT ... FOR UPDATE：
+- 更新 1 行表示本次转换生效，订单对象同步为新状态；
+- 更新 0 行表示订单已不在前置状态（被并发的回调、轮询或过期处理抢先），调用方按“已处理”对待。
+重复的支付回调和轮询因此只是一条不命中的 UPDATE，不会互相等待行锁。
+
+支付状态（payment_status）:
+    unpaid  -> paid       mark_paid
+    expired -> paid       mark_paid（过期后用户仍完成了支付，以微信的支付结果为准）
+    unpaid  -> expired    mark_expired
+订单状态（status）:
+    pending -> completed  mark_paid(..., status='completed')（卡密已分配，与支付状态在同一条 UPDATE 中转换）
+    pending -> cancelled  mark_cancelled（支付时库存不足）
+"""
+from django.utils import timezone
+
+from .models import Order
+
+# 可以转为已支付的支付状态
+PAYABLE_STATUSES = ('unpaid', 'expired')
+
+
+def _transition(order, condition, **changes):
+    """condition 满足时更新订单，返回是否生效"""
+    updated = Order.objects.filter(pk=order.pk, **condition).update(**changes)
+    if updated:
+        for field, value in changes.items():
+            setattr(order, field, value)
+    return bool(updated)
+
+
+def mark_paid(order, transaction_id, paid_at=None, **extra_fields):
+    """unpaid/expired -> paid"""
+    return _transition(
+        order,
+        {'payment_status__in': PAYABLE_STATUSES},
+        payment_status='paid',
+        transaction_id=transaction_id,
+        paid_at=paid_at or timezone.now(),
+        **extra_fields,
+    )
+
+
+def mark_expired(order, now=None):
+    """unpaid -> expired，只对已超过过期时间的订单生效"""
+    return _transition(
+        order,
+        {'payment_status': 'unpaid', 'expires_at__lt': now or timezone.now()},
+        payment_status='expired',
+    )
+
+
+def mark_cancelled(order):
+    """未支付订单 pending -> cancelled"""
+    return _transition(
+        order, {'payment_status__in': PAYABLE_STATUSES, 'status': 'pending'}, status='cancelled',
+    )
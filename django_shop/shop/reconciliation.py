@@ -0,0 +1,264 @@
+"""支付对账：主动查询未支付订单的微信支付状态
+
+支付回调丢失（超时、部署中断）时，订单要等到买家页面轮询 check_payment_status 才会发货，
+买家关闭页面后就永远停留在未支付。对账任务定期扫描待支付订单并向微信查询：
+
+- 按主键 keyset 分页读取待支付订单，每批 batch_size 条，不使用 OFFSET；
+- 查询在有界线程池中并发执行，全局限速 rate 次/秒，每个订单每轮只查询一次；
+- 已支付的订单在主线程走与回调相同的履约流程（fulfill_order + 通知），工作线程只查询微信；
+  工作线程读写熔断器缓存和平台证书缓存时可能打开自己的数据库连接（数据库缓存），本轮结束时逐个关闭；
+- 整轮共用一个 Deadline，预算用完或熔断器打开时停止，剩余订单留给下一轮。
+
+待支付订单包括刚过期不久（grace 内）的订单：买家可能在过期前最后一刻完成支付，
+而两轮对账之间过期的订单也需要再查一次。
+"""
+import contextvars
+import logging
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass, field
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connections
+from django.utils import timezone
+
+from .circuit_breaker import CircuitOpenError
+from .deadline import Deadline, DeadlineExceeded
+from .fulfillment import ALREADY_PAID, CONFLICT, FULFILLED, OUT_OF_STOCK, fulfill_order, send_fulfillment_notifications
+from .models import Order
+from .order_state import PAYABLE_STATUSES
+from .tracing import trace_context
+
+logger = logging.getLogger(__name__)
+
+# 创建不久的订单买家多半还在支付页，交给页面轮询和回调
+DEFAULT_MIN_AGE = timedelta(minutes=2)
+# 过期后仍需对账的时间，应大于对账间隔
+DEFAULT_GRACE = timedelta(minutes=15)
+
+
+class RateLimiter:
+    """线程安全的限速器：相邻两次放行至少间隔 1/rate 秒"""
+
+    def __init__(self, rate):
+        self.interval = 1 / rate if rate else 0
+        self.lock = threading.Lock()
+        self.next_at = time.monotonic()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            wait = self.next_at - now
+            self.next_at = max(now, self.next_at) + self.interval
+        if wait > 0:
+            time.sleep(wait)
+
+
+@dataclass
+class ReconcileResult:
+    checked: int = 0        # 已查询的订单数
+    fulfilled: int = 0      # 查询到已支付并完成发货
+    already_paid: int = 0   # 查询期间回调或轮询已完成发货
+    out_of_stock: int = 0   # 已支付但库存不足
+    not_paid: int = 0       # 微信侧仍未支付
+    errors: int = 0         # 查询或发货失败
+    remaining: bool = False  # 预算用完或熔断，还有订单未查询
+    elapsed: float = 0.0
+    fulfilled_orders: list = field(default_factory=list)
+
+    def to_dict(self):
+        return asdict(self)
+
+
+def pending_orders(now=None, min_age=DEFAULT_MIN_AGE, grace=DEFAULT_GRACE):
+    """需要对账的订单：未支付，且未过期或过期不超过 grace"""
+    now = now or timezone.now()
+    return Order.objects.filter(
+        payment_status__in=PAYABLE_STATUSES,
+        status='pending',
+        created_at__lte=now - min_age,
+        expires_at__gt=now - grace,
+    )
+
+
+def iter_pending_batches(queryset, batch_size):
+    """按主键 keyset 分页，返回 [(pk, out_trade_no), ...] 批次"""
+    last_pk = 0
+    while True:
+        batch = list(
+            queryset.filter(pk__gt=last_pk).order_by('pk').values_list('pk', 'out_trade_no')[:batch_size]
+        )
+        if not batch:
+            return
+        yield batch
+        last_pk = batch[-1][0]
+
+
+class PaymentReconciler:
+    """对账执行器
+
+    Args:
+        batch_size: 每批读取的订单数
+        workers: 并发查询的线程数
+        rate: 每秒最多查询次数（0 表示不限）
+        deadline: 整轮的截止时间（Deadline），None 表示不限
+        dry_run: 只查询不发货
+        client_factory: 创建微信支付客户端的函数，每个工作线程一个客户端；默认客户端的超时不超过整轮的剩余时间
+    """
+
+    def __init__(self, batch_size=100, workers=4, rate=10, deadline=None, dry_run=False, client_factory=None,
+                 min_age=DEFAULT_MIN_AGE, grace=DEFAULT_GRACE):
+        self.batch_size = batch_size
+        self.workers = workers
+        self.limiter = RateLimiter(rate)
+        self.deadline = deadline
+        self.dry_run = dry_run
+        self.client_factory = client_factory or self._default_client
+        self.min_age = min_age
+        self.grace = grace
+        self._local = threading.local()
+        self._stop = threading.Event()
+
+    def _default_client(self):
+        from .wechat_pay import DEFAULT_TIMEOUT, WeChatPayClient
+
+        timeout = self.deadline.timeout(cap=DEFAULT_TIMEOUT) if self.deadline else DEFAULT_TIMEOUT
+        return WeChatPayClient(timeout=timeout)
+
+    def _client(self):
+        client = getattr(self._local, 'client', None)
+        if client is None:
+            client = self._local.client = self.client_factory()
+        return client
+
+    def _query(self, out_trade_no):
+        """工作线程：查询一个订单，返回 (查询结果, 异常)"""
+        if self._stop.is_set() or (self.deadline and self.deadline.expired):
+            return None, None
+        self.limiter.wait()
+        try:
+            # 对账每轮都会重新查询，单个订单失败不重试
+            kwargs = {'max_retries': 1}
+            if self.deadline:
+                kwargs['deadline'] = self.deadline
+            return self._client().query_order(out_trade_no, **kwargs), None
+        except Exception as e:
+            if isinstance(e, DeadlineExceeded) or isinstance(e.__cause__, DeadlineExceeded):
+                # 预算在等待限速或创建客户端期间用完，留给下一轮
+                return None, None
+            if isinstance(e.__cause__, CircuitOpenError):
+                self._stop.set()
+            return None, e
+
+    def run(self):
+        started = time.monotonic()
+        result = ReconcileResult()
+        queryset = pending_orders(min_age=self.min_age, grace=self.grace)
+
+        # 工作线程的慢调用记录到本轮的追踪上下文，结束后在主线程统一写入
+        with trace_context(f'reconcile-{uuid.uuid4().hex[:8]}', 'reconcile_payments') as trace, \
+                ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='reconcile') as executor:
+            try:
+                self._run_batches(executor, queryset, trace, result)
+            finally:
+                close_worker_connections(executor, self.workers)
+
+        result.elapsed = round(time.monotonic() - started, 3)
+        logger.info(
+            "对账完成: 查询 %s 单，补发货 %s 单，失败 %s 单，耗时 %.2fs%s",
+            result.checked, result.fulfilled, result.errors, result.elapsed, '，未完成' if result.remaining else '',
+        )
+        return result
+
+    def _run_batches(self, executor, queryset, trace, result):
+        """主线程：分批提交查询并处理结果"""
+        for batch in iter_pending_batches(queryset, self.batch_size):
+            if self._stop.is_set() or (self.deadline and self.deadline.expired):
+                result.remaining = True
+                break
+            futures = [
+                executor.submit(contextvars.copy_context().run, self._query, out_trade_no)
+                for _, out_trade_no in batch
+            ]
+            for (order_id, _), future in zip(batch, futures):
+                transaction, error = future.result()
+                if transaction is None and error is None:
+                    result.remaining = True
+                    continue
+                result.checked += 1
+                if error is not None:
+                    result.errors += 1
+                    logger.warning("对账查询失败: 订单#%s, %s", order_id, error)
+                    continue
+                self._handle(order_id, transaction, result)
+                # 发货时 bind_order 绑定的订单不延续到后续订单的查询
+                trace.order_id = None
+
+    def _handle(self, order_id, transaction, result):
+        """主线程：处理一个订单的查询结果"""
+        if transaction.get('trade_state') != 'SUCCESS':
+            result.not_paid += 1
+            return
+        if self.dry_run:
+            result.fulfilled_orders.append(order_id)
+            result.fulfilled += 1
+            return
+
+        try:
+            # 与支付回调一致：微信确认已支付但库存不足时取消订单，等待退款
+            order, cards, fulfillment = fulfill_order(
+                {'pk': order_id},
+                transaction_id=transaction.get('transaction_id', ''),
+                cancel_on_shortage=True,
+            )
+        except Exception as e:
+            result.errors += 1
+            logger.error("对账发货失败: 订单#%s, %s", order_id, e, exc_info=True)
+            return
+
+        if fulfillment == FULFILLED:
+            result.fulfilled += 1
+            result.fulfilled_orders.append(order_id)
+            logger.warning("对账补发货: 订单#%s（支付回调未送达）", order_id)
+            send_fulfillment_notifications(order, cards, '对账')
+        elif fulfillment == ALREADY_PAID:
+            result.already_paid += 1
+        elif fulfillment == OUT_OF_STOCK:
+            result.out_of_stock += 1
+            logger.error("对账发现已支付订单库存不足: 订单#%s", order_id)
+        elif fulfillment == CONFLICT:
+            # 订单仍未发货，下一轮对账重试
+            result.errors += 1
+            logger.warning("对账发货时卡密分配冲突: 订单#%s", order_id)
+
+
+def close_worker_connections(executor, workers):
+    """在线程池的每个工作线程里关闭该线程打开的数据库连接
+
+    Django 的连接按线程保存，只能由所属线程关闭。提交 workers 个在 Barrier 上会合的任务，
+    保证每个线程恰好执行一次（线程池不足 workers 个线程时会补齐新线程，新线程没有连接）。
+    """
+    barrier = threading.Barrier(workers)
+
+    def close():
+        try:
+            barrier.wait(timeout=5)
+        except threading.BrokenBarrierError:
+            pass
+        connections.close_all()
+
+    for future in [executor.submit(close) for _ in range(workers)]:
+        future.result()
+
+
+def reconcile_payments(deadline_seconds=None, **options):
+    """按 settings.PAYMENT_RECONCILE_* 执行一轮对账，返回 ReconcileResult"""
+    seconds = settings.PAYMENT_RECONCILE_DEADLINE_SECONDS if deadline_seconds is None else deadline_seconds
+    options.setdefault('workers', settings.PAYMENT_RECONCILE_WORKERS)
+    options.setdefault('rate', settings.PAYMENT_RECONCILE_RATE)
+    return PaymentReconciler(deadline=Deadline(seconds) if seconds else None, **options).run()
@@ -20,7 +20,8 @@ def get_today_stats(target_date=None) -> Dict[str, Any]:
     """
     # 确定统计日期范围（当天 00:00:00 到 23:59:59）
     if target_date is None:
-        target_date = timezone.now().date()
+        # 按本地时区（TIME_ZONE）取日期，与下面 make_aware 的时区一致
+        target_date = timezone.localdate()
 
     start_time = timezone.make_aware(datetime.combine(target_date, datetime.min.time()))
     end_time = timezone.make_aware(datetime.combine(target_date, datetime.max.time()))
@@ -83,20 +84,18 @@ def get_low_stock_products(threshold: int) -> List[Dict[str, Any]]:
     Returns:
         低库存商品列表
     """
-    products = Product.objects.all()
-    low_stock = []
-
-    for product in products:
-        stock_count = product.stock_count()
-        if stock_count < threshold:
-            low_stock.append({
-                'product_id': product.id,
-                'product_name': product.name,
-                'stock_count': stock_count,
-                'threshold': threshold
-            })
-
-    return low_stock
+    # 库存通过子查询注解后在数据库中过滤，不再逐个商品统计
+    products = Product.objects.with_stats().filter(stock_total__lt=threshold)
+
+    return [
+        {
+            'product_id': product.id,
+            'product_name': product.name,
+            'stock_count': product.stock_total,
+            'threshold': threshold
+        }
+        for product in products
+    ]
 
 
 def get_weekly_stats() -> Dict[str, Any]:
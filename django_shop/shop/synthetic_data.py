@@ -0,0 +1,305 @@
+"""大规模合成数据生成
+
+为后台、统计、发货的基准测试和执行计划检查生成与线上形态相近的数据：
+- 商品热度服从长尾分布，每个商品 1~3 档阶梯价格；
+- 订单分布在最近若干个月，越近越多，按小时有日内波峰；
+- 订单状态：约四成已支付，大量未支付/已过期，少量退款和缺货取消；
+- 已支付订单按购买数量关联已售卡密，其余卡密为未售出库存。
+
+相同的随机种子和截止日期（--end-date）生成完全相同的数据。
+写入不经过 ORM：PostgreSQL 使用 COPY，其他数据库使用 executemany，
+订单 ID 预先分配以便卡密直接引用，写入后重置自增序列。
+"""
+import csv
+import io
+import random
+from datetime import datetime, time, timedelta
+from decimal import Decimal
+
+from django.conf import settings
+from django.core.management.color import no_style
+from django.db import connections, router, transaction
+from django.db.models import Max
+from django.utils import timezone
+
+from .card_import import _copy_from_buffer
+from .models import Card, Order, PriceTier, Product
+
+SLUG_PREFIX = 'synthetic-'
+EMAIL_DOMAIN = 'synthetic.example'
+
+# 清理时每批删除的订单数
+DELETE_BATCH_SIZE = 2000
+
+# 购买数量分布
+QUANTITIES = (1, 2, 3, 5, 10, 20, 50, 100)
+QUANTITY_WEIGHTS = (60, 12, 6, 8, 7, 4, 2, 1)
+
+# 下单时段分布（0~23 点），午休和晚间为高峰
+HOUR_WEIGHTS = (3, 2, 1, 1, 1, 1, 2, 3, 5, 6, 7, 8, 9, 8, 7, 7, 7, 8, 9, 11, 12, 12, 10, 6)
+
+ORDER_FIELDS = (
+    'id', 'product_id', 'email', 'quantity', 'total_amount', 'unit_price_used', 'status', 'created_at',
+    'payment_status', 'out_trade_no', 'transaction_id', 'qr_code_url', 'paid_at', 'expires_at',
+)
+CARD_FIELDS = ('product_id', 'content', 'status', 'order_id', 'created_at')
+
+
+class _Writer:
+    """按批写入原始行"""
+
+    def __init__(self, model, fields, using, batch_size):
+        self.connection = connections[using]
+        self.batch_size = batch_size
+        self.rows = []
+        self.written = 0
+        ops = self.connection.ops
+        table = ops.quote_name(model._meta.db_table)
+        columns = ', '.join(ops.quote_name(name) for name in fields)
+        self.use_copy = self.connection.vendor == 'postgresql'
+        if self.use_copy:
+            self.sql = f'COPY {table} ({columns}) FROM STDIN WITH (FORMAT csv)'
+        else:
+            self.sql = f'INSERT INTO {table} ({columns}) VALUES ({", ".join(["%s"] * len(fields))})'
+
+    def add(self, row):
+        self.rows.append(row)
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.rows:
+            return
+        with self.connection.cursor() as cursor:
+            if self.use_copy:
+                buffer = io.StringIO()
+                csv.writer(buffer).writerows(self.rows)
+                buffer.seek(0)
+                _copy_from_buffer(cursor, self.sql, buffer)
+            else:
+                cursor.executemany(self.sql, self.rows)
+        self.written += len(self.rows)
+        self.rows = []
+
+
+class SyntheticDataGenerator:
+    """合成数据生成器
+
+    Args:
+        products: 商品数量
+        cards: 未售出卡密总数（按商品热度分配）
+        orders: 订单总数
+        months: 订单时间跨度（月）
+        seed: 随机种子
+        end_date: 订单时间的截止日期（默认当前时间），与种子一起决定生成结果
+        batch_size: 每批写入的行数
+        progress: 进度回调 progress(已写订单数, 已写卡密数)
+    """
+
+    def __init__(self, products=20, cards=1_000_000, orders=1_000_000, months=12, seed=42,
+                 end_date=None, batch_size=10000, using=None, progress=None):
+        self.product_count = products
+        self.card_count = cards
+        self.order_count = orders
+        self.days = max(1, months * 30)
+        self.seed = seed
+        # 订单时间以截止日期零点为基准按天、小时分布；指定截止日期时“当前时间”取该日结束时刻，
+        # 生成结果只取决于种子和截止日期，与运行时刻无关
+        if end_date is None:
+            self.now = timezone.now()
+            end_date = timezone.localdate(self.now)
+        else:
+            self.now = timezone.make_aware(datetime.combine(end_date + timedelta(days=1), time.min))
+        self.midnight = timezone.make_aware(datetime.combine(end_date, time.min))
+        self.batch_size = batch_size
+        self.using = using or router.db_for_write(Order)
+        self.progress = progress
+        self.rng = random.Random(seed)
+        self.connection = connections[self.using]
+
+    def generate(self):
+        """生成数据，返回各表写入行数"""
+        if Product.objects.using(self.using).filter(slug__startswith=f'{SLUG_PREFIX}{self.seed}-').exists():
+            raise ValueError(f'种子 {self.seed} 的合成数据已存在，请先清理（--clear）')
+
+        with transaction.atomic(using=self.using):
+            products = self._create_products()
+            orders, sold_cards = self._create_orders(products)
+            unsold_cards = self._create_unsold_cards(products)
+            self._reset_sequences()
+
+        return {
+            'products': len(products),
+            'orders': orders,
+            'sold_cards': sold_cards,
+            'unsold_cards': unsold_cards,
+        }
+
+    # ------------------------------------------------------------------
+    # 商品
+    # ------------------------------------------------------------------
+
+    def _create_products(self):
+        products = []
+        for rank in range(self.product_count):
+            base_price = Decimal(self.rng.choice((5, 9, 19, 29, 49, 99, 199))).quantize(Decimal('0.01'))
+            product = Product.objects.using(self.using).create(
+                name=f'合成商品{rank + 1:03d}',
+                slug=f'{SLUG_PREFIX}{self.seed}-{rank + 1:03d}',
+                description='合成数据，用于压测和执行计划检查',
+                price=base_price,
+                display_order=rank,
+            )
+            tiers = [(1, None, base_price)]
+            tier_count = self.rng.choice((1, 2, 2, 3))
+            if tier_count >= 2:
+                tiers = [(1, 9, base_price), (10, None, (base_price * Decimal('0.9')).quantize(Decimal('0.01')))]
+            if tier_count == 3:
+                tiers = tiers[:1] + [
+                    (10, 99, (base_price * Decimal('0.9')).quantize(Decimal('0.01'))),
+                    (100, None, (base_price * Decimal('0.8')).quantize(Decimal('0.01'))),
+                ]
+            PriceTier.objects.using(self.using).bulk_create([
+                PriceTier(product=product, min_quantity=low, max_quantity=high, unit_price=price, display_order=i)
+                for i, (low, high, price) in enumerate(tiers)
+            ])
+            product.tiers = tiers
+            # 长尾热度：排名越靠前下单越多
+            product.weight = 1 / (rank + 1) ** 1.1
+            products.append(product)
+        return products
+
+    @staticmethod
+    def _unit_price(product, quantity):
+        for low, high, price in product.tiers:
+            if quantity >= low and (high is None or quantity <= high):
+                return price
+        return product.price
+
+    # ------------------------------------------------------------------
+    # 订单和已售卡密
+    # ------------------------------------------------------------------
+
+    def _created_at(self):
+        # 越近的日期订单越多（业务增长），日内按时段分布
+        day = int(self.days * self.rng.random() ** 1.6)
+        hour = self.rng.choices(range(24), weights=HOUR_WEIGHTS)[0]
+        created_at = self.midnight + timedelta(days=-day, hours=hour, minutes=self.rng.randrange(60),
+                                               seconds=self.rng.randrange(60), microseconds=self.rng.randrange(1_000_000))
+        if created_at > self.now:
+            # 未指定截止日期时，今天还没到的时段挪到前一天
+            created_at -= timedelta(days=1)
+        return created_at
+
+    def _order_state(self, created_at):
+        """返回 (payment_status, status, paid_at)"""
+        # 每个订单消耗的随机数个数固定
+        r = self.rng.random()
+        paid_at = created_at + timedelta(seconds=int(self.rng.lognormvariate(3.5, 0.8)))
+        if created_at > self.now - timedelta(minutes=settings.ORDER_EXPIRE_MINUTES):
+            # 最近半小时内的订单还在等待支付
+            return ('paid', 'completed', paid_at) if r < 0.4 else ('unpaid', 'pending', None)
+        if r < 0.38:
+            return 'paid', 'completed', paid_at
+        if r < 0.395:
+            return 'refunded', 'cancelled', paid_at
+        if r < 0.41:
+            # 支付时库存不足，订单取消
+            return 'unpaid', 'cancelled', None
+        if r < 0.70:
+            # 用户在过期后重新打开支付页，订单被标记为过期
+            return 'expired', 'pending', None
+        return 'unpaid', 'pending', None
+
+    def _create_orders(self, products):
+        ops = self.connection.ops
+        orders = _Writer(Order, ORDER_FIELDS, self.using, self.batch_size)
+        cards = _Writer(Card, CARD_FIELDS, self.using, self.batch_size)
+        first_id = (Order.objects.using(self.using).aggregate(max_id=Max('id'))['max_id'] or 0) + 1
+        weights = [product.weight for product in products]
+        expire = timedelta(minutes=settings.ORDER_EXPIRE_MINUTES)
+
+        for n in range(self.order_count):
+            order_id = first_id + n
+            product = self.rng.choices(products, weights=weights)[0]
+            quantity = self.rng.choices(QUANTITIES, weights=QUANTITY_WEIGHTS)[0]
+            unit_price = self._unit_price(product, quantity)
+            created_at = self._created_at()
+            payment_status, status, paid_at = self._order_state(created_at)
+            out_trade_no = f'SYN{self.seed}_{n:09d}'
+            orders.add((
+                order_id,
+                product.pk,
+                f'user{self.rng.randrange(max(1, self.order_count // 3)):07d}@{EMAIL_DOMAIN}',
+                quantity,
+                ops.adapt_decimalfield_value(unit_price * quantity, 10, 2),
+                ops.adapt_decimalfield_value(unit_price, 10, 2),
+                status,
+                ops.adapt_datetimefield_value(created_at),
+                payment_status,
+                out_trade_no,
+                f'4200{self.seed:04d}{n:012d}' if paid_at else None,
+                f'weixin://wxpay/bizpayurl?pr=SYN{n:09d}',
+                ops.adapt_datetimefield_value(paid_at),
+                ops.adapt_datetimefield_value(created_at + expire),
+            ))
+            if paid_at:
+                # 卡密在订单之前导入
+                card_created = ops.adapt_datetimefield_value(created_at - timedelta(days=self.rng.randint(1, 30)))
+                for i in range(quantity):
+                    cards.add((product.pk, f'SYN-{order_id:09d}-{i:03d}-{self.rng.getrandbits(48):012X}',
+                               'sold', order_id, card_created))
+            if self.progress and (n + 1) % self.batch_size == 0:
+                self.progress(n + 1, cards.written)
+
+        orders.flush()
+        cards.flush()
+        return orders.written, cards.written
+
+    def _create_unsold_cards(self, products):
+        ops = self.connection.ops
+        cards = _Writer(Card, CARD_FIELDS, self.using, self.batch_size)
+        total_weight = sum(product.weight for product in products)
+        remaining = self.card_count
+        for index, product in enumerate(products):
+            if index == len(products) - 1:
+                count = remaining
+            else:
+                count = min(remaining, round(self.card_count * product.weight / total_weight))
+            remaining -= count
+            for i in range(count):
+                created_at = self.now - timedelta(days=int(self.days * self.rng.random()))
+                cards.add((product.pk, f'SYN-{product.pk:05d}-{i:09d}-{self.rng.getrandbits(48):012X}',
+                           'unsold', None, ops.adapt_datetimefield_value(created_at)))
+        cards.flush()
+        return cards.written
+
+    def _reset_sequences(self):
+        # 显式写入 ID 后，PostgreSQL 的自增序列需要同步
+        statements = self.connection.ops.sequence_reset_sql(no_style(), [Order, Card])
+        if statements:
+            with self.connection.cursor() as cursor:
+                for sql in statements:
+                    cursor.execute(sql)
+
+
+def clear_synthetic_data(using=None):
+    """删除所有合成数据，返回 (订单数, 商品数)"""
+    using = using or router.db_for_write(Order)
+    products = Product.objects.using(using).filter(slug__startswith=SLUG_PREFIX)
+    orders = Order.objects.using(using).filter(product__in=products)
+    with transaction.atomic(using=using):
+        # 卡密没有下游关联，QuerySet.delete 直接执行一条 DELETE
+        Card.objects.using(using).filter(product__in=products).delete()
+        # 订单按主键分批删除：QuerySet.delete 按外键的 on_delete 处理所有引用订单的行
+        # （OutboundSpan 置空、IdempotencyKey 级联删除），每批只加载 DELETE_BATCH_SIZE 个订单
+        order_count = 0
+        while True:
+            batch = list(orders.order_by('pk').values_list('pk', flat=True)[:DELETE_BATCH_SIZE])
+            if not batch:
+                break
+            _, deleted = Order.objects.using(using).filter(pk__in=batch).delete()
+            order_count += deleted.get(Order._meta.label, 0)
+        product_count = products.count()
+        products.delete()
+    return order_count, product_count
@@ -1,3 +1,1538 @@
-from django.test import TestCase
+"""查询预算回归测试
 
-# Create your tests here.
+每个视图、后台列表页和统计函数都有查询次数上限，并检查是否出现重复 SQL
+（参数不同、语句相同的查询通常意味着逐行查询的 N+1 问题）。
+测试数据包含多个商品、阶梯价格、较大的卡密池和已支付订单，
+如果改动导致查询次数随行数增长，这里会失败。
+"""
+import base64
+import gzip
+import hashlib
+import importlib.util
+import io
+import json
+import logging
+import os
+import re
+import tempfile
+import threading
+import time
+import uuid
+from collections import Counter
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+from unittest import mock, skipUnless
+
+from asgiref.sync import sync_to_async
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import padding, rsa
+from cryptography.x509.oid import NameOID
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connection
+from django.db.models import Count, F
+from django.http import HttpResponse
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import include, path, reverse
+from django.utils import timezone
+
+from core.db_profiles import build_database_config, build_sqlite_config, detect_pooler_mode
+from core.log import SamplingFilter
+from core.middleware import BasicAuthMiddleware
+
+from . import async_views, idempotency, metrics, tracing, views
+from .benchmarks import compare_results, registry, run_benchmark
+from .card_import import import_cards
+from .fulfillment import ALREADY_PAID, CONFLICT, FULFILLED, OUT_OF_STOCK, _allocate_cards, fulfill_order
+from .loadtest import LOADTEST_EMAIL_DOMAIN, check_consistency, count_sold_without_order, percentile
+from .models import Card, IdempotencyKey, MetricSnapshot, Order, OutboundSpan, PriceTier, Product
+from .reconciliation import PaymentReconciler
+from .stats_service import get_today_stats
+from .synthetic_data import EMAIL_DOMAIN as SYNTHETIC_EMAIL_DOMAIN, SyntheticDataGenerator, clear_synthetic_data
+from .trade_bill import TradeBillError, reconcile_trade_bill
+from .circuit_breaker import CircuitBreaker, CircuitOpenError, wechat_pay_breaker
+from .deadline import Deadline
+from .wechat_certs import PlatformKeyStore, _download_certificates
+from .wechat_pay import WeChatPayCallError, WeChatPayClient, verify_notify
+from .wechat_simulator import FaultConfig, SimulatorKeys, WeChatPaySimulator, start_simulator
+
+PRODUCT_COUNT = 4
+CARDS_PER_PRODUCT = 250
+PAID_ORDERS_PER_PRODUCT = 5
+
+# 事务控制语句不计入重复检查
+_IGNORED_SQL = re.compile(r'^\s*(SAVEPOINT|RELEASE SAVEPOINT|ROLLBACK TO SAVEPOINT|BEGIN|COMMIT)\b', re.I)
+_LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+
+
+def normalize_sql(sql):
+    """去掉字面量参数，得到语句模板"""
+    return _LITERALS.sub('?', sql)
+
+
+class QueryBudgetMixin:
+    """查询预算断言"""
+
+    @contextmanager
+    def assertQueryBudget(self, max_queries, allow_duplicates=()):
+        """断言代码块内的查询次数不超过 max_queries，且没有重复的语句模板
+
+        Args:
+            max_queries: 查询次数上限
+            allow_duplicates: 允许重复出现的语句模板片段（例如会话读写）
+        """
+        with CaptureQueriesContext(connection) as context:
+            yield context
+
+        statements = [q['sql'] for q in context.captured_queries if not _IGNORED_SQL.match(q['sql'])]
+        if len(statements) > max_queries:
+            self.fail(
+                f'查询次数 {len(statements)} 超过预算 {max_queries}:\n'
+                + '\n'.join(f'  {i}. {sql}' for i, sql in enumerate(statements, 1))
+            )
+
+        duplicates = [
+            (template, count)
+            for template, count in Counter(normalize_sql(sql) for sql in statements).items()
+            if count > 1 and not any(fragment in template for fragment in allow_duplicates)
+        ]
+        if duplicates:
+            self.fail(
+                '检测到重复 SQL（可能是 N+1 查询）:\n'
+                + '\n'.join(f'  x{count}: {template}' for template, count in duplicates)
+            )
+
+
+class ShopFixtureMixin:
+    """商品、阶梯价格、卡密池和订单测试数据"""
+
+    @classmethod
+    def setUpTestData(cls):
+        now = timezone.now()
+        cls.products = []
+        for i in range(PRODUCT_COUNT):
+            product = Product.objects.create(
+                name=f'测试商品{i}',
+                slug=f'product-{i}',
+                description='测试商品描述',
+                price=Decimal('10.00'),
+                display_order=i,
+            )
+            cls.products.append(product)
+            PriceTier.objects.bulk_create([
+                PriceTier(product=product, min_quantity=1, max_quantity=9, unit_price=Decimal('10.00'), display_order=0),
+                PriceTier(product=product, min_quantity=10, max_quantity=None, unit_price=Decimal('8.00'), display_order=1),
+            ])
+            Card.objects.bulk_create([
+                Card(product=product, content=f'CARD-{i}-{n:05d}')
+                for n in range(CARDS_PER_PRODUCT)
+            ])
+
+        # 已支付订单，每个订单分配 2 张卡密
+        cls.paid_orders = []
+        for product in cls.products:
+            for n in range(PAID_ORDERS_PER_PRODUCT):
+                order = Order.objects.create(
+                    product=product,
+                    email=f'buyer{n}@example.com',
+                    quantity=2,
+                    unit_price_used=Decimal('10.00'),
+                    total_amount=Decimal('20.00'),
+                    out_trade_no=f'ORDER_TEST_{product.pk}_{n}',
+                    transaction_id=f'4200000000{product.pk:04d}{n:04d}',
+                    payment_status='paid',
+                    status='completed',
+                    paid_at=now,
+                    expires_at=now + timedelta(minutes=30),
+                )
+                cls.paid_orders.append(order)
+                card_ids = list(
+                    Card.objects.filter(product=product, status='unsold').values_list('pk', flat=True)[:2]
+                )
+                Card.objects.filter(pk__in=card_ids).update(status='sold', order=order)
+
+        cls.unpaid_order = Order.objects.create(
+            product=cls.products[0],
+            email='pending@example.com',
+            quantity=1,
+            unit_price_used=Decimal('10.00'),
+            total_amount=Decimal('10.00'),
+            out_trade_no='ORDER_TEST_UNPAID',
+            expires_at=now + timedelta(minutes=30),
+        )
+
+        OutboundSpan.objects.bulk_create([
+            OutboundSpan(
+                service='wechat', operation='query_order', duration_ms=1500, outcome='ok',
+                order=cls.paid_orders[n], started_at=now,
+            )
+            for n in range(10)
+        ])
+
+    @classmethod
+    def create_order(cls, **overrides):
+        """创建订单，未指定的字段为第一个商品的待支付订单，金额按 10 元单价和数量计算"""
+        quantity = overrides.get('quantity', 1)
+        fields = {
+            'product': cls.products[0],
+            'email': 'buyer@example.com',
+            'quantity': quantity,
+            'unit_price_used': Decimal('10.00'),
+            'total_amount': Decimal('10.00') * quantity,
+            'out_trade_no': f'ORDER_{uuid.uuid4().hex}',
+            'expires_at': timezone.now() + timedelta(minutes=30),
+        }
+        fields.update(overrides)
+        return Order.objects.create(**fields)
+
+
+class _FakeWeChatPayClient:
+    """替代微信支付客户端：查询结果固定为支付成功"""
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def query_order(self, out_trade_no, max_retries=3, deadline=None):
+        return {'trade_state': 'SUCCESS', 'transaction_id': '4200000000TEST'}
+
+
+@override_settings(PAYMENT_TEST_MODE=True, METRICS_DB_FLUSH=False)
+@mock.patch('shop.views.send_fulfillment_notifications')
+class ViewQueryBudgetTests(ShopFixtureMixin, QueryBudgetMixin, TestCase):
+
+    def test_product_list(self, _notify):
+        with self.assertQueryBudget(1):
+            response = self.client.get(reverse('shop:product_list'))
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, '测试商品3')
+
+    def test_product_detail(self, _notify):
+        with self.assertQueryBudget(2):
+            response = self.client.get(reverse('shop:product_detail', args=[self.products[0].slug]))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['product'].stock_count(), CARDS_PER_PRODUCT - 2 * PAID_ORDERS_PER_PRODUCT)
+
+    def test_buy_product(self, notify):
+        product = self.products[1]
+        with self.assertQueryBudget(8):
+            response = self.client.post(
+                reverse('shop:buy_product', args=[product.slug]),
+                {'email': 'new@example.com', 'quantity': 10},
+            )
+        self.assertEqual(response.status_code, 302)
+        order = Order.objects.get(email='new@example.com')
+        self.assertEqual(order.payment_status, 'paid')
+        self.assertEqual(order.unit_price_used, Decimal('8.00'))
+        self.assertEqual(order.cards.count(), 10)
+        notify.assert_called_once()
+
+    def test_buy_product_idempotency_key_replays_first_order(self, notify):
+        product = self.products[1]
+        url = reverse('shop:buy_product', args=[product.slug])
+        data = {'email': 'idem@example.com', 'quantity': 2, 'idempotency_key': 'form-token-0001'}
+        first = self.client.post(url, data)
+        self.assertEqual(first.status_code, 302)
+
+        # 重复提交：一次索引查询，返回同一个订单
+        with self.assertQueryBudget(1):
+            second = self.client.post(url, data)
+        self.assertEqual(second['Location'], first['Location'])
+        self.assertEqual(Order.objects.filter(email='idem@example.com').count(), 1)
+        notify.assert_called_once()
+
+        # 同一个键换了数量
+        response = self.client.post(url, dict(data, quantity=3))
+        self.assertEqual(response.status_code, 422)
+
+        # 请求头优先于表单字段
+        response = self.client.post(url, data, HTTP_IDEMPOTENCY_KEY='header-token-0001')
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(Order.objects.filter(email='idem@example.com').count(), 2)
+
+        self.assertEqual(self.client.post(url, dict(data, idempotency_key='bad key')).status_code, 400)
+
+    @override_settings(PAYMENT_TEST_MODE=False)
+    def test_buy_product_idempotency_key_calls_wechat_once(self, _notify):
+        url = reverse('shop:buy_product', args=[self.products[2].slug])
+        data = {'email': 'idem@example.com', 'quantity': 1, 'idempotency_key': 'form-token-0002'}
+        with mock.patch('shop.views.WeChatPayClient') as client:
+            client.generate_out_trade_no = WeChatPayClient.generate_out_trade_no
+            client.return_value.create_native_order.side_effect = Exception('连接超时 timeout')
+            self.assertEqual(self.client.post(url, data).status_code, 500)
+            # 下单失败释放幂等键，同一个表单可以重新提交
+            client.return_value.create_native_order.side_effect = None
+            client.return_value.create_native_order.return_value = 'weixin://wxpay/bizpayurl?pr=idem'
+            first = self.client.post(url, data)
+            second = self.client.post(url, data)
+        self.assertEqual(second['Location'], first['Location'])
+        self.assertEqual(client.return_value.create_native_order.call_count, 2)
+        # 客户端超时（含证书模式初始化时的证书下载）不超过请求的时间预算
+        self.assertLessEqual(client.call_args.kwargs['timeout'], settings.WECHAT_PAY_DEADLINE_SECONDS)
+        order = Order.objects.filter(email='idem@example.com').latest('pk')
+        self.assertEqual(order.qr_code_url, 'weixin://wxpay/bizpayurl?pr=idem')
+
+    def test_purge_expired_idempotency_keys(self, _notify):
+        now = timezone.now()
+        order = self.paid_orders[0]
+        IdempotencyKey.objects.create(key='expired-key', request_hash='x', order=order, expires_at=now)
+        stale = IdempotencyKey.objects.create(key='stale-claim', request_hash='x', expires_at=now + timedelta(hours=1))
+        IdempotencyKey.objects.filter(pk=stale.pk).update(created_at=now - timedelta(hours=1))
+        IdempotencyKey.objects.create(key='fresh-key', request_hash='x', order=order, expires_at=now + timedelta(hours=1))
+
+        self.assertEqual(idempotency.purge_expired(force=True), 2)
+        self.assertEqual(list(IdempotencyKey.objects.values_list('key', flat=True)), ['fresh-key'])
+
+        # 支付对账定时任务每轮也清理一次
+        IdempotencyKey.objects.create(key='expired-key', request_hash='x', order=order, expires_at=now)
+        response = self.client.get(reverse('shop:reconcile_payments_cron'), HTTP_USER_AGENT='vercel-cron/1.0')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(list(IdempotencyKey.objects.values_list('key', flat=True)), ['fresh-key'])
+
+    def test_order_detail(self, _notify):
+        order = self.paid_orders[0]
+        with self.assertQueryBudget(2):
+            response = self.client.get(reverse('shop:order_detail', args=[order.pk]))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.context['cards']), 2)
+
+    def test_check_payment_status_paid(self, _notify):
+        order = self.paid_orders[0]
+        with self.assertQueryBudget(1):
+            response = self.client.get(reverse('shop:payment_status', args=[order.pk]))
+        self.assertTrue(response.json()['is_paid'])
+
+    @mock.patch('shop.views.WeChatPayClient', _FakeWeChatPayClient)
+    def test_check_payment_status_fulfills_unpaid(self, notify):
+        with self.assertQueryBudget(5):
+            response = self.client.get(reverse('shop:payment_status', args=[self.unpaid_order.pk]))
+        self.assertTrue(response.json()['is_paid'])
+        self.assertEqual(self.unpaid_order.cards.count(), 1)
+        notify.assert_called_once()
+
+
+class AdminChangelistQueryBudgetTests(ShopFixtureMixin, QueryBudgetMixin, TestCase):
+    # 每个后台请求都包含会话和用户读取 2 次查询
+    BUDGETS = {
+        'shop_product_changelist': 4,
+        'shop_card_changelist': 5,
+        'shop_order_changelist': 6,
+        'shop_outboundspan_changelist': 7,
+    }
+
+    def setUp(self):
+        user = get_user_model().objects.create_superuser('admin', 'admin@example.com', 'password')
+        self.client.force_login(user)
+
+    def test_changelists(self):
+        for url_name, budget in self.BUDGETS.items():
+            with self.subTest(url_name):
+                with self.assertQueryBudget(budget):
+                    response = self.client.get(reverse(f'admin:{url_name}'))
+                self.assertEqual(response.status_code, 200)
+
+    def test_changelists_with_filters(self):
+        cases = [
+            ('shop_card_changelist', {'product_stock': 'in_stock'}, 5),
+            ('shop_card_changelist', {'status__exact': 'sold'}, 5),
+            ('shop_order_changelist', {'payment_state': 'fulfilled'}, 6),
+            ('shop_order_changelist', {'q': 'buyer1@example.com'}, 6),
+        ]
+        for url_name, params, budget in cases:
+            with self.subTest(url_name, **params):
+                with self.assertQueryBudget(budget):
+                    response = self.client.get(reverse(f'admin:{url_name}'), params)
+                self.assertEqual(response.status_code, 200)
+
+
+@mock.patch('shop.admin.CARD_ACTION_CHUNK_SIZE', 2)
+class CardAdminActionTests(ShopFixtureMixin, TestCase):
+    """卡密批量改状态：按主键分批条件 UPDATE，不满足条件的卡密跳过"""
+
+    def setUp(self):
+        self.client.force_login(get_user_model().objects.create_superuser('admin', 'admin@example.com', 'password'))
+
+    def _run(self, action, cards):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.post(
+                reverse('admin:shop_card_changelist'),
+                {'action': action, '_selected_action': [card.pk for card in cards]},
+                follow=True,
+            )
+        updates = [q['sql'] for q in context.captured_queries if q['sql'].startswith('UPDATE "shop_card"')]
+        return [str(m) for m in response.context['messages']], updates
+
+    def _unsold(self, n):
+        return list(Card.objects.filter(product=self.products[0], status='unsold').order_by('pk')[:n])
+
+    def test_mark_as_sold_in_chunks_skips_sold_cards(self):
+        cards = self._unsold(5) + [self.paid_orders[0].cards.first()]
+        messages, updates = self._run('mark_as_sold', cards)
+
+        # 6 张卡密按每批 2 个主键分 3 批更新
+        self.assertEqual(len(updates), 3)
+        self.assertEqual(messages, ['成功将5个卡密设置为已售出。注意：这些卡密未关联订单，仅标记状态。（跳过1个已售出的卡密）'])
+        self.assertEqual(Card.objects.filter(pk__in=[c.pk for c in cards], status='sold').count(), 6)
+
+    def test_mark_as_unsold_skips_cards_with_orders(self):
+        free = self._unsold(3)
+        Card.objects.filter(pk__in=[c.pk for c in free]).update(status='sold')
+        with_order = list(self.paid_orders[0].cards.all())
+        cards = free + with_order + self._unsold(4)[3:]
+        messages, updates = self._run('mark_as_unsold', cards)
+
+        self.assertEqual(len(updates), 3)
+        self.assertEqual(messages, [
+            '成功将3个卡密设置为未售出。跳过3个未售出或已关联订单的卡密，已关联订单的卡密请在订单管理中处理。'
+        ])
+        self.assertEqual(Card.objects.filter(pk__in=[c.pk for c in free], status='unsold').count(), 3)
+        # 已关联订单的卡密保持已售出
+        self.assertEqual(Card.objects.filter(pk__in=[c.pk for c in with_order], status='sold').count(), 2)
+
+    def test_nothing_to_update_warns(self):
+        messages, _ = self._run('mark_as_unsold', list(self.paid_orders[0].cards.all()))
+        self.assertEqual(messages, ['选中的卡密中没有可改回未售出的卡密（需为已售出且未关联订单）'])
+
+
+class StatsQueryBudgetTests(ShopFixtureMixin, QueryBudgetMixin, TestCase):
+
+    @override_settings(STOCK_WARNING_THRESHOLD=CARDS_PER_PRODUCT)
+    def test_get_today_stats(self):
+        with self.assertQueryBudget(4):
+            stats = get_today_stats()
+        self.assertEqual(stats['total_orders'], PRODUCT_COUNT * PAID_ORDERS_PER_PRODUCT)
+        self.assertEqual(len(stats['product_sales']), PRODUCT_COUNT)
+        self.assertEqual(len(stats['low_stock_products']), PRODUCT_COUNT)
+
+
+@override_settings(METRICS_DB_FLUSH=False, METRICS_TOKEN='scrape-token')
+class MetricsTests(ShopFixtureMixin, TestCase):
+
+    def _count(self, histogram, labels):
+        series = histogram.values.get(labels)
+        return series[-1] if series else 0
+
+    def test_histogram_render(self):
+        histogram = metrics.Histogram('demo_seconds', '示例', ('view',), (0.1, 1))
+        histogram.observe(('a"b',), 0.5)
+        histogram.observe(('a"b',), 2)
+        self.assertEqual(histogram.render(), [
+            '# HELP demo_seconds 示例',
+            '# TYPE demo_seconds histogram',
+            'demo_seconds_bucket{view="a\\"b",le="0.1"} 0',
+            'demo_seconds_bucket{view="a\\"b",le="1"} 1',
+            'demo_seconds_bucket{view="a\\"b",le="+Inf"} 2',
+            'demo_seconds_sum{view="a\\"b"} 2.500000',
+            'demo_seconds_count{view="a\\"b"} 2',
+        ])
+
+        # 多实例快照合并
+        registry = metrics.MetricsRegistry()
+        merged = registry.histogram('demo_seconds', '示例', ('view',), (0.1, 1))
+        registry.observe(merged, ('x',), 0.05)
+        snapshot = registry.snapshot()
+        text = registry.render([snapshot, snapshot, {'unknown': []}])
+        self.assertIn('demo_seconds_count{view="x"} 2', text)
+
+    def test_middleware_records_view_metrics(self):
+        labels = ('shop:product_list', 'GET', '200')
+        before = (
+            self._count(metrics.REQUEST_DURATION, labels),
+            self._count(metrics.REQUEST_DB_QUERIES, ('shop:product_list',)),
+            self._count(metrics.RESPONSE_SIZE, ('shop:product_list',)),
+        )
+        self.client.get(reverse('shop:product_list'))
+        after = (
+            self._count(metrics.REQUEST_DURATION, labels),
+            self._count(metrics.REQUEST_DB_QUERIES, ('shop:product_list',)),
+            self._count(metrics.RESPONSE_SIZE, ('shop:product_list',)),
+        )
+        self.assertEqual([a - b for a, b in zip(after, before)], [1, 1, 1])
+        # 查询次数直方图的总和包含本次请求的查询
+        self.assertGreater(metrics.REQUEST_DB_QUERIES.values[('shop:product_list',)][-2], 0)
+
+    def test_first_request_of_fresh_process_writes_snapshot(self):
+        # 重新加载一份 shop.metrics 模拟刚启动的进程
+        spec = importlib.util.spec_from_file_location('shop._fresh_metrics', metrics.__file__)
+        fresh = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(fresh)
+        middleware = fresh.MetricsMiddleware(lambda request: HttpResponse('ok'))
+        with override_settings(METRICS_DB_FLUSH=True, METRICS_FLUSH_INTERVAL=60):
+            middleware(RequestFactory().get('/'))
+            self.assertTrue(MetricSnapshot.objects.filter(worker_id=fresh.WORKER_ID).exists())
+            # 写入间隔内的后续请求不再写入
+            self.assertFalse(fresh.flush_to_db())
+
+    def test_metrics_requires_bearer_token_or_staff(self):
+        url = reverse('shop:metrics')
+        self.assertEqual(self.client.get(url).status_code, 403)
+        # 令牌不能放在查询参数中
+        self.assertEqual(self.client.get(url, {'token': 'scrape-token'}).status_code, 403)
+        self.assertEqual(self.client.get(url, HTTP_AUTHORIZATION='Bearer wrong').status_code, 403)
+        self.assertEqual(self.client.get(url, HTTP_AUTHORIZATION='Basic scrape-token').status_code, 403)
+
+        response = self.client.get(url, HTTP_AUTHORIZATION='Bearer scrape-token')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('# TYPE shop_request_duration_seconds histogram', response.content.decode())
+
+        self.client.force_login(get_user_model().objects.create_user('staff', password='password', is_staff=True))
+        self.assertEqual(self.client.get(url).status_code, 200)
+
+
+class TracingTests(ShopFixtureMixin, TestCase):
+
+    def setUp(self):
+        self.fixture_span_ids = list(OutboundSpan.objects.values_list('pk', flat=True))
+
+    def _new_spans(self):
+        return OutboundSpan.objects.exclude(pk__in=self.fixture_span_ids)
+
+    def test_only_slow_or_failed_spans_are_persisted(self):
+        with tracing.trace_span('feishu', 'send'):
+            pass
+        self.assertFalse(self._new_spans().exists())
+
+        with override_settings(TRACING_SLOW_SPAN_MS=0):
+            with tracing.trace_span('wechat', 'query_order', attempt=2, retry_sleep=1, order_id=self.unpaid_order.pk):
+                pass
+        with self.assertRaises(ValueError):
+            with tracing.trace_span('smtp', 'send'):
+                raise ValueError('连接被拒绝')
+        with tracing.trace_span('wechat', 'close_order') as span:
+            span.status_code = 500
+
+        spans = {span.operation: span for span in self._new_spans()}
+        self.assertEqual(set(spans), {'query_order', 'send', 'close_order'})
+        slow = spans['query_order']
+        self.assertEqual((slow.outcome, slow.attempt, slow.retry_sleep_ms, slow.order_id), ('ok', 2, 1000, self.unpaid_order.pk))
+        self.assertEqual((spans['send'].outcome, spans['send'].error), ('error', '连接被拒绝'))
+        self.assertEqual((spans['close_order'].outcome, spans['close_order'].error), ('error', 'HTTP 500'))
+
+    def test_middleware_writes_request_spans_after_response(self):
+        def view(request):
+            tracing.bind_order(self.unpaid_order.pk)
+            with tracing.trace_span('wechat', 'query_order') as span:
+                span.status_code = 503
+            # 请求结束前不写数据库
+            self.assertFalse(self._new_spans().exists())
+            return HttpResponse('ok')
+
+        tracing.TracingMiddleware(view)(RequestFactory().get('/payment/status/1/'))
+
+        span = self._new_spans().get()
+        self.assertEqual(span.order_id, self.unpaid_order.pk)
+        self.assertEqual(span.request_path, '/payment/status/1/')
+        self.assertEqual(len(span.request_id), 16)
+
+    @override_settings(TRACING_SPAN_TTL=3600)
+    def test_purge_expired_spans(self):
+        now = timezone.now()
+        OutboundSpan.objects.create(
+            service='wechat', operation='query_order', duration_ms=1500, outcome='ok', started_at=now - timedelta(hours=2),
+        )
+        self.assertEqual(tracing.purge_expired(force=True), 1)
+        self.assertEqual(OutboundSpan.objects.count(), len(self.fixture_span_ids))
+        # 每个进程按间隔清理
+        self.assertEqual(tracing.purge_expired(), 0)
+
+
+class WeChatPaySimulatorMixin:
+    """每个测试类启动一个本地微信支付模拟器，用例之间重置订单、故障和熔断器状态"""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.key_dir = tempfile.TemporaryDirectory()
+        cls.simulator = WeChatPaySimulator(SimulatorKeys.load_or_create(cls.key_dir.name))
+        cls.server = start_simulator(cls.simulator)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        cls.key_dir.cleanup()
+        super().tearDownClass()
+
+    def setUp(self):
+        # 熔断器状态保存在缓存中，不能跨用例残留
+        cache.clear()
+        self.simulator.faults = FaultConfig()
+        self.simulator.orders.clear()
+        env = self.simulator.keys.env(self.server.base_url, notify_url='http://testserver/payment/notify/')
+        env.pop('PAYMENT_TEST_MODE')
+        settings_override = override_settings(PAYMENT_TEST_MODE=False, METRICS_DB_FLUSH=False, **env)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def _post_notify(self, body, headers):
+        meta = {'HTTP_' + key.upper().replace('-', '_'): value for key, value in headers.items()}
+        return self.client.post(reverse('shop:payment_notify'), body, content_type='application/json', **meta)
+
+
+class WeChatPaySimulatorTests(WeChatPaySimulatorMixin, ShopFixtureMixin, QueryBudgetMixin, TestCase):
+    """通过本地模拟器走通真实的 WeChatPayClient：请求签名、应答验签、回调解密和发货"""
+
+    @mock.patch('shop.views.send_fulfillment_notifications')
+    def test_checkout_query_and_notify(self, notify):
+        order = self.unpaid_order
+        client = WeChatPayClient()
+
+        code_url = client.create_native_order(order)
+        self.assertTrue(code_url.startswith('weixin://'))
+        # 重复下单返回同一个二维码
+        self.assertEqual(client.create_native_order(order), code_url)
+        self.assertEqual(client.query_order(order.out_trade_no)['trade_state'], 'NOTPAY')
+
+        status, paid = self.simulator.pay(order.out_trade_no, deliver=False)
+        self.assertEqual(status, 200)
+        body, headers = self.simulator.build_notify(self.simulator.orders[order.out_trade_no])
+        response = self._post_notify(body, headers)
+        self.assertEqual(response.json()['code'], 'SUCCESS')
+
+        order.refresh_from_db()
+        self.assertEqual(order.payment_status, 'paid')
+        self.assertEqual(order.transaction_id, paid['transaction_id'])
+        self.assertEqual(order.cards.count(), order.quantity)
+        notify.assert_called_once()
+
+        transaction = client.query_order(order.out_trade_no)
+        self.assertEqual(transaction['trade_state'], 'SUCCESS')
+        self.assertEqual(transaction['amount']['total'], 1000)
+
+    @override_settings(CACHES={
+        'default': {'BACKEND': 'django.core.cache.backends.db.DatabaseCache', 'LOCATION': 'shop_cache'},
+    })
+    def test_breaker_database_cache_queries(self):
+        # 缓存表由迁移创建；正常调用只读取一次熔断器状态，成功次数在进程内累计
+        wechat_pay_breaker().reset()
+        client = WeChatPayClient()
+        client.create_native_order(self.unpaid_order)
+        with self.assertQueryBudget(1):
+            self.assertEqual(client.query_order(self.unpaid_order.out_trade_no)['trade_state'], 'NOTPAY')
+        self.assertEqual(wechat_pay_breaker().counts()['calls'], 1)
+
+    def test_tampered_notify_rejected(self):
+        WeChatPayClient().create_native_order(self.unpaid_order)
+        self.simulator.pay(self.unpaid_order.out_trade_no, deliver=False)
+        body, headers = self.simulator.build_notify(self.simulator.orders[self.unpaid_order.out_trade_no])
+        response = self._post_notify(body.replace('TRANSACTION.SUCCESS', 'TRANSACTION.SUCCESS '), headers)
+        self.assertEqual(response.json()['code'], 'FAIL')
+        self.unpaid_order.refresh_from_db()
+        self.assertEqual(self.unpaid_order.payment_status, 'unpaid')
+
+    @mock.patch('shop.wechat_pay.time.sleep')
+    def test_injected_errors_exhaust_retries(self, sleep):
+        self.simulator.faults = FaultConfig(error_rate=1)
+        with self.assertRaisesMessage(Exception, 'SYSTEM_ERROR'):
+            WeChatPayClient().query_order('ORDER_NOT_CREATED', max_retries=2)
+        self.assertEqual(sleep.call_count, 1)
+
+    def test_deadline_bounds_retries(self):
+        # 模拟器挂起不响应：第一次请求用完全部预算后不再重试
+        self.simulator.faults = FaultConfig(timeout_rate=1, timeout_seconds=3)
+        with self.assertRaises(WeChatPayCallError) as raised:
+            WeChatPayClient().create_native_order(self.unpaid_order, deadline=Deadline(0.8, min_attempt=0.3))
+        self.assertEqual(raised.exception.attempts, 1)
+        self.assertLess(raised.exception.elapsed, 2)
+        self.assertIn('连接超时', str(raised.exception))
+
+    @mock.patch('shop.reconciliation.send_fulfillment_notifications')
+    def test_reconcile_fulfills_orders_with_lost_notify(self, notify):
+        orders = []
+        for n in range(3):
+            order = self.create_order(
+                product=self.products[2], email=f'reconcile{n}@example.com', quantity=2, out_trade_no=f'RECONCILE_{n}',
+                expires_at=timezone.now() + timedelta(minutes=20),
+            )
+            WeChatPayClient().create_native_order(order)
+            orders.append(order)
+        Order.objects.filter(pk__in=[o.pk for o in orders]).update(created_at=timezone.now() - timedelta(minutes=10))
+        # 两单已支付但回调丢失
+        for order in orders[:2]:
+            self.simulator.pay(order.out_trade_no, deliver=False)
+
+        result = PaymentReconciler(batch_size=2, workers=2, rate=0).run()
+        self.assertEqual((result.checked, result.fulfilled, result.not_paid, result.errors), (3, 2, 1, 0))
+        self.assertEqual(notify.call_count, 2)
+        for order in orders:
+            order.refresh_from_db()
+        self.assertEqual([o.payment_status for o in orders], ['paid', 'paid', 'unpaid'])
+        self.assertEqual(orders[0].cards.count(), 2)
+
+        # 已发货的订单不再查询
+        self.assertEqual(PaymentReconciler(rate=0).run().checked, 1)
+
+        response = self.client.get(reverse('shop:reconcile_payments_cron'))
+        self.assertEqual(response.status_code, 403)
+        response = self.client.get(reverse('shop:reconcile_payments_cron'), HTTP_USER_AGENT='vercel-cron/1.0')
+        self.assertEqual(response.json()['checked'], 1)
+
+    def test_reconcile_closes_worker_connections(self):
+        for n in range(4):
+            order = self.create_order(out_trade_no=f'RECONCILE_CLOSE_{n}', expires_at=timezone.now() + timedelta(minutes=20))
+            WeChatPayClient().create_native_order(order)
+        Order.objects.filter(out_trade_no__startswith='RECONCILE_CLOSE_').update(
+            created_at=timezone.now() - timedelta(minutes=10),
+        )
+        closed_by = []
+        with mock.patch('shop.reconciliation.connections') as connections:
+            connections.close_all.side_effect = lambda: closed_by.append(threading.current_thread().name)
+            self.assertEqual(PaymentReconciler(workers=3, rate=0).run().checked, 4)
+        # 每个工作线程各关闭一次自己的连接
+        self.assertEqual(len(set(closed_by)), 3)
+        self.assertTrue(all(name.startswith('reconcile') for name in closed_by))
+
+    @mock.patch('shop.wechat_pay.time.sleep')
+    @override_settings(WECHAT_PAY_BREAKER_MIN_CALLS=2)
+    def test_open_circuit_fails_fast(self, sleep):
+        self.simulator.faults = FaultConfig(error_rate=1)
+        with self.assertRaises(WeChatPayCallError):
+            WeChatPayClient().query_order('ORDER_NOT_CREATED', max_retries=2)
+        requests = self.simulator.snapshot()['stats']['requests']
+
+        with self.assertRaises(WeChatPayCallError) as raised:
+            WeChatPayClient().create_native_order(self.unpaid_order)
+        self.assertEqual(raised.exception.attempts, 0)
+        self.assertEqual(str(raised.exception), '支付系统连接超时，请稍后重试。')
+        self.assertEqual(self.simulator.snapshot()['stats']['requests'], requests)
+
+    @mock.patch('shop.wechat_pay.time.sleep')
+    def test_deadline_skips_backoff_that_does_not_fit(self, sleep):
+        self.simulator.faults = FaultConfig(error_rate=1)
+        clock = mock.Mock(return_value=0.0)
+        # 第一次失败后剩余 1.5 秒，不够 1 秒退避加 1 秒请求
+        deadline = Deadline(1.5, clock=clock)
+        with self.assertRaises(WeChatPayCallError) as raised:
+            WeChatPayClient().query_order('ORDER_NOT_CREATED', deadline=deadline)
+        self.assertEqual(raised.exception.attempts, 1)
+        sleep.assert_not_called()
+
+
+class AsyncPaymentURLConf:
+    """异步支付视图的路由：shop.urls 在导入时按 PAYMENT_ASYNC_VIEWS 选择视图，测试中单独配置"""
+    urlpatterns = [
+        path('', include(([
+            path('buy/<slug:slug>/', async_views.buy_product, name='buy_product'),
+            path('payment/<int:order_id>/', views.payment_page, name='payment_page'),
+            path('payment/notify/', async_views.wechat_payment_notify, name='payment_notify'),
+            path('payment/status/<int:order_id>/', async_views.check_payment_status, name='payment_status'),
+        ], 'shop'))),
+    ]
+
+
+@override_settings(ROOT_URLCONF=AsyncPaymentURLConf)
+class AsyncPaymentViewTests(WeChatPaySimulatorMixin, ShopFixtureMixin, TestCase):
+    """用 AsyncClient 通过模拟器测试异步下单、回调和长轮询"""
+
+    async def _create_native_order(self, order):
+        await sync_to_async(WeChatPayClient().create_native_order)(order)
+
+    def _requests(self):
+        return self.simulator.snapshot()['stats'].get('requests', 0)
+
+    async def test_buy_product(self):
+        url = reverse('shop:buy_product', args=[self.products[1].slug])
+        data = {'email': 'async@example.com', 'quantity': 2, 'idempotency_key': 'async-checkout-1'}
+        response = await self.async_client.post(url, data)
+
+        self.assertEqual(response.status_code, 302)
+        order = await Order.objects.aget(email='async@example.com')
+        self.assertEqual(response.url, reverse('shop:payment_page', args=[order.id]))
+        self.assertTrue(order.qr_code_url.startswith('weixin://'))
+        self.assertEqual(self.simulator.orders[order.out_trade_no].trade_state, 'NOTPAY')
+
+        # 重复提交同一个幂等键：同一个跳转，不再调用微信下单
+        requests = self._requests()
+        again = await self.async_client.post(url, data)
+        self.assertEqual(again.url, response.url)
+        self.assertEqual(self._requests(), requests)
+        self.assertEqual(await Order.objects.filter(email='async@example.com').acount(), 1)
+
+    @mock.patch('shop.async_views.send_fulfillment_notifications_async')
+    async def test_payment_notify(self, notify):
+        order = self.unpaid_order
+        await self._create_native_order(order)
+        self.simulator.pay(order.out_trade_no, deliver=False)
+        body, headers = self.simulator.build_notify(self.simulator.orders[order.out_trade_no])
+        url = reverse('shop:payment_notify')
+
+        tampered = await self.async_client.post(
+            url, body.replace('TRANSACTION.SUCCESS', 'TRANSACTION.SUCCESS '), content_type='application/json', headers=headers,
+        )
+        self.assertEqual(tampered.json()['code'], 'FAIL')
+
+        response = await self.async_client.post(url, body, content_type='application/json', headers=headers)
+        self.assertEqual(response.json(), {'code': 'SUCCESS', 'message': '成功'})
+        await order.arefresh_from_db()
+        self.assertEqual(order.payment_status, 'paid')
+        self.assertEqual(await order.cards.acount(), order.quantity)
+        notify.assert_awaited_once()
+
+        # 微信重复投递
+        replay = await self.async_client.post(url, body, content_type='application/json', headers=headers)
+        self.assertEqual(replay.json()['message'], '订单已处理')
+        notify.assert_awaited_once()
+
+    @mock.patch('shop.async_views.LONG_POLL_INTERVAL', 0.1)
+    async def test_long_poll_times_out_while_unpaid(self):
+        order = self.unpaid_order
+        await self._create_native_order(order)
+        requests = self._requests()
+
+        started = time.monotonic()
+        response = await self.async_client.get(reverse('shop:payment_status', args=[order.id]), {'wait': '0.5'})
+        elapsed = time.monotonic() - started
+
+        self.assertEqual(response.json(), {'payment_status': 'unpaid', 'is_paid': False, 'order_id': order.id})
+        self.assertGreaterEqual(elapsed, 0.5)
+        self.assertLess(elapsed, 3)
+        # 挂起期间多次主动查询
+        self.assertGreater(self._requests() - requests, 1)
+
+    @mock.patch('shop.async_views.LONG_POLL_INTERVAL', 0.1)
+    @mock.patch('shop.async_views.send_fulfillment_notifications_async')
+    async def test_long_poll_returns_when_paid(self, notify):
+        order = self.unpaid_order
+        await self._create_native_order(order)
+        # 挂起期间用户完成支付，回调丢失，由主动查询发现
+        timer = threading.Timer(0.3, self.simulator.pay, args=(order.out_trade_no,), kwargs={'deliver': False})
+        timer.start()
+        self.addCleanup(timer.cancel)
+
+        started = time.monotonic()
+        response = await self.async_client.get(reverse('shop:payment_status', args=[order.id]), {'wait': '10'})
+        elapsed = time.monotonic() - started
+
+        self.assertEqual(response.json(), {'payment_status': 'paid', 'is_paid': True, 'order_id': order.id})
+        self.assertLess(elapsed, 3)
+        self.assertEqual(await order.cards.acount(), order.quantity)
+        notify.assert_awaited_once()
+
+
+class LoadTestConsistencyTests(ShopFixtureMixin, TestCase):
+
+    def setUp(self):
+        self.since = timezone.now() - timedelta(minutes=1)
+        self.simulator = WeChatPaySimulator.__new__(WeChatPaySimulator)
+        self.simulator.orders = {}
+
+    def _loadtest_order(self, n, **fields):
+        return self.create_order(
+            email=f'lt-0-{n}@{LOADTEST_EMAIL_DOMAIN}', quantity=2, out_trade_no=f'ORDER_LT_{n}', **fields,
+        )
+
+    def test_detects_allocation_mismatch_and_lost_payment(self):
+        paid = self._loadtest_order(1, payment_status='paid', status='completed')
+        card_ids = list(Card.objects.filter(product=self.products[0], status='unsold').values_list('pk', flat=True)[:3])
+        Card.objects.filter(pk__in=card_ids).update(status='sold', order=paid)
+        lost = self._loadtest_order(2)
+        self.simulator.orders[lost.out_trade_no] = mock.Mock(trade_state='SUCCESS')
+
+        result = check_consistency(self.since, self.simulator, self.products)
+        self.assertFalse(result['passed'])
+        self.assertEqual(result['allocation_mismatch_order_ids'], [paid.pk])
+        self.assertEqual(result['lost_payments'], 1)
+
+    def test_fixture_orders_are_ignored(self):
+        result = check_consistency(self.since, self.simulator, self.products)
+        self.assertTrue(result['passed'])
+        self.assertEqual(result['orders'], {})
+
+    def test_only_new_sold_cards_without_order_of_tested_products_count(self):
+        tested = self.products[:1]
+        unsold = Card.objects.filter(status='unsold', order__isnull=True)
+        # 压测前手动标记的卡密和未参与压测的商品不计入
+        Card.objects.filter(pk=unsold.filter(product=self.products[0]).first().pk).update(status='sold')
+        Card.objects.filter(pk=unsold.filter(product=self.products[1]).first().pk).update(status='sold')
+        before = count_sold_without_order(tested)
+        self.assertTrue(check_consistency(self.since, self.simulator, tested, before)['passed'])
+
+        Card.objects.filter(pk=unsold.filter(product=self.products[0]).first().pk).update(status='sold')
+        result = check_consistency(self.since, self.simulator, tested, before)
+        self.assertFalse(result['passed'])
+        self.assertEqual(result['sold_cards_without_order'], 1)
+
+    def test_percentile(self):
+        values = sorted(range(1, 101))
+        self.assertEqual([percentile(values, q) for q in (50, 95, 99)], [50, 95, 99])
+
+
+class BenchmarkCasesSmokeTests(TestCase):
+    """每个基准用例用最小数据量跑一轮，防止用例随代码改动失效"""
+
+    def test_all_cases_run(self):
+        from .benchmarks import cases  # noqa: F401  注册用例
+
+        context = cases.BenchmarkContext(stats_orders=100, export_cards=20)
+        self.addCleanup(context.close)
+        for benchmark in registry.values():
+            with self.subTest(benchmark.name):
+                result = run_benchmark(benchmark, context, repeat=1, min_time=0)
+                self.assertGreater(result.ops_per_sec, 0)
+
+    def test_compare_flags_regressions(self):
+        baseline = {'case': {'ops_per_sec': 100.0, 'queries_per_op': 2, 'peak_kib': 100.0}}
+        rows = compare_results({'case': {'ops_per_sec': 80.0, 'queries_per_op': 3, 'peak_kib': 105.0}}, baseline)
+        self.assertEqual({metric: regressed for _, metric, _, _, _, regressed in rows},
+                         {'ops_per_sec': True, 'queries_per_op': True, 'peak_kib': False})
+
+
+class CardImportTests(TestCase):
+    """卡密导入的 ORM 路径（SQLite）和后台 Excel 导入"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.product = Product.objects.create(name='导入商品', slug='import', price=Decimal('10.00'))
+        cls.other = Product.objects.create(name='其他商品', slug='import-other', price=Decimal('10.00'))
+        Card.objects.create(product=cls.product, content='EXISTING')
+        Card.objects.create(product=cls.other, content='OTHER-ONLY')
+
+    def _contents(self):
+        return list(Card.objects.filter(product=self.product).order_by('content').values_list('content', flat=True))
+
+    def test_skips_blank_rows_and_duplicates(self):
+        result = import_cards(self.product, ['EXISTING', ' NEW-1 ', '', None, '   ', 'NEW-1', 'OTHER-ONLY', 2024])
+
+        # 空白行不计入；文件内重复和该商品已有的卡密算作跳过；其他商品的同名卡密不影响
+        self.assertEqual(result, {'total': 5, 'created': 3, 'duplicates': 2, 'method': 'orm'})
+        self.assertEqual(self._contents(), ['2024', 'EXISTING', 'NEW-1', 'OTHER-ONLY'])
+
+    @mock.patch('shop.card_import.ORM_BATCH_SIZE', 2)
+    def test_deduplicates_across_batches(self):
+        result = import_cards(self.product, ['A', 'B', 'EXISTING', 'C', 'A', 'D', 'B'])
+        self.assertEqual((result['total'], result['created'], result['duplicates']), (7, 4, 3))
+        self.assertEqual(self._contents(), ['A', 'B', 'C', 'D', 'EXISTING'])
+
+        # 再导入一次全部跳过
+        result = import_cards(self.product, ['A', 'B', 'C'])
+        self.assertEqual((result['created'], result['duplicates']), (0, 3))
+
+    def test_skips_existing_cards_on_each_path(self):
+        # COPY 路径只能在 PostgreSQL 上运行
+        methods = ['orm', 'copy'] if connection.vendor == 'postgresql' else ['orm']
+        for method in methods:
+            with self.subTest(method=method):
+                result = import_cards(self.product, ['EXISTING', f'{method}-1', f'{method}-2'], method=method)
+                self.assertEqual((result['created'], result['duplicates'], result['method']), (2, 1, method))
+                result = import_cards(self.product, [f'{method}-1', 'EXISTING'], method=method)
+                self.assertEqual((result['created'], result['duplicates']), (0, 2))
+        self.assertEqual(Card.objects.filter(product=self.product, content='EXISTING').count(), 1)
+
+    @skipUnless(connection.vendor == 'sqlite', 'EXPLAIN 输出格式按 SQLite 断言')
+    def test_existing_check_uses_product_content_index(self):
+        queryset = Card.objects.filter(product=self.product, content__in=['A', 'B']).values_list('content', flat=True)
+        self.assertIn('shop_card_product_content_idx', queryset.explain())
+
+    def test_copy_requires_postgresql(self):
+        with self.assertRaises(ValueError):
+            import_cards(self.product, ['A'], method='copy')
+
+    def test_admin_excel_import(self):
+        from openpyxl import Workbook
+
+        workbook = Workbook()
+        sheet = workbook.active
+        for value in ('卡密', 'EXCEL-1', None, 'EXISTING', 'EXCEL-2', 'EXCEL-1'):
+            sheet.append([value])
+        buffer = io.BytesIO()
+        workbook.save(buffer)
+        upload = SimpleUploadedFile('cards.xlsx', buffer.getvalue())
+
+        self.client.force_login(get_user_model().objects.create_superuser('admin', 'admin@example.com', 'password'))
+        response = self.client.post(
+            reverse('admin:card_import_excel'), {'product': self.product.pk, 'excel_file': upload}, follow=True,
+        )
+        self.assertEqual(
+            [str(m) for m in response.context['messages']],
+            ['成功导入 2 个卡密到商品「导入商品」，跳过 2 个重复卡密'],
+        )
+        self.assertEqual(self._contents(), ['EXCEL-1', 'EXCEL-2', 'EXISTING'])
+
+
+class SyntheticDataTests(TestCase):
+
+    def _generate(self, end_date=date(2026, 1, 31)):
+        return SyntheticDataGenerator(
+            products=3, cards=50, orders=300, months=2, seed=1, end_date=end_date, batch_size=64,
+        ).generate()
+
+    def _digest(self):
+        return list(
+            Order.objects.filter(email__endswith='@' + SYNTHETIC_EMAIL_DOMAIN)
+            .order_by('out_trade_no')
+            .values_list('out_trade_no', 'product__slug', 'quantity', 'total_amount', 'payment_status',
+                         'created_at', 'paid_at')
+        )
+
+    def test_reproducible_and_consistent(self):
+        result = self._generate()
+        self.assertEqual(result['orders'], 300)
+        self.assertEqual(result['unsold_cards'], 50)
+        first = self._digest()
+
+        # 已支付订单的卡密数量等于购买数量，未支付订单没有卡密
+        paid = Order.objects.filter(payment_status__in=('paid', 'refunded')).annotate(n=Count('cards'))
+        self.assertTrue(paid.exists())
+        self.assertFalse(paid.exclude(n=F('quantity')).exists())
+        self.assertFalse(Order.objects.filter(payment_status__in=('unpaid', 'expired'), cards__isnull=False).exists())
+        self.assertEqual(Card.objects.filter(status='sold').count(), result['sold_cards'])
+
+        with self.assertRaises(ValueError):
+            self._generate()
+
+        self.assertEqual(clear_synthetic_data(), (300, 3))
+        self._generate()
+        self.assertEqual(self._digest(), first)
+
+    def test_end_date_today_is_reproducible(self):
+        today = timezone.localdate()
+        self._generate(today)
+        first = self._digest()
+        # 订单时间不超过截止日期当天结束
+        day_end = timezone.make_aware(datetime.combine(today + timedelta(days=1), datetime.min.time()))
+        self.assertLessEqual(max(row[5] for row in first), day_end)
+
+        clear_synthetic_data()
+        with mock.patch('django.utils.timezone.now', return_value=timezone.now() + timedelta(hours=5)):
+            self._generate(today)
+        self.assertEqual(self._digest(), first)
+
+    @mock.patch('shop.synthetic_data.DELETE_BATCH_SIZE', 70)
+    def test_clear_handles_order_references(self):
+        self._generate()
+        order = Order.objects.filter(email__endswith='@' + SYNTHETIC_EMAIL_DOMAIN).first()
+        IdempotencyKey.objects.create(
+            key='synthetic-key', request_hash='x', order=order, expires_at=timezone.now() + timedelta(days=1),
+        )
+        span = OutboundSpan.objects.create(
+            service='wechat', operation='query_order', duration_ms=1, outcome='ok', started_at=timezone.now(), order=order,
+        )
+        # 分多批删除，引用订单的行按外键的 on_delete 处理
+        self.assertEqual(clear_synthetic_data(), (300, 3))
+        self.assertFalse(IdempotencyKey.objects.exists())
+        span.refresh_from_db()
+        self.assertIsNone(span.order_id)
+
+
+class DatabaseProfileTests(SimpleTestCase):
+    DIRECT_URL = 'postgresql://u:p@db.example.supabase.co:5432/postgres'
+    POOLER_URL = 'postgresql://u:p@pooler.example.supabase.com:6543/postgres'
+
+    def test_detect_pooler_mode(self):
+        self.assertEqual(detect_pooler_mode(self.POOLER_URL, environ={}), 'transaction')
+        self.assertEqual(detect_pooler_mode(self.DIRECT_URL, environ={}), 'none')
+        self.assertEqual(detect_pooler_mode(self.POOLER_URL, environ={'DB_POOLER_MODE': 'Session'}), 'session')
+        with self.assertRaises(ImproperlyConfigured):
+            detect_pooler_mode(self.DIRECT_URL, environ={'DB_POOLER_MODE': 'pgbouncer'})
+
+    def test_server_side_cursors_disabled_unless_direct_connection_declared(self):
+        # 按端口推断不出 pooler 时也默认禁用
+        self.assertTrue(build_database_config(self.DIRECT_URL, environ={})['DISABLE_SERVER_SIDE_CURSORS'])
+        self.assertTrue(build_database_config(self.POOLER_URL, environ={})['DISABLE_SERVER_SIDE_CURSORS'])
+        self.assertTrue(build_database_config(
+            self.DIRECT_URL, environ={'DB_POOLER_MODE': 'session'}
+        )['DISABLE_SERVER_SIDE_CURSORS'])
+        self.assertFalse(build_database_config(
+            self.DIRECT_URL, environ={'DB_POOLER_MODE': 'none'}
+        )['DISABLE_SERVER_SIDE_CURSORS'])
+        self.assertFalse(build_database_config(
+            self.DIRECT_URL, environ={'DB_DISABLE_SERVER_SIDE_CURSORS': 'false'}
+        )['DISABLE_SERVER_SIDE_CURSORS'])
+
+    def test_transaction_pooler_rejects_server_side_cursors(self):
+        with self.assertRaises(ImproperlyConfigured):
+            build_database_config(self.POOLER_URL, environ={'DB_DISABLE_SERVER_SIDE_CURSORS': 'false'})
+
+    def test_profiles(self):
+        serverless = build_database_config(self.DIRECT_URL, environ={})
+        self.assertEqual(serverless['CONN_MAX_AGE'], 0)
+        self.assertEqual(serverless['OPTIONS']['sslmode'], 'require')
+        self.assertEqual(serverless['OPTIONS']['connect_timeout'], 10)
+
+        persistent = build_database_config(
+            self.DIRECT_URL + '?sslmode=disable', environ={'DB_PROFILE': 'persistent', 'DB_CONN_MAX_AGE': '60'}
+        )
+        self.assertEqual(persistent['CONN_MAX_AGE'], 60)
+        self.assertTrue(persistent['CONN_HEALTH_CHECKS'])
+        self.assertEqual(persistent['OPTIONS']['sslmode'], 'disable')
+
+        pooled = build_database_config(self.DIRECT_URL, environ={'DB_PROFILE': 'pooled', 'DB_POOL_MAX_SIZE': '4'})
+        self.assertEqual(pooled['CONN_MAX_AGE'], 0)
+        self.assertEqual(pooled['OPTIONS']['pool'], {'min_size': 2, 'max_size': 4, 'timeout': 10})
+
+        for environ in ({'DB_PROFILE': 'sticky'}, {'DB_PROFILE': 'pooled', 'DB_POOL_MIN_SIZE': '5', 'DB_POOL_MAX_SIZE': '2'},
+                        {'DB_CONNECT_TIMEOUT': 'soon'}):
+            with self.subTest(environ=environ), self.assertRaises(ImproperlyConfigured):
+                build_database_config(self.DIRECT_URL, environ=environ)
+
+    def test_sqlite_pragmas_are_validated(self):
+        config = build_sqlite_config('/tmp/shop.sqlite3', environ={'SQLITE_JOURNAL_MODE': 'truncate', 'SQLITE_SYNCHRONOUS': 'full'})
+        self.assertIn('PRAGMA journal_mode=TRUNCATE', config['OPTIONS']['init_command'])
+        self.assertIn('PRAGMA synchronous=FULL', config['OPTIONS']['init_command'])
+
+        for environ in ({'SQLITE_SYNCHRONOUS': 'sometimes'}, {'SQLITE_JOURNAL_MODE': 'WAL; PRAGMA foreign_keys=OFF'},
+                        {'SQLITE_JOURNAL_MODE': 'WAL2'}):
+            with self.subTest(environ=environ), self.assertRaises(ImproperlyConfigured):
+                build_sqlite_config('/tmp/shop.sqlite3', environ=environ)
+
+
+class SamplingFilterTests(SimpleTestCase):
+
+    def _record(self, name, level):
+        return logging.LogRecord(name, level, __file__, 0, 'msg', (), None)
+
+    def test_samples_only_below_warning(self):
+        sampler = SamplingFilter('shop.poll=0,shop.poll.fast=1')
+        self.assertFalse(sampler.filter(self._record('shop.poll', logging.INFO)))
+        self.assertFalse(sampler.filter(self._record('shop.poll.child', logging.DEBUG)))
+        self.assertTrue(sampler.filter(self._record('shop.poll.fast', logging.INFO)))
+        self.assertTrue(sampler.filter(self._record('shop.views', logging.INFO)))
+        for level in (logging.WARNING, logging.ERROR):
+            self.assertTrue(sampler.filter(self._record('shop.poll', level)))
+
+
+class BasicAuthMiddlewareTests(SimpleTestCase):
+    ENV = {
+        'BASIC_AUTH_ENABLED': 'True', 'BASIC_AUTH_USERNAME': 'shop', 'BASIC_AUTH_PASSWORD': 's3cret',
+        'BASIC_AUTH_EXCLUDE_PATHS': '/health/',
+    }
+
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.middleware = self._middleware()
+
+    def _middleware(self):
+        with mock.patch.dict(os.environ, self.ENV):
+            return BasicAuthMiddleware(lambda request: HttpResponse('ok'))
+
+    def _get(self, path='/', password=None, cookie=None, middleware=None):
+        extra = {}
+        if password is not None:
+            extra['HTTP_AUTHORIZATION'] = 'Basic ' + base64.b64encode(f'shop:{password}'.encode()).decode()
+        request = self.factory.get(path, **extra)
+        if cookie is not None:
+            request.COOKIES[BasicAuthMiddleware.COOKIE_NAME] = cookie
+        return (middleware or self.middleware)(request)
+
+    def _login_cookie(self):
+        return self._get(password='s3cret').cookies[BasicAuthMiddleware.COOKIE_NAME].value
+
+    def test_authorization_header(self):
+        response = self._get(password='s3cret')
+        self.assertEqual(response.status_code, 200)
+        cookie = response.cookies[BasicAuthMiddleware.COOKIE_NAME]
+        self.assertTrue(cookie['httponly'])
+        # Cookie 可读，不能包含不带密钥的凭证哈希
+        self.assertNotIn(hashlib.sha256(b'shop:s3cret').hexdigest()[:16], cookie.value)
+        # 认证方式不区分大小写
+        request = self.factory.get('/', HTTP_AUTHORIZATION='basic ' + base64.b64encode(b'shop:s3cret').decode())
+        self.assertEqual(self.middleware(request).status_code, 200)
+
+    def test_wrong_password(self):
+        for password in ('wrong', None):
+            with self.subTest(password=password):
+                response = self._get(password=password)
+                self.assertEqual(response.status_code, 401)
+                self.assertEqual(response['WWW-Authenticate'], 'Basic realm="Protected Area"')
+                self.assertNotIn(BasicAuthMiddleware.COOKIE_NAME, response.cookies)
+
+    def test_cookie_fast_path(self):
+        cookie = self._login_cookie()
+        response = self._get('/static/app.css', cookie=cookie)
+        self.assertEqual(response.status_code, 200)
+        # Cookie 有效时直接放行：不比较 Authorization 头，也不重新下发
+        with mock.patch.object(self.middleware, '_check_authorization') as check_authorization:
+            self.assertNotIn(BasicAuthMiddleware.COOKIE_NAME, self._get(password='s3cret', cookie=cookie).cookies)
+        check_authorization.assert_not_called()
+        # Cookie 失效但 Authorization 头正确时重新下发
+        response = self._get(password='s3cret', cookie=cookie + 'x')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(BasicAuthMiddleware.COOKIE_NAME, response.cookies)
+
+    def test_expired_or_tampered_cookie(self):
+        cookie = self._login_cookie()
+        self.assertEqual(self._get(cookie=cookie + 'x').status_code, 401)
+        value, timestamp, signature = cookie.split(':')
+        self.assertEqual(self._get(cookie=f'{value[::-1]}:{timestamp}:{signature}').status_code, 401)
+        with mock.patch('django.core.signing.time.time', return_value=time.time() + 43200 + 1):
+            self.assertEqual(self._get(cookie=cookie).status_code, 401)
+        # 更换 SECRET_KEY 后旧 Cookie 失效
+        with override_settings(SECRET_KEY='another-secret-key'):
+            self.assertEqual(self._get(cookie=cookie, middleware=self._middleware()).status_code, 401)
+
+    def test_excluded_paths(self):
+        for path in ('/payment/notify/', '/api/cron/reconcile-payments/', '/health/live'):
+            with self.subTest(path=path):
+                self.assertEqual(self._get(path).status_code, 200)
+        self.assertEqual(self._get('/admin/').status_code, 401)
+
+
+class CardAllocationTests(ShopFixtureMixin, TestCase):
+
+    def test_sqlite_config(self):
+        config = build_sqlite_config('/tmp/shop.sqlite3', environ={'SQLITE_BUSY_TIMEOUT': '5'})
+        self.assertEqual(config['OPTIONS']['transaction_mode'], 'IMMEDIATE')
+        self.assertEqual(config['OPTIONS']['timeout'], 5)
+        self.assertIn('PRAGMA journal_mode=WAL', config['OPTIONS']['init_command'])
+        self.assertIn('PRAGMA synchronous=NORMAL', config['OPTIONS']['init_command'])
+
+    def _stale_selection(self, order):
+        """模拟读取候选卡密之后、更新之前，另一个事务售出了其中一张"""
+        candidates = list(Card.objects.filter(product=order.product, status='unsold')[:3])
+        Card.objects.filter(pk=candidates[0].pk).update(status='sold')
+        queryset = mock.MagicMock()
+        queryset.filter.return_value.__getitem__.return_value = candidates
+        return candidates, queryset
+
+    def test_cards_sold_concurrently_are_not_reallocated(self):
+        order = self.create_order(quantity=3)
+        candidates, queryset = self._stale_selection(order)
+        with mock.patch('shop.fulfillment.Card.objects.select_for_update', return_value=queryset):
+            _, cards, result = fulfill_order({'pk': order.pk}, transaction_id='T1', cancel_on_shortage=True)
+
+        # 重新选择后仍然冲突：不是缺货，不能取消订单
+        self.assertEqual(result, CONFLICT)
+        self.assertEqual(cards, [])
+        self.assertEqual(queryset.filter.call_count, 2)
+        # 冲突时整批回滚，订单保持未支付，其余两张卡密仍可售
+        self.assertFalse(Card.objects.filter(order=order).exists())
+        self.assertEqual(Card.objects.filter(pk__in=[c.pk for c in candidates[1:]], status='unsold').count(), 2)
+        order.refresh_from_db()
+        self.assertEqual(order.payment_status, 'unpaid')
+
+        _, cards, result = fulfill_order({'pk': order.pk}, transaction_id='T1')
+        self.assertEqual(result, FULFILLED)
+        self.assertEqual(Card.objects.filter(order=order, status='sold').count(), 3)
+
+    def test_conflict_retries_selection_once(self):
+        order = self.create_order(quantity=3)
+        candidates, queryset = self._stale_selection(order)
+        select_for_update = Card.objects.select_for_update
+        selections = iter([queryset])
+
+        with mock.patch(
+            'shop.fulfillment.Card.objects.select_for_update',
+            side_effect=lambda **kwargs: next(selections, None) or select_for_update(**kwargs),
+        ):
+            _, cards, result = fulfill_order({'pk': order.pk}, transaction_id='T1', cancel_on_shortage=True)
+
+        self.assertEqual(result, FULFILLED)
+        self.assertEqual(len(cards), 3)
+        self.assertNotIn(candidates[0].pk, [card.pk for card in cards])
+        order.refresh_from_db()
+        self.assertEqual((order.payment_status, order.status), ('paid', 'completed'))
+
+
+class OrderStateTransitionTests(ShopFixtureMixin, TestCase):
+
+    def test_duplicate_fulfillment_is_noop(self):
+        order = self.create_order(quantity=2)
+        self.assertEqual(fulfill_order({'pk': order.pk}, transaction_id='T1')[2], FULFILLED)
+        with CaptureQueriesContext(connection) as queries:
+            _, cards, result = fulfill_order({'pk': order.pk}, transaction_id='T2')
+        self.assertEqual(result, ALREADY_PAID)
+        self.assertEqual(cards, [])
+        self.assertEqual(len(queries), 1)
+        order.refresh_from_db()
+        self.assertEqual((order.transaction_id, order.status), ('T1', 'completed'))
+
+    def test_losing_concurrent_fulfillment_releases_cards(self):
+        order = self.create_order(quantity=2)
+
+        def paid_elsewhere(order):
+            # 模拟读取订单之后，另一个请求抢先完成了支付
+            Order.objects.filter(pk=order.pk).update(payment_status='paid', transaction_id='WINNER')
+            return _allocate_cards(order)
+
+        with mock.patch('shop.fulfillment._allocate_cards', side_effect=paid_elsewhere):
+            order, cards, result = fulfill_order({'pk': order.pk}, transaction_id='LOSER')
+
+        self.assertEqual(result, ALREADY_PAID)
+        self.assertEqual(cards, [])
+        # 模拟的“另一个请求”与本次分配处于同一事务，随之回滚；这里只检查本次没有写入
+        self.assertNotEqual(order.transaction_id, 'LOSER')
+        self.assertFalse(Card.objects.filter(order=order).exists())
+
+    def test_expired_page_does_not_override_payment(self):
+        order = self.create_order(quantity=2, expires_at=timezone.now() - timedelta(minutes=1))
+        self.assertEqual(fulfill_order({'pk': order.pk}, transaction_id='T1')[2], FULFILLED)
+        stale = Order.objects.get(pk=order.pk)
+        stale.payment_status = 'unpaid'
+        with mock.patch('shop.views.get_object_or_404', return_value=stale):
+            response = self.client.get(reverse('shop:payment_page', args=[order.pk]))
+        self.assertRedirects(response, reverse('shop:order_detail', args=[order.pk]))
+        order.refresh_from_db()
+        self.assertEqual(order.payment_status, 'paid')
+
+        unpaid = self.create_order(quantity=2, expires_at=timezone.now() - timedelta(minutes=1))
+        self.client.get(reverse('shop:payment_page', args=[unpaid.pk]))
+        unpaid.refresh_from_db()
+        self.assertEqual(unpaid.payment_status, 'expired')
+
+
+class CircuitBreakerTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.now = 1_000_000.0
+        self.breaker = CircuitBreaker(
+            'test', failure_rate=0.5, slow_call_seconds=2, slow_call_rate=0.5, min_calls=4,
+            window_seconds=60, open_seconds=30, clock=lambda: self.now,
+        )
+        self.breaker.reset()
+
+    def test_opens_on_failure_rate_and_probes_half_open(self):
+        for success in (True, True, False):
+            self.breaker.record(success, 0.1)
+        self.assertEqual(self.breaker.state(), 'closed')
+        self.breaker.record(False, 0.1)
+        self.assertEqual(self.breaker.state(), 'open')
+        with self.assertRaises(CircuitOpenError):
+            self.breaker.before_call()
+
+        # 半开：只放行一个探测请求，探测失败重新打开
+        self.now += 31
+        self.breaker.before_call()
+        with self.assertRaises(CircuitOpenError):
+            self.breaker.before_call()
+        self.breaker.record(False, 0.1)
+        self.assertEqual(self.breaker.state(), 'open')
+
+        # 探测成功后关闭并清空统计
+        self.now += 31
+        self.breaker.before_call()
+        self.breaker.record(True, 0.1)
+        self.assertEqual(self.breaker.state(), 'closed')
+        self.assertEqual(self.breaker.counts()['calls'], 0)
+
+    def test_slow_calls_open_circuit(self):
+        for duration in (0.1, 0.1, 2.5, 2.5):
+            self.breaker.record(True, duration)
+        self.assertEqual(self.breaker.state(), 'open')
+
+    @override_settings(WECHAT_PAY_BREAKER_FAILURE_RATE=0.5, WECHAT_PAY_BREAKER_SLOW_CALL_RATE=0.9,
+                       WECHAT_PAY_BREAKER_SLOW_CALL_SECONDS=2, WECHAT_PAY_BREAKER_MIN_CALLS=4)
+    def test_slow_call_rate_configured_separately(self):
+        breaker = wechat_pay_breaker()
+        breaker.clock = lambda: self.now
+        breaker.reset()
+        self.assertEqual((breaker.failure_rate, breaker.slow_call_rate), (0.5, 0.9))
+        # 慢调用率 50% 未达到 0.9，不打开
+        for duration in (0.1, 0.1, 2.5, 2.5):
+            breaker.record(True, duration)
+        self.assertEqual(breaker.state(), 'closed')
+        for _ in range(16):
+            breaker.record(True, 2.5)
+        self.assertEqual(breaker.state(), 'open')
+
+    def test_successes_flushed_in_batches(self):
+        for _ in range(3):
+            self.breaker.record(True, 0.1)
+        # 第一次成功立即写入，其余在进程内累计
+        self.assertEqual(self.breaker.counts()['calls'], 1)
+        self.now += 10
+        self.breaker.record(True, 0.1)
+        self.assertEqual(self.breaker.counts()['calls'], 4)
+        # 失败调用先写入累计的成功次数
+        self.breaker.record(True, 0.1)
+        self.breaker.record(False, 0.1)
+        self.assertEqual(self.breaker.counts(), {'calls': 6, 'failures': 1, 'slow': 0})
+
+    def test_old_windows_expire(self):
+        for _ in range(3):
+            self.breaker.record(False, 0.1)
+        self.now += 120
+        self.breaker.record(False, 0.1)
+        self.assertEqual(self.breaker.state(), 'closed')
+
+
+class TradeBillReconcileTests(ShopFixtureMixin, TestCase):
+    """按本地账单样例（shop/testdata）对账，不访问网络"""
+
+    BILL_DATE = date(2026, 1, 10)
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        paid_at = timezone.make_aware(datetime(2026, 1, 10, 12, 0))
+
+        def order(out_trade_no, transaction_id=None, amount='20.00', payment_status='paid', status='completed'):
+            return cls.create_order(
+                email='bill@example.com', total_amount=Decimal(amount), out_trade_no=out_trade_no,
+                transaction_id=transaction_id, payment_status=payment_status, status=status,
+                paid_at=paid_at if payment_status != 'unpaid' else None,
+            )
+
+        order('ORDER_BILL_OK', '4200000001202601100001')
+        order('ORDER_BILL_REFUNDED', '4200000001202601100002', '10.00', payment_status='refunded')
+        # 库存不足取消后已退款：不算未发货
+        order('ORDER_BILL_REFUND_CANCELLED', '4200000001202601100008', '10.00', payment_status='refunded', status='cancelled')
+        cls.amount_order = order('ORDER_BILL_AMOUNT', '4200000001202601100003')
+        cls.unfulfilled_order = order('ORDER_BILL_UNFULFILLED', amount='10.00', payment_status='unpaid', status='pending')
+        cls.transaction_order = order('ORDER_BILL_TRANSACTION', '4200000001202601109999')
+        cls.local_only_order = order('ORDER_BILL_LOCAL_ONLY', '4200000001202601100007')
+        # 测试模式支付的订单不在微信账单里，不算差异
+        order('ORDER_BILL_TEST_MODE', 'TEST_ORDER_BILL_TEST_MODE')
+
+    def setUp(self):
+        with open(os.path.join(os.path.dirname(__file__), 'testdata', 'tradebill_20260110.csv'), 'rb') as f:
+            self.content = f.read()
+
+    def test_reports_differences(self):
+        report = reconcile_trade_bill(self.BILL_DATE, self.content)
+
+        self.assertEqual((report.rows, report.payments, report.refunds), (9, 7, 2))
+        self.assertEqual([item['out_trade_no'] for item in report.missing_orders], ['ORDER_BILL_MISSING'])
+        self.assertEqual(report.missing_orders[0]['transaction_id'], '4200000001202601100005')
+        self.assertEqual([item['order_id'] for item in report.unfulfilled], [self.unfulfilled_order.pk])
+        self.assertEqual([item['order_id'] for item in report.amount_mismatch], [self.amount_order.pk])
+        self.assertEqual(Decimal(report.amount_mismatch[0]['bill_amount']), Decimal('15.00'))
+        self.assertEqual([item['order_id'] for item in report.transaction_mismatch], [self.transaction_order.pk])
+        self.assertEqual([item['order_id'] for item in report.missing_in_bill], [self.local_only_order.pk])
+        self.assertEqual(report.issue_count, 5)
+
+    def test_gzip_bill_with_hash(self):
+        digest = hashlib.sha1(self.content).hexdigest()
+        report = reconcile_trade_bill(self.BILL_DATE, gzip.compress(self.content), 'SHA1', digest)
+        self.assertEqual(report.rows, 9)
+
+        with self.assertRaises(TradeBillError):
+            reconcile_trade_bill(self.BILL_DATE, gzip.compress(self.content), 'SHA1', '0' * 40)
+
+    def test_truncated_bill_is_rejected(self):
+        truncated = self.content[:self.content.index('总交易单数'.encode())]
+        with self.assertRaises(TradeBillError):
+            reconcile_trade_bill(self.BILL_DATE, truncated)
+
+    def test_command_exits_non_zero_on_differences(self):
+        path = os.path.join(os.path.dirname(__file__), 'testdata', 'tradebill_20260110.csv')
+        out = io.StringIO()
+        with self.assertRaisesMessage(CommandError, '5 处差异'):
+            call_command('reconcile_trade_bill', date=self.BILL_DATE, file=path, stdout=out)
+        self.assertIn('ORDER_BILL_MISSING', out.getvalue())
+
+
+class PlatformKeyStoreTests(TestCase):
+    """回调验签使用进程内缓存的平台公钥，不构造支付客户端"""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.key_dir = tempfile.TemporaryDirectory()
+        cls.keys = SimulatorKeys.load_or_create(cls.key_dir.name)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.key_dir.cleanup()
+        super().tearDownClass()
+
+    def setUp(self):
+        cache.clear()
+
+    def _notify(self, sign=None, serial=None):
+        body = json.dumps({
+            'id': str(uuid.uuid4()),
+            'resource_type': 'encrypt-resource',
+            'event_type': 'TRANSACTION.SUCCESS',
+            'resource': self.keys.encrypt_resource(json.dumps({'out_trade_no': 'ORDER_1', 'trade_state': 'SUCCESS'})),
+        })
+        headers = self.keys.signed_headers(body)
+        if sign is not None:
+            headers['Wechatpay-Signature'] = sign(f"{headers['Wechatpay-Timestamp']}\n{headers['Wechatpay-Nonce']}\n{body}\n")
+        if serial is not None:
+            headers['Wechatpay-Serial'] = serial
+        return headers, body.encode()
+
+    def _certificate(self, days=30):
+        """自签名平台证书，返回 (PEM, 序列号, 签名函数)"""
+        key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, 'WeChat Pay Platform')])
+        now = timezone.now()
+        cert = (
+            x509.CertificateBuilder().subject_name(name).issuer_name(name).public_key(key.public_key())
+            .serial_number(x509.random_serial_number())
+            .not_valid_before(now - timedelta(days=1)).not_valid_after(now + timedelta(days=days))
+            .sign(key, hashes.SHA256())
+        )
+
+        def sign(message):
+            return base64.b64encode(key.sign(message.encode(), padding.PKCS1v15(), hashes.SHA256())).decode()
+
+        return cert.public_bytes(serialization.Encoding.PEM).decode(), format(cert.serial_number, 'X'), sign
+
+    @mock.patch('shop.wechat_pay.WeChatPayClient', side_effect=AssertionError('不应构造支付客户端'))
+    def test_public_key_mode_verifies_in_memory(self, client):
+        env = self.keys.env('http://127.0.0.1:1')
+        with override_settings(**env):
+            headers, body = self._notify()
+            result = verify_notify(headers, body)
+            self.assertEqual(result['resource']['out_trade_no'], 'ORDER_1')
+            # request.META 形式的请求头同样可用
+            meta = {'HTTP_' + key.upper().replace('-', '_'): value for key, value in headers.items()}
+            self.assertIsNotNone(verify_notify(meta, body))
+
+            self.assertIsNone(verify_notify(headers, body.replace(b'TRANSACTION.SUCCESS', b'TRANSACTION.CLOSED')))
+            self.assertIsNone(verify_notify(dict(headers, **{'Wechatpay-Serial': 'PUB_KEY_ID_OTHER'}), body))
+        client.assert_not_called()
+
+    def test_certificate_mode_downloads_once_and_caches(self):
+        pem, serial, sign = self._certificate()
+        downloads = []
+
+        def downloader():
+            downloads.append(1)
+            return [pem]
+
+        env = self.keys.env('http://127.0.0.1:1')
+        env.update(WECHAT_PLATFORM_CERT='', WECHAT_PLATFORM_CERT_SERIAL_NO='')
+        with override_settings(**env):
+            store = PlatformKeyStore(downloader=downloader)
+            for _ in range(3):
+                self.assertEqual(store.callback(*self._notify(sign=sign, serial=serial.lower()))['resource']['trade_state'], 'SUCCESS')
+            self.assertEqual(len(downloads), 1)
+
+            # 冷启动的新实例从缓存加载证书，不重新下载
+            cold = PlatformKeyStore(downloader=downloader)
+            self.assertIsNotNone(cold.callback(*self._notify(sign=sign, serial=serial)))
+            self.assertEqual(len(downloads), 1)
+
+            # 未知序列号同步刷新一次，短时间内不重复
+            for _ in range(3):
+                self.assertIsNone(cold.callback(*self._notify(sign=sign, serial='ABCDEF')))
+            self.assertEqual(len(downloads), 2)
+
+    def test_download_certificates_requests_once(self):
+        pem, serial, _ = self._certificate()
+        payload = json.dumps({'data': [{
+            'serial_no': serial,
+            'effective_time': '2026-01-01T00:00:00+08:00',
+            'expire_time': '2031-01-01T00:00:00+08:00',
+            'encrypt_certificate': self.keys.encrypt_resource(pem, associated_data='certificate'),
+        }]})
+        env = self.keys.env('http://127.0.0.1:1')
+        env.update(WECHAT_PLATFORM_CERT='', WECHAT_PLATFORM_CERT_SERIAL_NO='')
+        with override_settings(**env), \
+                mock.patch('wechatpayv3.core.Core.request', autospec=True, return_value=(200, payload)) as request:
+            self.assertEqual(_download_certificates(), [pem])
+        # 构造时不加载证书，只请求一次，发往配置的 API 地址
+        request.assert_called_once()
+        self.assertEqual(request.call_args.args[0]._gate_way, 'http://127.0.0.1:1')
+
+    def test_expiring_certificate_refreshes_in_background(self):
+        pem, serial, sign = self._certificate(days=1)
+        env = self.keys.env('http://127.0.0.1:1')
+        env.update(WECHAT_PLATFORM_CERT='', WECHAT_PLATFORM_CERT_SERIAL_NO='')
+        with override_settings(**env):
+            store = PlatformKeyStore(downloader=lambda: [pem])
+            store._ensure_loaded()
+            store._last_refresh -= 2 * 3600
+            with mock.patch.object(store, 'refresh_in_background') as refresh:
+                self.assertIsNotNone(store.callback(*self._notify(sign=sign, serial=serial)))
+            refresh.assert_called_once()
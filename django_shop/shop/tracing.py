@@ -0,0 +1,220 @@
+"""外部依赖调用追踪
+
+每次调用微信支付、SMTP、飞书都记录为一个 span：耗时、第几次尝试、重试前的等待时间、结果。
+span 归属于当前请求（TracingMiddleware 绑定）和当前订单（bind_order 绑定），
+耗时超过 TRACING_SLOW_SPAN_MS 或失败的 span 写入 OutboundSpan 表，可在后台按依赖查询尾延迟。
+超过 TRACING_SPAN_TTL 的记录在写入时顺带清理，每个进程每 PURGE_INTERVAL 秒最多一次。
+
+用法：
+    with trace_span('wechat', 'query_order', attempt=2, retry_sleep=1) as span:
+        code, message = wxpay.query(out_trade_no=...)
+        span.status_code = code
+"""
+import contextvars
+import logging
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import timedelta
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.utils import timezone
+
+from .metrics import OUTBOUND_DURATION, registry
+from .models import OutboundSpan
+
+logger = logging.getLogger(__name__)
+
+OK = 'ok'
+ERROR = 'error'
+TIMEOUT = 'timeout'
+
+# 每个进程清理过期 span 的最小间隔（秒）
+PURGE_INTERVAL = 3600
+
+_last_purge = 0.0
+_purge_lock = threading.Lock()
+
+
+class TraceContext:
+    """当前请求的追踪上下文，收集本请求内产生的慢 span，请求结束时批量写入"""
+
+    def __init__(self, request_id='', request_path=''):
+        self.request_id = request_id
+        self.request_path = request_path
+        self.order_id = None
+        self.pending = []
+
+
+_current = contextvars.ContextVar('shop_trace_context', default=None)
+
+
+def bind_order(order_id):
+    """把当前请求后续的 span 关联到订单"""
+    context = _current.get()
+    if context is not None:
+        context.order_id = order_id
+
+
+class Span:
+    def __init__(self, service, operation, attempt, retry_sleep, order_id):
+        self.service = service
+        self.operation = operation
+        self.attempt = attempt
+        self.retry_sleep = retry_sleep
+        self.order_id = order_id
+        # 调用方可设置 HTTP 状态码，非 2xx 视为失败
+        self.status_code = None
+        self.outcome = OK
+        self.error = ''
+        self.started_at = None
+        self.duration = 0.0
+
+    def _finish(self, exc):
+        if exc is not None:
+            from .wechat_pay import is_timeout_error
+
+            self.outcome = TIMEOUT if is_timeout_error(exc) else ERROR
+            self.error = str(exc)[:500]
+        elif self.status_code is not None and not 200 <= self.status_code < 300:
+            self.outcome = ERROR
+            self.error = f'HTTP {self.status_code}'
+
+    def to_model(self, context):
+        return OutboundSpan(
+            service=self.service,
+            operation=self.operation,
+            attempt=self.attempt,
+            duration_ms=round(self.duration * 1000, 3),
+            retry_sleep_ms=round(self.retry_sleep * 1000, 3),
+            outcome=self.outcome,
+            status_code=self.status_code,
+            error=self.error,
+            order_id=self.order_id or (context.order_id if context else None),
+            request_id=context.request_id if context else '',
+            request_path=context.request_path[:200] if context else '',
+            started_at=self.started_at,
+        )
+
+
+@contextmanager
+def trace_span(service, operation, attempt=1, retry_sleep=0, order_id=None):
+    """追踪一次外部调用
+
+    Args:
+        service: 依赖名称：wechat / smtp / feishu
+        operation: 操作名称，例如 native_order、query_order
+        attempt: 第几次尝试（从 1 开始）
+        retry_sleep: 本次尝试前的退避等待时间（秒）
+        order_id: 关联订单，不传时使用 bind_order 绑定的订单
+    """
+    span = Span(service, operation, attempt, retry_sleep, order_id)
+    span.started_at = timezone.now()
+    start = time.perf_counter()
+    exc = None
+    try:
+        yield span
+    except BaseException as e:
+        exc = e
+        raise
+    finally:
+        span.duration = time.perf_counter() - start
+        span._finish(exc)
+        registry.observe(OUTBOUND_DURATION, (service, operation, span.outcome), span.duration)
+        _record(span)
+
+
+def _record(span):
+    if span.outcome == OK and span.duration * 1000 < settings.TRACING_SLOW_SPAN_MS:
+        return
+    context = _current.get()
+    if context is not None:
+        # 请求内：请求结束时统一写入，避免在外部调用之间插入数据库写
+        context.pending.append(span)
+    else:
+        # 管理命令、后台任务等请求之外的调用：立即写入
+        _persist([span], None)
+
+
+@contextmanager
+def trace_context(request_id, request_path=''):
+    """在请求之外（管理命令、对账任务）建立追踪上下文，退出时统一写入慢 span
+
+    工作线程中的调用需要通过 contextvars.copy_context().run 执行才能归属到该上下文。
+    """
+    context = TraceContext(request_id, request_path)
+    token = _current.set(context)
+    try:
+        yield context
+    finally:
+        _current.reset(token)
+        if context.pending:
+            _persist(context.pending, context)
+
+
+def _persist(spans, context):
+    try:
+        OutboundSpan.objects.bulk_create([span.to_model(context) for span in spans])
+    except Exception as e:
+        logger.warning("慢调用记录写入失败: %s", e)
+    purge_expired()
+
+
+def purge_expired(force=False):
+    """删除超过 TRACING_SPAN_TTL 的 span，返回删除的行数"""
+    global _last_purge
+
+    now = time.monotonic()
+    if not force and now - _last_purge < PURGE_INTERVAL:
+        return 0
+    if not _purge_lock.acquire(blocking=False):
+        return 0
+    try:
+        _last_purge = now
+        expired_before = timezone.now() - timedelta(seconds=settings.TRACING_SPAN_TTL)
+        deleted, _ = OutboundSpan.objects.filter(started_at__lt=expired_before).delete()
+        if deleted:
+            logger.info("清理过期外部调用记录 %s 条", deleted)
+        return deleted
+    except Exception as e:
+        logger.warning("清理外部调用记录失败: %s", e)
+        return 0
+    finally:
+        _purge_lock.release()
+
+
+class TracingMiddleware:
+    """为每个请求建立追踪上下文，请求结束后写入本请求的慢 span"""
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        context = TraceContext(uuid.uuid4().hex[:16], request.path)
+        token = _current.set(context)
+        try:
+            return self.get_response(request)
+        finally:
+            _current.reset(token)
+            if context.pending:
+                _persist(context.pending, context)
+
+    async def __acall__(self, request):
+        context = TraceContext(uuid.uuid4().hex[:16], request.path)
+        token = _current.set(context)
+        try:
+            return await self.get_response(request)
+        finally:
+            _current.reset(token)
+            if context.pending:
+                await sync_to_async(_persist)(context.pending, context)
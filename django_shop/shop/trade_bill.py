@@ -0,0 +1,324 @@
+"""微信支付交易账单对账
+
+按日下载交易账单（bill_type=ALL），逐行流式解析后写入数据库临时表，
+再用几条 JOIN / NOT EXISTS 查询与订单表比对，报告：
+
+- missing_orders:       账单中支付成功、本地没有对应订单（按商户订单号）
+- unfulfilled:          账单中支付成功、本地订单未发货（未标记已支付或未完成，包括库存不足取消；已退款的不算）
+- amount_mismatch:      订单金额与账单不一致
+- transaction_mismatch: 本地记录的微信订单号与账单不一致
+- missing_in_bill:      本地当天已支付（非测试模式）、账单中没有支付记录
+
+账单格式：第一行为表头，数据行每个字段以反引号 ` 开头（防止 Excel 把单号转成数字），
+数据之后是“总交易单数,应结订单总金额,...”汇总表头和一行汇总值。
+账单下载由 wechatpayv3 一次读入内存（GZIP 压缩后体积不大），解压、解析和写入都是逐行进行的。
+
+PostgreSQL 用 COPY 写入临时表（ON COMMIT DROP）；SQLite 等其他数据库分批 executemany。
+"""
+import csv
+import gzip
+import hashlib
+import io
+from dataclasses import asdict, dataclass, field
+from datetime import datetime, time, timedelta
+from decimal import Decimal, InvalidOperation
+
+from django.db import connections, router, transaction
+from django.utils import timezone
+
+from .card_import import _copy_from_buffer
+from .models import Order
+
+# 临时表名
+STAGING_TABLE = 'shop_trade_bill_staging'
+STAGING_COLUMNS = ('trade_time', 'transaction_id', 'out_trade_no', 'trade_state', 'amount', 'refund_amount')
+
+# 每批写入临时表的行数
+BATCH_SIZE = 2000
+
+# 汇总部分的表头第一列
+SUMMARY_HEADER = '总交易单数'
+
+# 账单列名 -> 临时表字段；订单金额缺失时（旧版账单）使用应结订单金额
+BILL_COLUMNS = {
+    '交易时间': 'trade_time',
+    '微信订单号': 'transaction_id',
+    '商户订单号': 'out_trade_no',
+    '交易状态': 'trade_state',
+    '退款金额': 'refund_amount',
+}
+AMOUNT_COLUMNS = ('订单金额', '应结订单金额')
+
+# 测试模式（PAYMENT_TEST_MODE）的订单不经过微信，不参与对账
+TEST_TRANSACTION_PREFIX = 'TEST_'
+
+
+class TradeBillError(ValueError):
+    """账单格式错误或内容不完整"""
+
+
+class _HashingReader(io.RawIOBase):
+    """读取时计算摘要，用于校验解压后的账单内容（微信的 hash_value 针对原始账单）"""
+
+    def __init__(self, raw, hash_name='sha1'):
+        self.raw = raw
+        self.hash = hashlib.new(hash_name)
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self.raw.read(len(buffer))
+        self.hash.update(data)
+        buffer[:len(data)] = data
+        return len(data)
+
+
+def open_bill(content, hash_type='SHA1'):
+    """把账单字节（GZIP 或明文）包装为逐行读取的文本流，返回 (文本流, 摘要读取器)"""
+    raw = io.BytesIO(content) if isinstance(content, bytes) else content
+    if raw.read(2) == b'\x1f\x8b':
+        raw.seek(0)
+        raw = gzip.GzipFile(fileobj=raw)
+    else:
+        raw.seek(0)
+    reader = _HashingReader(raw, hash_type.lower())
+    return io.TextIOWrapper(io.BufferedReader(reader), encoding='utf-8-sig', newline=''), reader
+
+
+def _value(field_value):
+    return field_value[1:] if field_value.startswith('`') else field_value
+
+
+def _amount(field_value, column, line_number):
+    value = _value(field_value).strip() or '0'
+    try:
+        return Decimal(value)
+    except InvalidOperation:
+        raise TradeBillError(f'第 {line_number} 行{column}不是金额: {field_value!r}')
+
+
+def iter_bill_rows(lines):
+    """逐行解析账单，产出 (字段元组, None)，最后产出 (None, 汇总字典)
+
+    字段元组顺序与 STAGING_COLUMNS 一致。
+    """
+    reader = csv.reader(lines)
+    try:
+        header = [name.strip() for name in next(reader)]
+    except StopIteration:
+        raise TradeBillError('账单为空')
+
+    positions = {}
+    for name, column in BILL_COLUMNS.items():
+        if name not in header:
+            raise TradeBillError(f'账单缺少“{name}”列')
+        positions[column] = header.index(name)
+    amount_column = next((name for name in AMOUNT_COLUMNS if name in header), None)
+    if amount_column is None:
+        raise TradeBillError('账单缺少“订单金额”列')
+    amount_position = header.index(amount_column)
+
+    for row in reader:
+        if not row:
+            continue
+        if row[0].strip() == SUMMARY_HEADER:
+            summary_header = [name.strip() for name in row]
+            values = next(reader, None)
+            if values is None:
+                raise TradeBillError('账单汇总行缺失')
+            yield None, {name: _value(value) for name, value in zip(summary_header, values)}
+            return
+        if len(row) < len(header):
+            raise TradeBillError(f'第 {reader.line_num} 行字段数 {len(row)} 少于表头 {len(header)}')
+        yield (
+            _value(row[positions['trade_time']]),
+            _value(row[positions['transaction_id']]),
+            _value(row[positions['out_trade_no']]),
+            _value(row[positions['trade_state']]),
+            _amount(row[amount_position], amount_column, reader.line_num),
+            _amount(row[positions['refund_amount']], '退款金额', reader.line_num),
+        ), None
+
+    raise TradeBillError('账单没有汇总行，可能下载不完整')
+
+
+@dataclass
+class TradeBillReport:
+    bill_date: str
+    rows: int = 0
+    payments: int = 0
+    refunds: int = 0
+    missing_orders: list = field(default_factory=list)
+    unfulfilled: list = field(default_factory=list)
+    amount_mismatch: list = field(default_factory=list)
+    transaction_mismatch: list = field(default_factory=list)
+    missing_in_bill: list = field(default_factory=list)
+
+    ISSUE_FIELDS = ('missing_orders', 'unfulfilled', 'amount_mismatch', 'transaction_mismatch', 'missing_in_bill')
+
+    @property
+    def issue_count(self):
+        return sum(len(getattr(self, name)) for name in self.ISSUE_FIELDS)
+
+    def to_dict(self):
+        return asdict(self)
+
+
+class _StagingWriter:
+    """分批写入临时表"""
+
+    def __init__(self, cursor, connection, table):
+        self.cursor = cursor
+        self.use_copy = connection.vendor == 'postgresql'
+        self.ops = connection.ops
+        columns = ', '.join(STAGING_COLUMNS)
+        if self.use_copy:
+            self.sql = f'COPY {table} ({columns}) FROM STDIN WITH (FORMAT csv)'
+        else:
+            self.sql = f'INSERT INTO {table} ({columns}) VALUES ({", ".join(["%s"] * len(STAGING_COLUMNS))})'
+        self.rows = []
+
+    def add(self, row):
+        self.rows.append(row)
+        if len(self.rows) >= BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        if not self.rows:
+            return
+        if self.use_copy:
+            buffer = io.StringIO()
+            csv.writer(buffer).writerows(self.rows)
+            buffer.seek(0)
+            _copy_from_buffer(self.cursor, self.sql, buffer)
+        else:
+            self.cursor.executemany(self.sql, [
+                row[:4] + tuple(self.ops.adapt_decimalfield_value(value, 10, 2) for value in row[4:])
+                for row in self.rows
+            ])
+        self.rows = []
+
+
+def _fetch_dicts(cursor, sql, params=()):
+    cursor.execute(sql, params)
+    names = [column[0] for column in cursor.description]
+    return [
+        {name: _format_value(name, value) for name, value in zip(names, row)}
+        for row in cursor.fetchall()
+    ]
+
+
+def _format_value(name, value):
+    # SQLite 的 decimal 列按数值亲和存储，10.00 会读回整数 10
+    if name.endswith('amount') and value is not None:
+        return str(Decimal(str(value)).quantize(Decimal('0.01')))
+    return value
+
+
+def reconcile_trade_bill(bill_date, content, hash_type=None, hash_value=None, using=None):
+    """比对一天的交易账单和订单表
+
+    Args:
+        bill_date: 账单日期（date）
+        content: 账单内容（bytes，GZIP 或明文）或二进制文件对象
+        hash_type / hash_value: 微信返回的原始账单摘要，提供时校验
+        using: 数据库别名
+
+    Returns:
+        TradeBillReport
+    """
+    using = using or router.db_for_read(Order)
+    connection = connections[using]
+    ops = connection.ops
+    staging = ops.quote_name(STAGING_TABLE)
+    orders = ops.quote_name(Order._meta.db_table)
+    report = TradeBillReport(bill_date=bill_date.isoformat())
+
+    text, digest = open_bill(content, hash_type or 'SHA1')
+    with transaction.atomic(using=using), connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            cursor.execute(
+                f'CREATE TEMPORARY TABLE IF NOT EXISTS {staging} ('
+                'trade_time varchar(32), transaction_id varchar(64), out_trade_no varchar(64), '
+                'trade_state varchar(32), amount numeric(10, 2), refund_amount numeric(10, 2)) ON COMMIT DROP'
+            )
+            cursor.execute(f'TRUNCATE {staging}')
+        else:
+            cursor.execute(
+                f'CREATE TEMPORARY TABLE IF NOT EXISTS {staging} ('
+                'trade_time varchar(32), transaction_id varchar(64), out_trade_no varchar(64), '
+                'trade_state varchar(32), amount decimal(10, 2), refund_amount decimal(10, 2))'
+            )
+            cursor.execute(f'DELETE FROM {staging}')
+        cursor.execute(f'CREATE INDEX IF NOT EXISTS {ops.quote_name(STAGING_TABLE + "_no")} '
+                       f'ON {staging} (out_trade_no)')
+
+        writer = _StagingWriter(cursor, connection, staging)
+        summary = None
+        for row, summary in iter_bill_rows(text):
+            if row is None:
+                break
+            report.rows += 1
+            if row[3] == 'SUCCESS':
+                report.payments += 1
+            elif row[3] == 'REFUND':
+                report.refunds += 1
+            writer.add(row)
+        writer.flush()
+
+        expected = (summary or {}).get(SUMMARY_HEADER, '').strip()
+        if expected and expected.isdigit() and int(expected) != report.rows:
+            raise TradeBillError(f'账单汇总 {expected} 笔，实际解析 {report.rows} 笔')
+        # 读完剩余内容（汇总之后可能还有空行）再校验摘要
+        text.read()
+        if hash_value and digest.hash.hexdigest().lower() != hash_value.lower():
+            raise TradeBillError('账单摘要校验失败，可能下载不完整')
+
+        paid = "b.trade_state = 'SUCCESS'"
+        report.missing_orders = _fetch_dicts(cursor, f"""
+            SELECT b.out_trade_no, b.transaction_id, b.amount AS bill_amount, b.trade_time
+            FROM {staging} b LEFT JOIN {orders} o ON o.out_trade_no = b.out_trade_no
+            WHERE {paid} AND o.id IS NULL
+            ORDER BY b.trade_time
+        """)
+        report.unfulfilled = _fetch_dicts(cursor, f"""
+            SELECT o.id AS order_id, b.out_trade_no, b.transaction_id, o.payment_status, o.status, b.trade_time
+            FROM {staging} b JOIN {orders} o ON o.out_trade_no = b.out_trade_no
+            WHERE {paid} AND (
+                o.payment_status NOT IN ('paid', 'refunded') OR (o.payment_status = 'paid' AND o.status <> 'completed')
+            )
+            ORDER BY o.id
+        """)
+        report.amount_mismatch = _fetch_dicts(cursor, f"""
+            SELECT o.id AS order_id, b.out_trade_no, o.total_amount AS order_amount, b.amount AS bill_amount
+            FROM {staging} b JOIN {orders} o ON o.out_trade_no = b.out_trade_no
+            WHERE {paid} AND o.total_amount <> b.amount
+            ORDER BY o.id
+        """)
+        report.transaction_mismatch = _fetch_dicts(cursor, f"""
+            SELECT o.id AS order_id, b.out_trade_no, o.transaction_id AS order_transaction_id,
+                   b.transaction_id AS bill_transaction_id
+            FROM {staging} b JOIN {orders} o ON o.out_trade_no = b.out_trade_no
+            WHERE {paid} AND o.transaction_id IS NOT NULL AND o.transaction_id <> ''
+              AND o.transaction_id <> b.transaction_id
+            ORDER BY o.id
+        """)
+
+        # 账单按北京时间自然日统计；本地支付时间比微信支付完成时间稍晚，零点附近的订单可能被误报
+        start = timezone.make_aware(datetime.combine(bill_date, time.min))
+        end = start + timedelta(days=1)
+        report.missing_in_bill = _fetch_dicts(cursor, f"""
+            SELECT o.id AS order_id, o.out_trade_no, o.transaction_id, o.total_amount AS order_amount, o.paid_at
+            FROM {orders} o
+            WHERE o.payment_status = 'paid' AND o.paid_at >= %s AND o.paid_at < %s
+              AND (o.transaction_id IS NULL OR o.transaction_id NOT LIKE %s ESCAPE '!')
+              AND NOT EXISTS (SELECT 1 FROM {staging} b WHERE b.out_trade_no = o.out_trade_no AND {paid})
+            ORDER BY o.id
+        """, [
+            ops.adapt_datetimefield_value(start),
+            ops.adapt_datetimefield_value(end),
+            TEST_TRANSACTION_PREFIX.replace('_', '!_') + '%',
+        ])
+
+    return report
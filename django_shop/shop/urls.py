@@ -1,25 +1,37 @@
+from django.conf import settings
 from django.urls import path
 
 from . import views
 from . import cron_views
+from . import metrics
 
 app_name = 'shop'
 
+# ASGI 部署时下单、回调和状态查询使用异步视图
+if settings.PAYMENT_ASYNC_VIEWS:
+    from . import async_views as payment_views
+else:
+    payment_views = views
+
 urlpatterns = [
     path('', views.product_list, name='product_list'),
     path('product/<slug:slug>/', views.product_detail, name='product_detail'),
-    path('buy/<slug:slug>/', views.buy_product, name='buy_product'),
+    path('buy/<slug:slug>/', payment_views.buy_product, name='buy_product'),
 
     # 支付相关
     path('payment/<int:order_id>/', views.payment_page, name='payment_page'),
     path('payment/qrcode/<int:order_id>/', views.generate_qr_code, name='qr_code'),
-    path('payment/notify/', views.wechat_payment_notify, name='payment_notify'),
-    path('payment/status/<int:order_id>/', views.check_payment_status, name='payment_status'),
+    path('payment/notify/', payment_views.wechat_payment_notify, name='payment_notify'),
+    path('payment/status/<int:order_id>/', payment_views.check_payment_status, name='payment_status'),
 
     # 订单查询
     path('order/<int:order_id>/', views.order_detail, name='order_detail'),
 
+    # 性能指标
+    path('metrics', metrics.metrics_view, name='metrics'),
+
     # 定时任务
     path('api/cron/daily-report/', cron_views.daily_report_cron, name='daily_report_cron'),
+    path('api/cron/reconcile-payments/', cron_views.reconcile_payments_cron, name='reconcile_payments_cron'),
     path('api/cron/test-feishu/', cron_views.test_feishu_notification, name='test_feishu'),
 ]
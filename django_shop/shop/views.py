@@ -1,53 +1,72 @@
 from datetime import timedelta
 from io import BytesIO
 import logging
+import uuid
 
-import qrcode
 from django.conf import settings
-from django.db import transaction
 from django.http import HttpResponse, HttpResponseBadRequest, JsonResponse
 from django.shortcuts import get_object_or_404, redirect, render
 from django.utils import timezone
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_POST
 
-from .email_utils import send_card_email
-from .models import Card, Order, Product
-from .wechat_pay import WeChatPayClient
+from . import idempotency
+from .deadline import Deadline
+from .fulfillment import (
+    ALREADY_PAID,
+    CONFLICT,
+    FULFILLED,
+    OUT_OF_STOCK,
+    fulfill_order,
+    send_fulfillment_notifications,
+)
+from .models import Order, Product
+from .order_state import mark_expired
+from .tracing import bind_order
+from .wechat_pay import WeChatPayClient, is_timeout_error, verify_notify
 
 logger = logging.getLogger(__name__)
+# 支付状态轮询日志量大，单独的 logger 按 LOG_SAMPLE_RATES 采样输出
+poll_logger = logging.getLogger('shop.poll')
 
 
 def product_list(request):
     """Display all products."""
-    products = Product.objects.all()
+    # 库存和已售数量通过子查询一次取出，模板中不再逐个商品查询
+    products = Product.objects.with_stats()
     return render(request, 'shop/index.html', {'products': products})
 
 
 def product_detail(request, slug):
     """商品详情页面"""
-    product = get_object_or_404(Product, slug=slug)
+    product = get_object_or_404(
+        Product.objects.with_stats().prefetch_related('price_tiers'),
+        slug=slug,
+    )
     return render(request, 'shop/product_detail.html', {
         'product': product,
+        # 每次打开页面生成新的幂等键，同一个表单重复提交只创建一个订单
+        'idempotency_key': uuid.uuid4().hex,
     })
 
 
-@require_POST
-def buy_product(request, slug):
-    """创建订单并跳转支付页面"""
-    product = get_object_or_404(Product, slug=slug)
+def _parse_purchase(request):
+    """解析购买表单，返回 (email, quantity, error_response)"""
     email = request.POST.get('email')
     quantity = int(request.POST.get('quantity', 1))
 
     if not email:
-        return HttpResponseBadRequest("Email is required")
+        return email, quantity, HttpResponseBadRequest("Email is required")
 
     # 验证购买数量
     if quantity < 1:
-        return HttpResponseBadRequest("购买数量至少为 1")
+        return email, quantity, HttpResponseBadRequest("购买数量至少为 1")
 
-    # 检查库存
-    stock_count = product.cards.filter(status='unsold').count()
+    return email, quantity, None
+
+
+def _stock_error_response(request, stock_count, quantity):
+    """库存不足时返回错误页，库存充足返回 None"""
     if stock_count == 0:
         return render(request, 'shop/error.html', {
             'message': '抱歉，该商品已售罄。'
@@ -58,9 +77,13 @@ def buy_product(request, slug):
             'message': f'抱歉，库存不足。当前库存仅剩 {stock_count} 件，您想购买 {quantity} 件。'
         }, status=400)
 
-    # 创建订单（待支付状态）
+    return None
+
+
+def _build_pending_order(product, email, quantity):
+    """构造待支付订单（未保存）"""
     unit_price = product.get_price_for_quantity(quantity)
-    order = Order.objects.create(
+    return Order(
         email=email,
         product=product,  # 关联商品
         quantity=quantity,
@@ -72,92 +95,153 @@ def buy_product(request, slug):
         expires_at=timezone.now() + timedelta(minutes=settings.ORDER_EXPIRE_MINUTES),
     )
 
-    # 检查是否启用测试模式
-    test_mode = getattr(settings, 'PAYMENT_TEST_MODE', False)
-
-    if test_mode:
-        # 测试模式：直接模拟支付成功
-        with transaction.atomic():
-            # 批量分配卡密
-            cards = (
-                Card.objects
-                .select_for_update(skip_locked=True)
-                .filter(product=product, status='unsold')
-                [:quantity]
-            )
-            cards_list = list(cards)
-
-            if len(cards_list) == quantity:
-                # 更新订单状态
-                order.payment_status = 'paid'
-                order.status = 'completed'
-                order.transaction_id = f'TEST_{order.out_trade_no}'
-                order.paid_at = timezone.now()
-                order.qr_code_url = 'test://paid'
-                order.save()
-
-                # 批量更新卡密状态
-                for card in cards_list:
-                    card.status = 'sold'
-                    card.order = order
-                    card.save()
-
-                # 发送邮件
-                try:
-                    send_card_email(order, cards_list)
-                except Exception as e:
-                    print(f"邮件发送失败: {e}")
-
-                # 发送飞书通知
-                try:
-                    from .feishu_utils import send_order_notification
-                    result = send_order_notification(order)
-                    logger.info(f"[测试模式] 飞书通知发送成功: 订单#{order.id}, 响应={result}")
-                except Exception as e:
-                    logger.error(f"[测试模式] 飞书通知发送失败: 订单#{order.id}, 错误={e}", exc_info=True)
-                    print(f"飞书通知发送失败: {e}")
-
-                # 直接跳转到订单详情页
-                return redirect('shop:order_detail', order_id=order.id)
+
+def _payment_error_response(request, e):
+    """创建支付订单失败时，根据错误类型返回友好的提示"""
+    logger.error("创建支付订单失败: %s", e, exc_info=True)
+
+    # 判断错误类型，提供不同的提示
+    error_message = str(e)
+
+    if is_timeout_error(e):
+        # 超时错误
+        user_message = '支付系统连接超时，请稍后重试。如果问题持续出现，请联系客服。'
+    elif '证书' in error_message or 'certificate' in error_message.lower():
+        # 证书错误
+        user_message = '支付配置错误，请联系客服处理。'
+    else:
+        # 其他错误
+        user_message = f'支付系统错误：{error_message}'
+
+    return render(request, 'shop/error.html', {
+        'message': user_message,
+        'detail': error_message if settings.DEBUG else None,  # 调试模式显示详细错误
+    }, status=500)
+
+
+def _test_mode_response(request, order):
+    """测试模式：直接模拟支付成功"""
+    order, cards_list, result = fulfill_order(
+        {'pk': order.pk},
+        transaction_id=f'TEST_{order.out_trade_no}',
+        qr_code_url='test://paid',
+    )
+
+    if result == OUT_OF_STOCK:
+        # 测试模式下也没有足够卡密，返回错误
+        return render(request, 'shop/error.html', {
+            'message': f'抱歉，库存不足。当前仅剩 {len(cards_list)} 件。'
+        }, status=400)
+
+    if result == CONFLICT:
+        return render(request, 'shop/error.html', {'message': '当前下单人数较多，请稍后重试。'}, status=503)
+
+    if result == FULFILLED:
+        send_fulfillment_notifications(order, cards_list, '测试模式')
+
+    # 直接跳转到订单详情页
+    return redirect('shop:order_detail', order_id=order.id)
+
+
+def _idempotency_key(request):
+    """读取幂等键，返回 (key, error_response)"""
+    try:
+        return idempotency.get_key(request), None
+    except ValueError as e:
+        return None, HttpResponseBadRequest(str(e))
+
+
+def _idempotent_response(request, record, digest):
+    """重复提交：返回第一次下单的跳转；请求内容不一致、第一次仍在处理或已失败时返回错误页"""
+    if record is None:
+        return render(request, 'shop/error.html', {
+            'message': '上一次提交未能完成，请重新下单。'
+        }, status=409)
+    if record.request_hash != digest:
+        return render(request, 'shop/error.html', {
+            'message': '该请求已用于另一笔订单，请刷新页面后重新提交。'
+        }, status=422)
+    if record.order is None:
+        return render(request, 'shop/error.html', {
+            'message': '订单正在创建，请稍后刷新页面。'
+        }, status=409)
+    if record.order.payment_status == 'paid':
+        return redirect('shop:order_detail', order_id=record.order_id)
+    return redirect('shop:payment_page', order_id=record.order_id)
+
+
+@require_POST
+def buy_product(request, slug):
+    """创建订单并跳转支付页面
+
+    带幂等键（表单隐藏字段或 Idempotency-Key 请求头）的重复提交返回第一次创建的订单，
+    不重复创建订单和调用微信下单（见 shop/idempotency.py）。
+    """
+    email, quantity, error_response = _parse_purchase(request)
+    if error_response:
+        return error_response
+    key, error_response = _idempotency_key(request)
+    if error_response:
+        return error_response
+    if key is None:
+        return _checkout(request, slug, email, quantity)[0]
+
+    digest = idempotency.request_hash(slug, email, quantity)
+    record = idempotency.lookup(key)
+    if record is None:
+        claimed, record = idempotency.claim(key, digest)
+        if claimed:
+            try:
+                response, order = _checkout(request, slug, email, quantity)
+            except BaseException:
+                idempotency.release(key)
+                raise
+            if order is not None:
+                idempotency.complete(key, order)
             else:
-                # 测试模式下也没有足够卡密，返回错误
-                return render(request, 'shop/error.html', {
-                    'message': f'抱歉，库存不足。当前仅剩 {len(cards_list)} 件。'
-                }, status=400)
+                idempotency.release(key)
+            return response
+    if record is not None and record.order_id is None and record.request_hash == digest:
+        # 第一个请求还在调用微信下单
+        record = idempotency.wait_for_order(key)
+    return _idempotent_response(request, record, digest)
+
+
+def _checkout(request, slug, email, quantity):
+    """检查库存、创建订单并生成支付二维码，返回 (response, 成功创建的订单或 None)"""
+    product = get_object_or_404(Product, slug=slug)
+
+    # 检查库存
+    stock_count = product.cards.filter(status='unsold').count()
+    error_response = _stock_error_response(request, stock_count, quantity)
+    if error_response:
+        return error_response, None
+
+    # 创建订单（待支付状态）
+    order = _build_pending_order(product, email, quantity)
+    order.save()
+
+    # 检查是否启用测试模式
+    if getattr(settings, 'PAYMENT_TEST_MODE', False):
+        response = _test_mode_response(request, order)
+        return response, order if response.status_code == 302 else None
 
     # 生产模式：生成支付二维码
+    # 本请求内所有微信支付调用（含重试）共用同一个时间预算
+    deadline = Deadline(settings.WECHAT_PAY_DEADLINE_SECONDS)
     try:
-        # 初始化微信支付客户端（30秒超时）
-        wechat_client = WeChatPayClient(timeout=30)
+        wechat_client = WeChatPayClient(timeout=deadline.timeout())
 
-        # 创建支付订单（最多重试3次）
-        qr_code_url = wechat_client.create_native_order(order, max_retries=3)
+        # 创建支付订单（最多尝试3次，预算用完即停止）
+        qr_code_url = wechat_client.create_native_order(order, max_retries=3, deadline=deadline)
 
         order.qr_code_url = qr_code_url
-        order.save()
+        order.save(update_fields=['qr_code_url'])
     except Exception as e:
-        logger.error(f"创建支付订单失败: {e}", exc_info=True)
-
-        # 判断错误类型，提供不同的提示
-        error_message = str(e)
-
-        if 'timeout' in error_message.lower() or 'timed out' in error_message.lower():
-            # 超时错误
-            user_message = '支付系统连接超时，请稍后重试。如果问题持续出现，请联系客服。'
-        elif '证书' in error_message or 'certificate' in error_message.lower():
-            # 证书错误
-            user_message = '支付配置错误，请联系客服处理。'
-        else:
-            # 其他错误
-            user_message = f'支付系统错误：{error_message}'
-
-        return render(request, 'shop/error.html', {
-            'message': user_message,
-            'detail': error_message if settings.DEBUG else None,  # 调试模式显示详细错误
-        }, status=500)
+        return _payment_error_response(request, e), None
 
     # 跳转到支付页面
-    return redirect('shop:payment_page', order_id=order.id)
+    return redirect('shop:payment_page', order_id=order.id), order
 
 
 def payment_page(request, order_id):
@@ -169,8 +253,11 @@ def payment_page(request, order_id):
         return redirect('shop:order_detail', order_id=order.id)
 
     if order.expires_at and order.expires_at < timezone.now():
-        order.payment_status = 'expired'
-        order.save()
+        # 条件更新：页面加载期间回调可能已完成支付，不能覆盖为过期
+        if not mark_expired(order):
+            order.refresh_from_db(fields=['payment_status'])
+            if order.payment_status == 'paid':
+                return redirect('shop:order_detail', order_id=order.id)
         return render(request, 'shop/error.html', {
             'message': '订单已过期，请重新下单。'
         })
@@ -184,6 +271,9 @@ def generate_qr_code(request, order_id):
     """生成二维码图片"""
     order = get_object_or_404(Order, id=order_id)
 
+    # 延迟导入：qrcode 会加载 PIL，只有二维码请求需要
+    import qrcode
+
     qr = qrcode.QRCode(version=1, box_size=10, border=4)
     qr.add_data(order.qr_code_url)
     qr.make(fit=True)
@@ -207,14 +297,14 @@ def wechat_payment_notify(request):
             'Wechatpay-Timestamp': request.META.get('HTTP_WECHATPAY_TIMESTAMP', ''),
             'Wechatpay-Nonce': request.META.get('HTTP_WECHATPAY_NONCE', ''),
             'Wechatpay-Serial': request.META.get('HTTP_WECHATPAY_SERIAL', ''),
+            'Wechatpay-Signature-Type': request.META.get('HTTP_WECHATPAY_SIGNATURE_TYPE', ''),
         }
 
         # 获取请求体
         body = request.body
 
-        # 验证签名并解密
-        wechat_client = WeChatPayClient()
-        result = wechat_client.verify_notify(headers, body)
+        # 验证签名并解密（平台公钥缓存在进程内，不构造支付客户端）
+        result = verify_notify(headers, body)
 
         if not result:
             return JsonResponse({'code': 'FAIL', 'message': '签名验证失败'})
@@ -232,66 +322,31 @@ def wechat_payment_notify(request):
         if trade_state != 'SUCCESS':
             return JsonResponse({'code': 'SUCCESS', 'message': '支付未成功'})
 
-        # 查询订单
-        with transaction.atomic():
-            order = Order.objects.select_for_update().get(out_trade_no=out_trade_no)
+        # 分配卡密并更新订单
+        order, cards_list, fulfillment = fulfill_order(
+            {'out_trade_no': out_trade_no},
+            transaction_id=transaction_id,
+            cancel_on_shortage=True,
+        )
 
-            # 防止重复处理
-            if order.payment_status == 'paid':
-                return JsonResponse({'code': 'SUCCESS', 'message': '订单已处理'})
-
-            # 批量分配卡密
-            quantity = order.quantity
-            cards = (
-                Card.objects
-                .select_for_update(skip_locked=True)
-                .filter(product__id=order.product_id, status='unsold')
-                [:quantity]
-            )
-            cards_list = list(cards)
-
-            if len(cards_list) < quantity:
-                # 库存不足，需要退款（这里简化处理）
-                order.status = 'cancelled'
-                order.save()
-                return JsonResponse({'code': 'SUCCESS', 'message': f'库存不足，需要 {quantity} 件，仅剩 {len(cards_list)} 件'})
-
-            # 更新订单状态
-            order.payment_status = 'paid'
-            order.status = 'completed'
-            order.transaction_id = transaction_id
-            order.paid_at = timezone.now()
-            order.save()
-
-            # 批量更新卡密状态
-            for card in cards_list:
-                card.status = 'sold'
-                card.order = order
-                card.save()
-
-        # 发送邮件（异步执行更好）
-        try:
-            send_card_email(order, cards_list)
-        except Exception as e:
-            # 记录日志但不影响支付流程
-            print(f"邮件发送失败: {e}")
+        # 防止重复处理
+        if fulfillment == ALREADY_PAID:
+            return JsonResponse({'code': 'SUCCESS', 'message': '订单已处理'})
 
-        # 发送飞书通知
-        try:
-            from .feishu_utils import send_order_notification
-            result = send_order_notification(order)
-            logger.info(f"[微信回调] 飞书通知发送成功: 订单#{order.id}, 响应={result}")
-        except Exception as e:
-            # 记录日志但不影响支付流程
-            logger.error(f"[微信回调] 飞书通知发送失败: 订单#{order.id}, 错误={e}", exc_info=True)
-            print(f"飞书通知发送失败: {e}")
+        if fulfillment == OUT_OF_STOCK:
+            return JsonResponse({'code': 'SUCCESS', 'message': f'库存不足，需要 {order.quantity} 件，仅剩 {len(cards_list)} 件'})
+
+        if fulfillment == CONFLICT:
+            # 返回失败，微信稍后重新投递回调
+            return JsonResponse({'code': 'FAIL', 'message': '卡密分配冲突，请重试'})
+
+        # 发送邮件和飞书通知（失败不影响支付流程）
+        send_fulfillment_notifications(order, cards_list, '微信回调')
 
         return JsonResponse({'code': 'SUCCESS', 'message': '成功'})
 
     except Exception as e:
-        print(f"支付回调处理失败: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.error("支付回调处理失败: %s", e, exc_info=True)
         return JsonResponse({'code': 'FAIL', 'message': str(e)})
 
 
@@ -312,72 +367,29 @@ def check_payment_status(request, order_id):
 
     # 如果订单还未支付，主动查询微信支付订单状态
     if order.payment_status == 'unpaid':
+        bind_order(order.id)
+        deadline = Deadline(settings.WECHAT_PAY_DEADLINE_SECONDS)
         try:
-            wechat_client = WeChatPayClient()
-            result = wechat_client.query_order(order.out_trade_no)
+            wechat_client = WeChatPayClient(timeout=deadline.timeout())
+            result = wechat_client.query_order(order.out_trade_no, deadline=deadline)
 
-            print(f"查询订单状态: {result}")
-
-            # 解析查询结果
-            if isinstance(result, str):
-                import json
-                result = json.loads(result)
+            poll_logger.debug("查询订单状态: 订单#%s, 结果=%s", order.id, result)
 
             trade_state = result.get('trade_state')
 
-            # 如果支付成功，更新订单状态
+            # 如果支付成功，分配卡密并更新订单状态
             if trade_state == 'SUCCESS':
-                with transaction.atomic():
-                    # 重新获取订单（加锁）
-                    order = Order.objects.select_for_update().get(id=order_id)
-
-                    # 防止重复处理
-                    if order.payment_status != 'paid':
-                        # 批量分配卡密
-                        quantity = order.quantity
-                        cards = (
-                            Card.objects
-                            .select_for_update(skip_locked=True)
-                            .filter(product=order.product, status='unsold')
-                            [:quantity]
-                        )
-                        cards_list = list(cards)
-
-                        if len(cards_list) == quantity:
-                            # 更新订单
-                            order.payment_status = 'paid'
-                            order.status = 'completed'
-                            order.transaction_id = result.get('transaction_id', '')
-                            order.paid_at = timezone.now()
-                            order.save()
-
-                            # 批量更新卡密
-                            for card in cards_list:
-                                card.status = 'sold'
-                                card.order = order
-                                card.save()
-
-                            print(f"✅ 订单 {order.id} 支付成功，已分配 {quantity} 个卡密")
-
-                            # 发送邮件
-                            try:
-                                send_card_email(order, cards_list)
-                            except Exception as e:
-                                print(f"邮件发送失败: {e}")
-
-                            # 发送飞书通知
-                            try:
-                                from .feishu_utils import send_order_notification
-                                result = send_order_notification(order)
-                                logger.info(f"[主动查询] 飞书通知发送成功: 订单#{order.id}, 响应={result}")
-                            except Exception as e:
-                                logger.error(f"[主动查询] 飞书通知发送失败: 订单#{order.id}, 错误={e}", exc_info=True)
-                                print(f"飞书通知发送失败: {e}")
+                order, cards_list, fulfillment = fulfill_order(
+                    {'pk': order_id},
+                    transaction_id=result.get('transaction_id', ''),
+                )
+
+                if fulfillment == FULFILLED:
+                    logger.info("订单 %s 支付成功，已分配 %s 个卡密", order.id, order.quantity)
+                    send_fulfillment_notifications(order, cards_list, '主动查询')
 
         except Exception as e:
-            print(f"查询订单状态失败: {e}")
-            import traceback
-            traceback.print_exc()
+            poll_logger.warning("查询订单状态失败: 订单#%s, 错误=%s", order.id, e, exc_info=True)
 
     return JsonResponse({
         'payment_status': order.payment_status,
@@ -0,0 +1,309 @@
+"""微信支付平台公钥 / 平台证书的进程内缓存，用于回调验签和解密
+
+原来每次回调都构造一个完整的 WeChatPayClient：加载商户私钥、解析平台公钥，证书模式下
+还要读取证书目录（Vercel 冷启动后 /tmp 为空，会重新下载平台证书）。这里把验签需要的公钥
+按序列号解析一次后保存在模块级的 PlatformKeyStore 中，热实例的后续回调只做内存中的
+RSA 验签和 AES-GCM 解密，不读磁盘、不访问网络。
+
+- 公钥模式：WECHAT_PLATFORM_CERT + WECHAT_PLATFORM_CERT_SERIAL_NO，首次使用时解析，不过期；
+- 证书模式：平台证书 PEM 保存在 Django 缓存中（数据库 / Redis 缓存跨冷启动保留），
+  缓存也没有时才通过 /v3/certificates 下载。证书接近过期或距上次刷新超过 REFRESH_INTERVAL 时
+  在后台线程刷新；遇到未知序列号（微信轮换证书）时同步刷新一次，MISS_REFRESH_INTERVAL 内不重复。
+
+配置（商户号、APIv3 密钥、平台公钥）变化时缓存自动失效，测试中 override_settings 不会串用旧密钥。
+"""
+import base64
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+from cryptography import x509
+from cryptography.exceptions import InvalidSignature, InvalidTag
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import padding
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from django.conf import settings
+from django.core.cache import caches
+from django.db import connections
+
+logger = logging.getLogger(__name__)
+
+SIGNATURE_TYPE = 'WECHATPAY2-SHA256-RSA2048'
+CACHE_KEY = 'wechatpay:platform_certs'
+
+# 定期刷新平台证书的间隔（秒）
+REFRESH_INTERVAL = 12 * 3600
+# 证书剩余有效期低于该值（秒）时缩短刷新间隔，尽早拿到微信新签发的证书
+REFRESH_BEFORE_EXPIRY = 3 * 24 * 3600
+EXPIRING_REFRESH_INTERVAL = 3600
+# 未知序列号触发同步刷新的最小间隔（秒），防止伪造序列号的请求反复触发下载
+MISS_REFRESH_INTERVAL = 60
+
+
+def _header(headers, name):
+    """兼容 'Wechatpay-Signature' 和 request.META 的 'HTTP_WECHATPAY_SIGNATURE' 两种写法"""
+    return headers.get(name) or headers.get('HTTP_' + name.upper().replace('-', '_'), '')
+
+
+def _normalize_serial(serial_no):
+    """证书序列号按十六进制数值比较（忽略大小写和前导零），公钥 ID 原样使用"""
+    try:
+        return format(int(serial_no, 16), 'X')
+    except ValueError:
+        return serial_no
+
+
+def _pem_public_key(value):
+    """平台公钥可能是完整 PEM，也可能只有 base64 内容（环境变量里常见）"""
+    value = value.strip()
+    if not value.startswith('-----BEGIN'):
+        value = f'-----BEGIN PUBLIC KEY-----\n{value}\n-----END PUBLIC KEY-----'
+    return serialization.load_pem_public_key(value.encode())
+
+
+def _download_certificates():
+    """通过 SDK 下载当前有效的平台证书，返回 PEM 列表
+
+    SDK 的 Core 构造时会先读取证书目录、为空再下载一次（且在设置 API 地址之前），
+    这里跳过构造时的加载，设置好 API 地址后只下载一次，也不会读到证书目录里轮换前的旧证书。
+    """
+    from wechatpayv3.core import Core
+
+    from .wechat_pay import DEFAULT_TIMEOUT
+
+    class DownloadCore(Core):
+        def _init_certificates(self):
+            pass
+
+    core = DownloadCore(
+        mchid=settings.WECHAT_MCH_ID,
+        cert_serial_no=settings.WECHAT_SERIAL_NO,
+        private_key=settings.WECHAT_PRIVATE_KEY,
+        apiv3_key=settings.WECHAT_API_V3_KEY,
+        timeout=DEFAULT_TIMEOUT,
+    )
+    if settings.WECHAT_PAY_API_BASE_URL:
+        core._gate_way = settings.WECHAT_PAY_API_BASE_URL.rstrip('/')
+    core._update_certificates()
+    return [cert.public_bytes(serialization.Encoding.PEM).decode() for cert in core._certificates]
+
+
+class PlatformKeyStore:
+    """按序列号缓存的平台公钥
+
+    Args:
+        downloader: 下载平台证书的函数，返回 PEM 列表
+        cache_alias: 跨实例保存证书的缓存
+    """
+
+    def __init__(self, downloader=_download_certificates, cache_alias='default', clock=time.time):
+        self.downloader = downloader
+        self.cache_alias = cache_alias
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._refreshing = threading.Lock()
+        self._fingerprint = None
+        self._reset()
+
+    def _reset(self):
+        self._keys = {}           # 序列号（大写十六进制） -> 公钥
+        self._expires = {}        # 序列号 -> 过期时间戳，公钥模式没有
+        self._aesgcm = None
+        self._loaded = False
+        self._last_refresh = 0.0
+        self._last_miss_refresh = 0.0
+
+    # ------------------------------------------------------------------
+    # 加载
+    # ------------------------------------------------------------------
+
+    @property
+    def public_key_mode(self):
+        return bool(settings.WECHAT_PLATFORM_CERT and settings.WECHAT_PLATFORM_CERT_SERIAL_NO)
+
+    def _check_config(self):
+        fingerprint = hashlib.sha256('\0'.join([
+            settings.WECHAT_MCH_ID, settings.WECHAT_API_V3_KEY,
+            settings.WECHAT_PLATFORM_CERT, settings.WECHAT_PLATFORM_CERT_SERIAL_NO,
+        ]).encode()).hexdigest()
+        if fingerprint != self._fingerprint:
+            with self._lock:
+                if fingerprint != self._fingerprint:
+                    self._reset()
+                    self._fingerprint = fingerprint
+
+    def _ensure_loaded(self):
+        self._check_config()
+        if self._loaded:
+            return
+        with self._lock:
+            if self._loaded:
+                return
+            self._aesgcm = AESGCM(settings.WECHAT_API_V3_KEY.encode())
+            if self.public_key_mode:
+                self._keys = {
+                    _normalize_serial(settings.WECHAT_PLATFORM_CERT_SERIAL_NO): _pem_public_key(settings.WECHAT_PLATFORM_CERT),
+                }
+            else:
+                pems = self._cache_get()
+                if pems:
+                    self._install(pems)
+                else:
+                    self._download()
+            self._loaded = True
+
+    def _cache_get(self):
+        try:
+            return caches[self.cache_alias].get(CACHE_KEY)
+        except Exception as e:
+            logger.warning("读取平台证书缓存失败: %s", e)
+            return None
+
+    def _install(self, pems):
+        """解析证书 PEM，替换当前公钥（已过期的证书丢弃）"""
+        now = self.clock()
+        keys, expires = {}, {}
+        for pem in pems:
+            cert = x509.load_pem_x509_certificate(pem.encode())
+            not_after = cert.not_valid_after_utc.timestamp()
+            if not_after <= now:
+                continue
+            serial = format(cert.serial_number, 'X')
+            keys[serial] = cert.public_key()
+            expires[serial] = not_after
+        self._keys, self._expires = keys, expires
+
+    def _download(self):
+        pems = self.downloader()
+        self._install(pems)
+        self._last_refresh = self.clock()
+        if not pems:
+            return
+        try:
+            # 缓存保留到最晚的证书过期
+            timeout = max(self._expires.values(), default=self.clock()) - self.clock()
+            caches[self.cache_alias].set(CACHE_KEY, pems, timeout=max(int(timeout), 1))
+        except Exception as e:
+            logger.warning("保存平台证书缓存失败: %s", e)
+        logger.info("平台证书已刷新: %s", ', '.join(sorted(self._keys)))
+
+    # ------------------------------------------------------------------
+    # 刷新
+    # ------------------------------------------------------------------
+
+    def _needs_refresh(self):
+        if self.public_key_mode:
+            return False
+        now = self.clock()
+        if not self._last_refresh:
+            # 从缓存加载的证书，本进程首次使用后按间隔刷新
+            self._last_refresh = now
+        soonest = min(self._expires.values(), default=0)
+        interval = EXPIRING_REFRESH_INTERVAL if soonest - now < REFRESH_BEFORE_EXPIRY else REFRESH_INTERVAL
+        return now - self._last_refresh > interval
+
+    def _refresh(self):
+        if not self._refreshing.acquire(blocking=False):
+            return
+        try:
+            with self._lock:
+                self._download()
+        except Exception as e:
+            # 刷新失败继续使用现有证书，下次回调再试
+            self._last_refresh = self.clock()
+            logger.warning("刷新平台证书失败: %s", e)
+        finally:
+            self._refreshing.release()
+
+    def _refresh_thread(self):
+        try:
+            self._refresh()
+        finally:
+            # 数据库缓存在本线程打开的连接
+            connections.close_all()
+
+    def refresh_in_background(self):
+        thread = threading.Thread(target=self._refresh_thread, name='wechatpay-certs', daemon=True)
+        thread.start()
+        return thread
+
+    # ------------------------------------------------------------------
+    # 验签和解密
+    # ------------------------------------------------------------------
+
+    def public_key(self, serial_no):
+        """序列号对应的平台公钥，找不到返回 None"""
+        self._ensure_loaded()
+        serial = _normalize_serial(serial_no)
+        key = self._keys.get(serial)
+        if key is not None:
+            if self._needs_refresh() and not self._refreshing.locked():
+                self.refresh_in_background()
+            return key
+        if self.public_key_mode or self.clock() - self._last_miss_refresh < MISS_REFRESH_INTERVAL:
+            return None
+        # 未知序列号：微信可能已轮换证书，同步刷新一次
+        self._last_miss_refresh = self.clock()
+        self._refresh()
+        return self._keys.get(serial)
+
+    def verify(self, headers, body):
+        """验证回调签名，body 为字符串"""
+        if _header(headers, 'Wechatpay-Signature-Type') != SIGNATURE_TYPE:
+            return False
+        public_key = self.public_key(_header(headers, 'Wechatpay-Serial'))
+        if public_key is None:
+            logger.warning("回调使用未知的平台证书序列号: %s", _header(headers, 'Wechatpay-Serial'))
+            return False
+        message = f"{_header(headers, 'Wechatpay-Timestamp')}\n{_header(headers, 'Wechatpay-Nonce')}\n{body}\n"
+        try:
+            signature = base64.b64decode(_header(headers, 'Wechatpay-Signature'))
+            public_key.verify(signature, message.encode(), padding.PKCS1v15(), hashes.SHA256())
+        except (InvalidSignature, ValueError):
+            return False
+        return True
+
+    def decrypt(self, resource):
+        """解密回调中的 resource（AEAD_AES_256_GCM），返回明文字符串，失败返回 None"""
+        self._ensure_loaded()
+        if resource.get('algorithm') != 'AEAD_AES_256_GCM' or not resource.get('nonce'):
+            return None
+        try:
+            return self._aesgcm.decrypt(
+                resource['nonce'].encode(),
+                base64.b64decode(resource.get('ciphertext', '')),
+                (resource.get('associated_data') or '').encode(),
+            ).decode()
+        except (InvalidTag, ValueError):
+            return None
+
+    def callback(self, headers, body):
+        """验签并解密回调，返回值与 wechatpayv3 的 callback 一致：resource 替换为解密后的字典"""
+        if isinstance(body, bytes):
+            body = body.decode('utf-8')
+        if not self.verify(headers, body):
+            return None
+        data = json.loads(body)
+        if data.get('resource_type') != 'encrypt-resource':
+            return None
+        plaintext = self.decrypt(data.get('resource') or {})
+        if plaintext is None:
+            return None
+        data['resource'] = json.loads(plaintext)
+        return data
+
+    def seed_cert_dir(self, cert_dir):
+        """证书模式下把缓存中的证书写入 SDK 的证书目录，冷启动构造客户端时不必重新下载"""
+        if self.public_key_mode or any(name.endswith('.pem') for name in os.listdir(cert_dir)):
+            return
+        for pem in self._cache_get() or []:
+            cert = x509.load_pem_x509_certificate(pem.encode())
+            with open(os.path.join(cert_dir, f'{format(cert.serial_number, "X")}.pem'), 'w') as f:
+                f.write(pem)
+
+
+platform_keys = PlatformKeyStore()
+
@@ -1,262 +1,398 @@
 """微信支付工具类 - 使用微信支付 V3 API"""
+import asyncio
+import functools
+import json
+import logging
 import os
 import time
 import uuid
 from datetime import datetime, timedelta
 
+from asgiref.sync import sync_to_async
 from django.conf import settings
-from wechatpayv3 import WeChatPay, WeChatPayType
+
+from .circuit_breaker import CircuitOpenError, wechat_pay_breaker
+from .deadline import Deadline, DeadlineExceeded
+from .tracing import trace_span
+
+logger = logging.getLogger(__name__)
+
+
+def _mask(value):
+    """证书序列号脱敏：只保留首尾 8 位"""
+    if len(value) <= 16:
+        return value[:8] + '...'
+    return f'{value[:8]}...{value[-8:]}'
+
+
+def get_cert_dir():
+    """平台证书缓存目录（Vercel Serverless 环境只有 /tmp 可写）"""
+    cert_dir = '/tmp/wechatpay_certs' if os.environ.get('VERCEL') else os.path.join(settings.BASE_DIR, 'wechatpay_certs')
+    os.makedirs(cert_dir, exist_ok=True)
+    return cert_dir
+
+
+def build_init_params(cert_dir):
+    """构建 wechatpayv3 客户端初始化参数（同步/异步客户端共用）"""
+    from wechatpayv3 import WeChatPayType
+
+    init_params = {
+        'wechatpay_type': WeChatPayType.NATIVE,
+        'mchid': settings.WECHAT_MCH_ID,
+        'private_key': settings.WECHAT_PRIVATE_KEY,
+        'cert_serial_no': settings.WECHAT_SERIAL_NO,
+        'apiv3_key': settings.WECHAT_API_V3_KEY,
+        'appid': settings.WECHAT_APP_ID,
+        'notify_url': settings.WECHAT_PAY_NOTIFY_URL,
+    }
+
+    # 如果配置了平台公钥，使用公钥模式（新商户号）；否则使用证书模式
+    if settings.WECHAT_PLATFORM_CERT and settings.WECHAT_PLATFORM_CERT_SERIAL_NO:
+        init_params['public_key'] = settings.WECHAT_PLATFORM_CERT
+        init_params['public_key_id'] = settings.WECHAT_PLATFORM_CERT_SERIAL_NO
+    else:
+        from .wechat_certs import platform_keys
+
+        platform_keys.seed_cert_dir(cert_dir)
+        init_params['cert_dir'] = cert_dir
+
+    return init_params
+
+
+def apply_api_base_url(wxpay):
+    """配置了 WECHAT_PAY_API_BASE_URL 时把请求发往该地址（本地模拟器），否则使用微信官方网关"""
+    base_url = settings.WECHAT_PAY_API_BASE_URL
+    if base_url:
+        wxpay._core._gate_way = base_url.rstrip('/')
+    return wxpay
+
+
+def set_request_timeout(wxpay, timeout):
+    """设置同步客户端后续请求的超时（秒）
+
+    wechatpayv3 没有公开的接口：Core 每次调用 requests 时读取私有属性 _timeout（2.x），
+    升级 SDK 时需要确认该属性仍然存在。
+    """
+    wxpay._core._timeout = timeout
+
+
+def isolate_request_headers(wxpay):
+    """每次请求使用新的 headers 字典
+
+    wechatpayv3 的 Core.request 以可变的 headers={} 作为默认参数，并在其中写入 Authorization。
+    多线程共用该字典时，一个线程的签名可能被另一个线程覆盖后才发出，微信返回 401 SIGN_ERROR。
+    """
+    request = wxpay._core.request
+
+    @functools.wraps(request)
+    def wrapper(*args, headers=None, **kwargs):
+        return request(*args, headers=dict(headers or {}), **kwargs)
+
+    wxpay._core.request = wrapper
+    return wxpay
+
+
+def build_native_order_params(order):
+    """构建 Native 下单参数"""
+    # 计算订单金额（单位：分）
+    total_amount = int(order.total_amount * 100)
+
+    # 计算订单过期时间
+    time_expire = order.expires_at.strftime('%Y-%m-%dT%H:%M:%S+08:00') if order.expires_at else None
+
+    return {
+        'description': f'{order.product.name}',
+        'out_trade_no': order.out_trade_no,
+        'amount': {'total': total_amount},
+        'time_expire': time_expire,
+    }
+
+
+def parse_response_message(message):
+    """解析微信支付 API 响应：公钥模式返回 JSON 字符串，证书模式直接返回字典"""
+    if isinstance(message, str):
+        try:
+            return json.loads(message)
+        except json.JSONDecodeError:
+            raise Exception(f'JSON 解析失败: {message}')
+    elif isinstance(message, dict):
+        return message
+    raise Exception(f'未知的响应类型: {type(message).__name__}')
+
+
+def verify_notify(headers, body):
+    """验证微信支付回调签名并解密
+
+    使用 wechat_certs.platform_keys 中缓存的平台公钥，热实例只做内存中的验签和解密，
+    不需要构造 WeChatPayClient。
+
+    Returns:
+        验证成功返回解密后的数据，失败返回 None
+    """
+    # 延迟导入：cryptography 只在处理回调时加载
+    from .wechat_certs import platform_keys
+
+    try:
+        return platform_keys.callback(headers, body)
+    except Exception as e:
+        logger.warning("回调验证失败: %s", e)
+        return None
+
+
+def is_timeout_error(error):
+    """判断是否是网络超时/连接错误（包括请求时间预算用完、熔断器打开）"""
+    error_str = str(error).lower()
+    return (
+        isinstance(error, (DeadlineExceeded, TimeoutError, CircuitOpenError))
+        or 'timeout' in error_str or 'timed out' in error_str or 'connection' in error_str or '超时' in error_str
+    )
+
+
+class WeChatPayCallError(Exception):
+    """微信支付 API 调用最终失败
+
+    Attributes:
+        attempts: 实际发起的请求次数
+        elapsed: 从截止时间开始计时到放弃时的耗时（秒）
+    """
+
+    def __init__(self, message, attempts, elapsed):
+        super().__init__(message)
+        self.attempts = attempts
+        self.elapsed = elapsed
+
+
+# 客户端单次请求的默认超时（秒）
+DEFAULT_TIMEOUT = 30
+
+
+def default_deadline(deadline=None):
+    """未传入截止时间时，使用 WECHAT_PAY_DEADLINE_SECONDS 作为本次调用的预算"""
+    return deadline or Deadline(settings.WECHAT_PAY_DEADLINE_SECONDS)
+
+
+def _retry_backoff(attempt):
+    """第 attempt 次失败后的退避时间：1秒、2秒、4秒"""
+    return 2 ** (attempt - 1)
+
+
+def _record_outcome(breaker, started, code=None):
+    """把一次请求的结果计入熔断器：网络异常、5xx 和 429 算失败，订单不存在等业务错误不算"""
+    if breaker is not None:
+        breaker.record(code is not None and code < 500 and code != 429, time.monotonic() - started)
+
+
+def _check_response(label, code, message):
+    if code != 200:
+        error_msg = message if isinstance(message, str) else str(message)
+        raise Exception(f'{label}失败 (code={code}): {error_msg}')
+    # 公钥模式返回 JSON 字符串，证书模式直接返回字典
+    return parse_response_message(message)
+
+
+def _extract_code_url(message_dict):
+    code_url = message_dict.get('code_url')
+    if not code_url:
+        raise Exception(f'微信支付返回成功但缺少 code_url: {message_dict}')
+    return code_url
+
+
+def _native_order_error(error):
+    """下单最终失败时，根据错误类型返回更友好的提示"""
+    if isinstance(error.__cause__, CircuitOpenError):
+        message = '支付系统连接超时，请稍后重试。'
+    elif is_timeout_error(error):
+        message = (
+            f'微信支付服务连接超时，请稍后重试。已尝试{error.attempts}次，耗时{error.elapsed:.1f}秒。'
+            f'详细错误: {error}'
+        )
+    else:
+        message = f'微信支付下单失败: {error}'
+    return WeChatPayCallError(message, error.attempts, error.elapsed)
 
 
 class WeChatPayClient:
     """微信支付客户端 - 使用微信支付 V3 API"""
 
-    def __init__(self, timeout=30):
+    def __init__(self, timeout=DEFAULT_TIMEOUT):
         """初始化微信支付客户端
 
         Args:
-            timeout: HTTP请求超时时间（秒），默认30秒
+            timeout: HTTP请求超时时间（秒），同时限制证书模式初始化时的平台证书下载；
+                在请求的时间预算内调用时传入 deadline.timeout(cap=...)
         """
         self.timeout = timeout
 
         # 创建证书缓存目录
-        # Vercel Serverless 环境只有 /tmp 可写
-        cert_dir = '/tmp/wechatpay_certs' if os.environ.get('VERCEL') else os.path.join(settings.BASE_DIR, 'wechatpay_certs')
-        os.makedirs(cert_dir, exist_ok=True)
-
-        # 打印配置信息（脱敏）用于调试
-        print("=" * 60)
-        print("微信支付初始化配置检查:")
-        print(f"  商户号 (mchid): {settings.WECHAT_MCH_ID}")
-        print(f"  AppID: {settings.WECHAT_APP_ID}")
-        print(f"  证书序列号: {settings.WECHAT_SERIAL_NO[:8]}...{settings.WECHAT_SERIAL_NO[-8:] if len(settings.WECHAT_SERIAL_NO) > 16 else ''}")
-        print(f"  APIv3密钥长度: {len(settings.WECHAT_API_V3_KEY)} 字符")
-        print(f"  私钥格式: {'✅ 包含 BEGIN PRIVATE KEY' if 'BEGIN PRIVATE KEY' in settings.WECHAT_PRIVATE_KEY else '❌ 格式错误'}")
-        print(f"  平台证书: {'✅ 已配置' if settings.WECHAT_PLATFORM_CERT else '⚠️  未配置'}")
-        if settings.WECHAT_PLATFORM_CERT:
-            print(f"  平台证书序列号: {settings.WECHAT_PLATFORM_CERT_SERIAL_NO[:8]}...{settings.WECHAT_PLATFORM_CERT_SERIAL_NO[-8:] if len(settings.WECHAT_PLATFORM_CERT_SERIAL_NO) > 16 else ''}")
-        print(f"  证书目录: {cert_dir}")
-        print(f"  回调 URL: {settings.WECHAT_PAY_NOTIFY_URL}")
-        print(f"  HTTP超时设置: {timeout} 秒")
-        print("=" * 60)
+        cert_dir = get_cert_dir()
+
+        # 配置信息（脱敏）仅在 DEBUG 级别输出，用于排查证书配置问题
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(
+                "微信支付初始化配置: mchid=%s, appid=%s, serial_no=%s, apiv3_key_len=%d, "
+                "private_key_ok=%s, platform_cert=%s, platform_serial=%s, cert_dir=%s, notify_url=%s, timeout=%s",
+                settings.WECHAT_MCH_ID,
+                settings.WECHAT_APP_ID,
+                _mask(settings.WECHAT_SERIAL_NO),
+                len(settings.WECHAT_API_V3_KEY),
+                'BEGIN PRIVATE KEY' in settings.WECHAT_PRIVATE_KEY,
+                bool(settings.WECHAT_PLATFORM_CERT),
+                _mask(settings.WECHAT_PLATFORM_CERT_SERIAL_NO),
+                cert_dir,
+                settings.WECHAT_PAY_NOTIFY_URL,
+                timeout,
+            )
 
         try:
-            print("\n正在初始化微信支付客户端...")
-
-            # 准备基础初始化参数
-            init_params = {
-                'wechatpay_type': WeChatPayType.NATIVE,
-                'mchid': settings.WECHAT_MCH_ID,
-                'private_key': settings.WECHAT_PRIVATE_KEY,
-                'cert_serial_no': settings.WECHAT_SERIAL_NO,
-                'apiv3_key': settings.WECHAT_API_V3_KEY,
-                'appid': settings.WECHAT_APP_ID,
-                'notify_url': settings.WECHAT_PAY_NOTIFY_URL,
-            }
-
-            # 如果配置了平台公钥，使用公钥模式（新商户号）
-            if settings.WECHAT_PLATFORM_CERT and settings.WECHAT_PLATFORM_CERT_SERIAL_NO:
-                print("  → 使用公钥模式（新商户号）")
-                init_params['public_key'] = settings.WECHAT_PLATFORM_CERT
-                init_params['public_key_id'] = settings.WECHAT_PLATFORM_CERT_SERIAL_NO
-                print(f"  → 公钥ID: {settings.WECHAT_PLATFORM_CERT_SERIAL_NO[:8]}...{settings.WECHAT_PLATFORM_CERT_SERIAL_NO[-8:]}")
-            else:
-                # 使用证书模式（需要自动下载或手动配置平台证书）
-                print("  → 使用证书模式（将自动下载平台证书）")
-                init_params['cert_dir'] = cert_dir
-
-            self.wxpay = WeChatPay(**init_params)
-
-            # 配置底层 requests Session 的超时和重试
-            if hasattr(self.wxpay, '_core'):
-                from requests.adapters import HTTPAdapter
-                from urllib3.util.retry import Retry
-
-                # 创建重试策略
-                retry_strategy = Retry(
-                    total=3,  # 最多重试3次
-                    backoff_factor=1,  # 指数退避因子
-                    status_forcelist=[429, 500, 502, 503, 504],  # 对这些HTTP状态码重试
-                    allowed_methods=["GET", "POST"]  # 允许重试的HTTP方法
-                )
+            # 延迟导入：wechatpayv3 会加载 cryptography 和 requests，
+            # 前台页面只用到 generate_out_trade_no，不需要在模块导入时加载
+            from wechatpayv3 import WeChatPay
 
-                adapter = HTTPAdapter(max_retries=retry_strategy)
+            # 准备初始化参数
+            init_params = build_init_params(cert_dir)
 
-                # 如果 _core 有 session 属性，配置它
-                if hasattr(self.wxpay._core, 'session'):
-                    self.wxpay._core.session.mount("https://", adapter)
-                    self.wxpay._core.session.mount("http://", adapter)
-                    print(f"✅ 已配置 HTTP 重试策略: 最多3次, 超时{timeout}秒")
-
-            print("✅ 微信支付客户端初始化成功")
+            # 公钥模式（新商户号）或证书模式（自动下载平台证书）
+            logger.debug("微信支付使用%s", '公钥模式' if 'public_key' in init_params else '证书模式')
 
+            # timeout 同时限制证书模式初始化时的平台证书下载；之后每次请求的超时由 _call 按截止时间设置
+            self.wxpay = isolate_request_headers(apply_api_base_url(WeChatPay(timeout=timeout, **init_params)))
         except Exception as e:
-            print(f"❌ 微信支付初始化失败: {e}")
-            import traceback
-            traceback.print_exc()
+            logger.error("微信支付初始化失败: %s", e, exc_info=True)
             raise Exception(f"微信支付配置错误: {str(e)}")
 
-    def create_native_order(self, order, max_retries=3):
-        """
-        创建 Native 支付订单 (扫码支付)
-        返回支付二维码 URL
+    def _call(self, label, operation, call, deadline, max_retries, order_id=None):
+        """在截止时间内调用微信支付 API，失败时退避重试
+
+        每次请求的超时取剩余预算（不超过 self.timeout）；剩余预算不够退避后再试一次时直接放弃。
+        熔断器打开时不发请求，直接失败（见 circuit_breaker.py）。
 
         Args:
-            order: Order 对象
-            max_retries: 最大重试次数，默认3次
+            label: 日志和错误信息中的操作名称
+            operation: trace_span 的操作名
+            call: 发起请求的无参函数，返回 (code, message)
+            deadline: 截止时间
+            max_retries: 最多尝试次数
+            order_id: 关联的订单 ID（追踪用）
 
         Returns:
-            code_url: 支付二维码链接
-        """
-        # 计算订单金额（单位：分）
-        total_amount = int(order.total_amount * 100)
-
-        # 计算订单过期时间
-        time_expire = order.expires_at.strftime('%Y-%m-%dT%H:%M:%S+08:00') if order.expires_at else None
+            解析后的响应字典
 
-        # 构建订单数据
-        out_trade_no = order.out_trade_no
-        description = f'{order.product.name}'
-
-        # 重试逻辑
+        Raises:
+            WeChatPayCallError: 所有尝试失败或截止时间已到
+        """
+        breaker = wechat_pay_breaker()
         last_exception = None
-        for attempt in range(max_retries):
+        attempts = 0
+        retry_sleep = 0
+        for attempt in range(1, max_retries + 1):
+            try:
+                set_request_timeout(self.wxpay, deadline.timeout(cap=self.timeout))
+                if breaker is not None:
+                    breaker.before_call()
+            except (DeadlineExceeded, CircuitOpenError) as e:
+                last_exception = e
+                break
+            attempts = attempt
+            started = time.monotonic()
             try:
-                print(f"\n{'='*60}")
-                print(f"尝试创建支付订单 (第 {attempt + 1}/{max_retries} 次)")
-                print(f"  订单号: {out_trade_no}")
-                print(f"  金额: {total_amount / 100:.2f} 元")
-                print(f"  商品: {description}")
-                print(f"{'='*60}\n")
-
-                # 调用 Native 下单 API
-                code, message = self.wxpay.pay(
-                    description=description,
-                    out_trade_no=out_trade_no,
-                    amount={'total': total_amount},
-                    time_expire=time_expire,
+                with trace_span('wechat', operation, attempt, retry_sleep, order_id) as span:
+                    try:
+                        code, message = call()
+                    except Exception:
+                        _record_outcome(breaker, started)
+                        raise
+                    span.status_code = code
+                _record_outcome(breaker, started, code)
+                return _check_response(label, code, message)
+            except Exception as e:
+                last_exception = e
+                logger.warning(
+                    "%s第 %d/%d 次失败 (%s, 已用 %.2fs): %s",
+                    label, attempt, max_retries, '网络超时' if is_timeout_error(e) else '其他错误', deadline.elapsed, e,
                 )
+                retry_sleep = _retry_backoff(attempt)
+                if attempt == max_retries or not deadline.allows_retry(retry_sleep):
+                    break
+                time.sleep(retry_sleep)
 
-                print(f"微信支付 API 响应: code={code}, message type={type(message)}")
-
-                if code == 200:
-                    # 检查 message 类型并解析
-                    if isinstance(message, str):
-                        # 公钥模式返回 JSON 字符串，需要解析
-                        try:
-                            import json
-                            message_dict = json.loads(message)
-                            print(f"✅ JSON 解析成功: {message_dict}")
-                        except json.JSONDecodeError as je:
-                            raise Exception(f'JSON 解析失败: {message}')
-                    elif isinstance(message, dict):
-                        # 证书模式直接返回字典
-                        message_dict = message
-                    else:
-                        raise Exception(f'未知的响应类型: {type(message).__name__}')
-
-                    # 提取 code_url
-                    code_url = message_dict.get('code_url')
-                    if code_url:
-                        print(f"✅ 支付二维码生成成功: {code_url}")
-                        return code_url
-                    else:
-                        raise Exception(f'微信支付返回成功但缺少 code_url: {message_dict}')
-                else:
-                    # 支付失败
-                    error_msg = message if isinstance(message, str) else str(message)
-                    raise Exception(f'微信支付下单失败 (code={code}): {error_msg}')
+        raise WeChatPayCallError(str(last_exception), attempts, deadline.elapsed) from last_exception
 
-            except Exception as e:
-                last_exception = e
-                error_str = str(e)
+    def create_native_order(self, order, max_retries=3, deadline=None):
+        """
+        创建 Native 支付订单 (扫码支付)
+        返回支付二维码 URL
 
-                # 判断是否是网络超时错误
-                is_timeout = (
-                    'timeout' in error_str.lower() or
-                    'timed out' in error_str.lower() or
-                    'connection' in error_str.lower()
-                )
+        Args:
+            order: Order 对象
+            max_retries: 最大尝试次数，默认3次
+            deadline: 截止时间（Deadline），默认 WECHAT_PAY_DEADLINE_SECONDS
+
+        Returns:
+            code_url: 支付二维码链接
 
-                print(f"❌ 第 {attempt + 1} 次尝试失败: {e}")
-                print(f"   错误类型: {'网络超时' if is_timeout else '其他错误'}")
-
-                if attempt < max_retries - 1:
-                    # 还有重试机会，计算等待时间（指数退避）
-                    wait_time = 2 ** attempt  # 1秒、2秒、4秒
-                    print(f"   ⏳ 等待 {wait_time} 秒后重试...\n")
-                    time.sleep(wait_time)
-                else:
-                    # 所有重试都失败
-                    print(f"\n{'='*60}")
-                    print(f"❌ 创建支付订单失败，已尝试 {max_retries} 次")
-                    print(f"最后错误: {last_exception}")
-                    print(f"{'='*60}\n")
-
-                    # 根据错误类型返回更友好的提示
-                    if is_timeout:
-                        raise Exception(f'微信支付服务连接超时，请稍后重试。已尝试{max_retries}次。详细错误: {last_exception}')
-                    else:
-                        raise Exception(f'微信支付下单失败: {last_exception}')
-
-        # 理论上不会到这里，但为了安全
-        if last_exception:
-            raise last_exception
-
-    def query_order(self, out_trade_no, max_retries=3):
+        Raises:
+            WeChatPayCallError: 下单失败，带尝试次数和耗时
+        """
+        deadline = default_deadline(deadline)
+        params = build_native_order_params(order)
+        logger.debug("创建支付订单: 订单号=%s, 金额=%s 分", params['out_trade_no'], params['amount']['total'])
+
+        try:
+            message_dict = self._call(
+                '微信支付下单', 'native_order', lambda: self.wxpay.pay(**params), deadline, max_retries, order.id,
+            )
+            code_url = _extract_code_url(message_dict)
+        except WeChatPayCallError as e:
+            logger.error("创建支付订单失败，已尝试 %d 次，耗时 %.2fs: %s", e.attempts, e.elapsed, e)
+            raise _native_order_error(e) from e
+
+        logger.info("支付二维码生成成功: 订单号=%s, 耗时=%.2fs", params['out_trade_no'], deadline.elapsed)
+        return code_url
+
+    def query_order(self, out_trade_no, max_retries=3, deadline=None):
         """
         查询订单支付状态
 
         Args:
             out_trade_no: 商户订单号
-            max_retries: 最大重试次数，默认3次
+            max_retries: 最大尝试次数，默认3次
+            deadline: 截止时间（Deadline），默认 WECHAT_PAY_DEADLINE_SECONDS
 
         Returns:
             订单详情字典
         """
-        last_exception = None
-        for attempt in range(max_retries):
-            try:
-                print(f"尝试查询订单状态 (第 {attempt + 1}/{max_retries} 次): {out_trade_no}")
-
-                code, message = self.wxpay.query(out_trade_no=out_trade_no)
-
-                print(f"查询订单 API 响应: code={code}, message type={type(message)}")
-
-                if code == 200:
-                    # 检查 message 类型并解析（与创建订单逻辑一致）
-                    if isinstance(message, str):
-                        # 公钥模式返回 JSON 字符串
-                        try:
-                            import json
-                            message_dict = json.loads(message)
-                            print(f"✅ 查询结果解析成功")
-                            return message_dict
-                        except json.JSONDecodeError:
-                            raise Exception(f'JSON 解析失败: {message}')
-                    elif isinstance(message, dict):
-                        # 证书模式直接返回字典
-                        return message
-                    else:
-                        raise Exception(f'未知的响应类型: {type(message).__name__}')
-                else:
-                    error_msg = message if isinstance(message, str) else str(message)
-                    raise Exception(f'查询订单失败 (code={code}): {error_msg}')
+        return self._call(
+            '查询订单', 'query_order', lambda: self.wxpay.query(out_trade_no=out_trade_no),
+            default_deadline(deadline), max_retries,
+        )
 
-            except Exception as e:
-                last_exception = e
-                print(f"❌ 第 {attempt + 1} 次查询失败: {e}")
+    def download_trade_bill(self, bill_date, max_retries=3, deadline=None):
+        """
+        下载交易账单（全部交易，GZIP 压缩）
 
-                if attempt < max_retries - 1:
-                    wait_time = 2 ** attempt
-                    print(f"   ⏳ 等待 {wait_time} 秒后重试...")
-                    time.sleep(wait_time)
-                else:
-                    print(f"❌ 查询订单失败，已尝试 {max_retries} 次: {e}")
-                    raise
+        Args:
+            bill_date: 账单日期（date），只能下载前一天及更早的账单
+            max_retries: 申请和下载各自的最大尝试次数
+            deadline: 截止时间（Deadline），申请和下载共用
 
-        if last_exception:
-            raise last_exception
+        Returns:
+            (账单内容 bytes, 摘要算法, 原始账单摘要)，摘要由 trade_bill.reconcile_trade_bill 在解压时校验
+        """
+        deadline = default_deadline(deadline)
+        info = self._call(
+            '申请交易账单', 'trade_bill',
+            lambda: self.wxpay.trade_bill(bill_date=bill_date.isoformat(), bill_type='ALL', tar_type='GZIP'),
+            deadline, max_retries,
+        )
+
+        def download():
+            code, content = self.wxpay.download_bill(info['download_url'])
+            # 下载地址返回文件内容，不是 JSON
+            return code, {'content': content} if code == 200 else content
+
+        result = self._call('下载交易账单', 'download_bill', download, deadline, max_retries)
+        logger.info("交易账单下载完成: %s, %d 字节, 耗时=%.2fs", bill_date, len(result['content']), deadline.elapsed)
+        return result['content'], info.get('hash_type', 'SHA1'), info.get('hash_value')
 
     def verify_notify(self, headers, body):
         """
@@ -269,12 +405,7 @@ class WeChatPayClient:
         Returns:
             验证成功返回解密后的数据，失败返回 None
         """
-        try:
-            result = self.wxpay.callback(headers, body)
-            return result
-        except Exception as e:
-            print(f'回调验证失败: {e}')
-            return None
+        return verify_notify(headers, body)
 
     @staticmethod
     def generate_out_trade_no():
@@ -282,3 +413,104 @@ class WeChatPayClient:
         timestamp = int(time.time())
         random_str = uuid.uuid4().hex[:8].upper()
         return f'ORDER_{timestamp}_{random_str}'
+
+
+class AsyncWeChatPayClient:
+    """微信支付异步客户端 - 基于 wechatpayv3 AsyncWeChatPay（httpx）
+
+    供 ASGI 部署下的异步视图使用，等待微信响应和重试退避期间不占用工作线程。
+
+    用法:
+        async with AsyncWeChatPayClient(timeout=10) as client:
+            result = await client.query_order(out_trade_no)
+    """
+
+    def __init__(self, timeout=DEFAULT_TIMEOUT):
+        from wechatpayv3.async_ import AsyncWeChatPay, WeChatPayType
+
+        self.timeout = timeout
+        try:
+            init_params = build_init_params(get_cert_dir())
+            # 异步 SDK 有自己的 WeChatPayType 枚举，同步版本的 NATIVE 与之不相等，下单会报 pay_type is not assigned
+            init_params['wechatpay_type'] = WeChatPayType.NATIVE
+            self.wxpay = isolate_request_headers(apply_api_base_url(
+                AsyncWeChatPay(timeout=timeout, **init_params)
+            ))
+        except Exception as e:
+            logger.error("微信支付异步客户端初始化失败: %s", e, exc_info=True)
+            raise Exception(f"微信支付配置错误: {str(e)}")
+
+    async def __aenter__(self):
+        await self.wxpay.__aenter__()
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        return await self.wxpay.__aexit__(exc_type, exc_val, exc_tb)
+
+    async def _call(self, label, operation, call, deadline, max_retries, order_id=None):
+        """WeChatPayClient._call 的异步版本，单次请求用 asyncio.wait_for 限制在剩余预算内"""
+        breaker = wechat_pay_breaker()
+        last_exception = None
+        attempts = 0
+        retry_sleep = 0
+        for attempt in range(1, max_retries + 1):
+            try:
+                timeout = deadline.timeout(cap=self.timeout)
+                if breaker is not None:
+                    # 熔断器状态可能在数据库缓存中，不能在事件循环里直接访问
+                    await sync_to_async(breaker.before_call)()
+            except (DeadlineExceeded, CircuitOpenError) as e:
+                last_exception = e
+                break
+            attempts = attempt
+            started = time.monotonic()
+            try:
+                with trace_span('wechat', operation, attempt, retry_sleep, order_id) as span:
+                    try:
+                        code, message = await asyncio.wait_for(call(), timeout)
+                    except Exception as e:
+                        await sync_to_async(_record_outcome)(breaker, started)
+                        if isinstance(e, asyncio.TimeoutError):
+                            raise TimeoutError(f'{label}请求超时（{timeout:.1f}s）') from None
+                        raise
+                    span.status_code = code
+                await sync_to_async(_record_outcome)(breaker, started, code)
+                return _check_response(label, code, message)
+            except Exception as e:
+                last_exception = e
+                logger.warning(
+                    "%s第 %s/%s 次失败 (已用 %.2fs): %s", label, attempt, max_retries, deadline.elapsed, e,
+                )
+                retry_sleep = _retry_backoff(attempt)
+                if attempt == max_retries or not deadline.allows_retry(retry_sleep):
+                    break
+                await asyncio.sleep(retry_sleep)
+
+        raise WeChatPayCallError(str(last_exception), attempts, deadline.elapsed) from last_exception
+
+    async def create_native_order(self, order, max_retries=3, deadline=None):
+        """创建 Native 支付订单，返回支付二维码 URL（参数与同步版本一致）"""
+        deadline = default_deadline(deadline)
+        params = build_native_order_params(order)
+        try:
+            message_dict = await self._call(
+                '微信支付下单', 'native_order', lambda: self.wxpay.pay(**params), deadline, max_retries, order.id,
+            )
+            code_url = _extract_code_url(message_dict)
+        except WeChatPayCallError as e:
+            logger.error("创建支付订单失败，已尝试 %d 次，耗时 %.2fs: %s", e.attempts, e.elapsed, e)
+            raise _native_order_error(e) from e
+
+        logger.info("支付二维码生成成功: 订单号=%s, 耗时=%.2fs", params['out_trade_no'], deadline.elapsed)
+        return code_url
+
+    async def query_order(self, out_trade_no, max_retries=3, deadline=None):
+        """查询订单支付状态，返回订单详情字典"""
+        return await self._call(
+            '查询订单', 'query_order', lambda: self.wxpay.query(out_trade_no=out_trade_no),
+            default_deadline(deadline), max_retries,
+        )
+
+    def verify_notify(self, headers, body):
+        """验证微信支付回调签名（见模块级 verify_notify）"""
+        return verify_notify(headers, body)
@@ -0,0 +1,522 @@
+"""本地微信支付 V3 模拟器（压测和联调用）
+
+实现 Native 下单、查询订单、关闭订单三个接口和支付成功回调：
+- 响应使用模拟器自己生成的平台密钥签名（公钥模式），wechatpayv3 客户端按正常流程验签；
+- 请求的 Authorization 签名使用商户公钥校验（密钥同样由模拟器生成）；
+- 回调报文使用 APIv3 密钥 AES-256-GCM 加密并签名，投递到下单时的 notify_url；
+- 支持注入延迟、错误和超时，可运行时通过 /simulator/config 调整。
+
+控制接口（不注入故障）：
+    POST /simulator/pay/<out_trade_no>   模拟用户扫码支付成功并投递回调
+    POST /simulator/config               修改故障注入参数（JSON）
+    GET  /simulator/orders               查看订单和回调统计
+    POST /simulator/feishu               飞书 Webhook 桩，压测时代替真实飞书
+
+通过 manage.py wechatpay_simulator 启动，生成的环境变量写入 <key-dir>/simulator.env。
+"""
+import base64
+import json
+import logging
+import random
+import re
+import secrets
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+from dataclasses import asdict, dataclass
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs, urlparse
+
+from cryptography.exceptions import InvalidSignature
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import padding, rsa
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+logger = logging.getLogger(__name__)
+
+PUBLIC_KEY_ID = 'PUB_KEY_ID_SIMULATOR'
+MERCHANT_SERIAL_NO = 'SIMULATOR0000000000000000000000000000001'
+DEFAULT_MCH_ID = '1900000001'
+DEFAULT_APP_ID = 'wx0000000000simulator'
+CHINA_TZ = timezone(timedelta(hours=8))
+
+_QUERY_PATH = re.compile(r'^/v3/pay/transactions/out-trade-no/(?P<no>[^/?]+)$')
+_CLOSE_PATH = re.compile(r'^/v3/pay/transactions/out-trade-no/(?P<no>[^/?]+)/close$')
+_AUTH_FIELDS = re.compile(r'(\w+)="([^"]*)"')
+
+
+@dataclass
+class FaultConfig:
+    """故障注入参数"""
+    latency_ms: float = 0.0          # 固定延迟
+    jitter_ms: float = 0.0           # 随机附加延迟上限
+    error_rate: float = 0.0          # 返回 500 SYSTEM_ERROR 的比例
+    timeout_rate: float = 0.0        # 挂起不响应的比例
+    timeout_seconds: float = 35.0    # 挂起时长（应大于客户端超时）
+    notify_delay: float = 0.0        # 支付成功后延迟投递回调（秒）
+    notify_retries: int = 3        # 回调失败重试次数
+    auto_pay_after: float = -1.0     # 下单后自动支付的秒数，< 0 表示不自动支付
+
+
+@dataclass
+class SimulatedOrder:
+    out_trade_no: str
+    description: str
+    total: int
+    notify_url: str
+    appid: str
+    mchid: str
+    code_url: str
+    trade_state: str = 'NOTPAY'
+    transaction_id: str = ''
+    success_time: str = ''
+    created_at: float = 0.0
+    notify_attempts: int = 0
+    notify_delivered: bool = False
+
+
+def generate_private_key_pem():
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    return key.private_bytes(
+        serialization.Encoding.PEM,
+        serialization.PrivateFormat.PKCS8,
+        serialization.NoEncryption(),
+    ).decode()
+
+
+def public_key_pem(private_key):
+    return private_key.public_key().public_bytes(
+        serialization.Encoding.PEM,
+        serialization.PublicFormat.SubjectPublicKeyInfo,
+    ).decode()
+
+
+class SimulatorKeys:
+    """模拟器密钥：平台私钥（签名响应和回调）、商户私钥（供客户端签名请求）、APIv3 密钥"""
+
+    def __init__(self, platform_private_pem, merchant_private_pem, apiv3_key):
+        self.platform_private_pem = platform_private_pem
+        self.merchant_private_pem = merchant_private_pem
+        self.apiv3_key = apiv3_key
+        self.platform_key = serialization.load_pem_private_key(platform_private_pem.encode(), None)
+        self.merchant_key = serialization.load_pem_private_key(merchant_private_pem.encode(), None)
+        self.platform_public_pem = public_key_pem(self.platform_key)
+
+    @classmethod
+    def load_or_create(cls, key_dir):
+        """从目录加载密钥，不存在时生成并保存（多次启动保持不变，应用无需重新配置）"""
+        key_dir = Path(key_dir)
+        key_dir.mkdir(parents=True, exist_ok=True)
+        files = {
+            'platform': key_dir / 'platform_private_key.pem',
+            'merchant': key_dir / 'merchant_private_key.pem',
+            'apiv3': key_dir / 'apiv3_key.txt',
+        }
+        if not files['platform'].exists():
+            files['platform'].write_text(generate_private_key_pem())
+        if not files['merchant'].exists():
+            files['merchant'].write_text(generate_private_key_pem())
+        if not files['apiv3'].exists():
+            files['apiv3'].write_text(secrets.token_hex(16))
+        return cls(
+            files['platform'].read_text(),
+            files['merchant'].read_text(),
+            files['apiv3'].read_text().strip(),
+        )
+
+    def sign(self, message):
+        signature = self.platform_key.sign(message.encode(), padding.PKCS1v15(), hashes.SHA256())
+        return base64.b64encode(signature).decode()
+
+    def verify_merchant(self, message, signature):
+        try:
+            self.merchant_key.public_key().verify(
+                base64.b64decode(signature), message.encode(), padding.PKCS1v15(), hashes.SHA256()
+            )
+        except (InvalidSignature, ValueError):
+            return False
+        return True
+
+    def signed_headers(self, body):
+        """按微信支付 V3 规则生成应答/回调签名头"""
+        timestamp = str(int(time.time()))
+        nonce = uuid.uuid4().hex
+        return {
+            'Wechatpay-Timestamp': timestamp,
+            'Wechatpay-Nonce': nonce,
+            'Wechatpay-Signature': self.sign(f'{timestamp}\n{nonce}\n{body}\n'),
+            'Wechatpay-Serial': PUBLIC_KEY_ID,
+            'Wechatpay-Signature-Type': 'WECHATPAY2-SHA256-RSA2048',
+        }
+
+    def encrypt_resource(self, plaintext, associated_data='transaction'):
+        nonce = secrets.token_hex(6)
+        ciphertext = AESGCM(self.apiv3_key.encode()).encrypt(
+            nonce.encode(), plaintext.encode(), associated_data.encode()
+        )
+        return {
+            'original_type': 'transaction',
+            'algorithm': 'AEAD_AES_256_GCM',
+            'ciphertext': base64.b64encode(ciphertext).decode(),
+            'associated_data': associated_data,
+            'nonce': nonce,
+        }
+
+    def env(self, base_url, mch_id=DEFAULT_MCH_ID, app_id=DEFAULT_APP_ID, notify_url=''):
+        """应用连接模拟器需要的环境变量"""
+        env = {
+            'WECHAT_PAY_API_BASE_URL': base_url,
+            'WECHAT_APP_ID': app_id,
+            'WECHAT_MCH_ID': mch_id,
+            'WECHAT_API_V3_KEY': self.apiv3_key,
+            'WECHAT_SERIAL_NO': MERCHANT_SERIAL_NO,
+            'WECHAT_PRIVATE_KEY': self.merchant_private_pem,
+            'WECHAT_PLATFORM_CERT': self.platform_public_pem,
+            'WECHAT_PLATFORM_CERT_SERIAL_NO': PUBLIC_KEY_ID,
+            'PAYMENT_TEST_MODE': 'False',
+            # 压测时不发真实邮件和飞书消息，飞书通知由模拟器应答
+            'EMAIL_BACKEND': 'django.core.mail.backends.dummy.EmailBackend',
+            'FEISHU_WEBHOOK_URL': f'{base_url}/simulator/feishu',
+        }
+        if notify_url:
+            env['WECHAT_PAY_NOTIFY_URL'] = notify_url
+        return env
+
+
+def format_env(env):
+    """输出 .env 格式，多行 PEM 用双引号包裹（python-dotenv 支持）"""
+    lines = []
+    for key, value in env.items():
+        if '\n' in value:
+            lines.append(f'{key}="{value.strip()}"')
+        else:
+            lines.append(f'{key}={value}')
+    return '\n'.join(lines) + '\n'
+
+
+class WeChatPaySimulator:
+    """模拟器状态：订单表、故障参数和统计，线程安全"""
+
+    def __init__(self, keys, faults=None, verify_signature=True):
+        self.keys = keys
+        self.faults = faults or FaultConfig()
+        self.verify_signature = verify_signature
+        self.orders = {}
+        self.lock = threading.Lock()
+        self.stats = {
+            'requests': 0, 'injected_errors': 0, 'injected_timeouts': 0,
+            'notify_sent': 0, 'notify_failed': 0,
+        }
+
+    def _count(self, key, n=1):
+        with self.lock:
+            self.stats[key] += n
+
+    # ------------------------------------------------------------------
+    # 故障注入
+    # ------------------------------------------------------------------
+
+    def inject_faults(self):
+        """返回 None 表示正常处理；返回 (status, body) 表示注入错误"""
+        faults = self.faults
+        delay = faults.latency_ms + random.uniform(0, faults.jitter_ms)
+        if delay > 0:
+            time.sleep(delay / 1000)
+        if faults.timeout_rate and random.random() < faults.timeout_rate:
+            self._count('injected_timeouts')
+            time.sleep(faults.timeout_seconds)
+        if faults.error_rate and random.random() < faults.error_rate:
+            self._count('injected_errors')
+            return 500, {'code': 'SYSTEM_ERROR', 'message': '系统错误（模拟器注入）'}
+        return None
+
+    # ------------------------------------------------------------------
+    # V3 接口
+    # ------------------------------------------------------------------
+
+    def create_native_order(self, data):
+        required = ('appid', 'mchid', 'description', 'out_trade_no', 'notify_url')
+        missing = [field for field in required if not data.get(field)]
+        total = (data.get('amount') or {}).get('total')
+        if missing or not isinstance(total, int) or total <= 0:
+            return 400, {'code': 'PARAM_ERROR', 'message': f'参数错误: {missing or "amount.total"}'}
+
+        out_trade_no = data['out_trade_no']
+        with self.lock:
+            order = self.orders.get(out_trade_no)
+            if order is not None:
+                if order.trade_state == 'SUCCESS':
+                    return 400, {'code': 'ORDERPAID', 'message': '该订单已支付'}
+                if order.trade_state == 'CLOSED':
+                    return 400, {'code': 'ORDERCLOSED', 'message': '该订单已关闭'}
+                # 重复下单返回同一个二维码
+                return 200, {'code_url': order.code_url}
+            order = SimulatedOrder(
+                out_trade_no=out_trade_no,
+                description=data['description'],
+                total=total,
+                notify_url=data['notify_url'],
+                appid=data['appid'],
+                mchid=data['mchid'],
+                code_url=f'weixin://wxpay/bizpayurl?pr=SIM{uuid.uuid4().hex[:12]}',
+                created_at=time.time(),
+            )
+            self.orders[out_trade_no] = order
+
+        if self.faults.auto_pay_after >= 0:
+            timer = threading.Timer(self.faults.auto_pay_after, self.pay, args=(out_trade_no,))
+            timer.daemon = True
+            timer.start()
+        return 200, {'code_url': order.code_url}
+
+    def query_order(self, out_trade_no):
+        with self.lock:
+            order = self.orders.get(out_trade_no)
+            if order is None:
+                return 404, {'code': 'ORDER_NOT_EXIST', 'message': '订单不存在'}
+            return 200, self._transaction(order)
+
+    def close_order(self, out_trade_no):
+        with self.lock:
+            order = self.orders.get(out_trade_no)
+            if order is None:
+                return 404, {'code': 'ORDER_NOT_EXIST', 'message': '订单不存在'}
+            if order.trade_state == 'SUCCESS':
+                return 400, {'code': 'ORDERPAID', 'message': '该订单已支付'}
+            order.trade_state = 'CLOSED'
+        return 204, None
+
+    def _transaction(self, order):
+        transaction = {
+            'appid': order.appid,
+            'mchid': order.mchid,
+            'out_trade_no': order.out_trade_no,
+            'trade_type': 'NATIVE',
+            'trade_state': order.trade_state,
+            'trade_state_desc': {'SUCCESS': '支付成功', 'CLOSED': '订单已关闭'}.get(order.trade_state, '订单未支付'),
+            'amount': {'total': order.total, 'currency': 'CNY'},
+        }
+        if order.trade_state == 'SUCCESS':
+            transaction.update({
+                'transaction_id': order.transaction_id,
+                'bank_type': 'OTHERS',
+                'attach': '',
+                'success_time': order.success_time,
+                'payer': {'openid': 'oSIMULATOR' + order.transaction_id[-8:]},
+            })
+            transaction['amount'].update({'payer_total': order.total, 'payer_currency': 'CNY'})
+        return transaction
+
+    # ------------------------------------------------------------------
+    # 支付与回调
+    # ------------------------------------------------------------------
+
+    def pay(self, out_trade_no, deliver=True):
+        """模拟支付成功并投递回调，返回 (status, body)
+
+        deliver=False 时只修改订单状态，由调用方用 build_notify 自行投递（测试用）
+        """
+        with self.lock:
+            order = self.orders.get(out_trade_no)
+            if order is None:
+                return 404, {'code': 'ORDER_NOT_EXIST', 'message': '订单不存在'}
+            if order.trade_state != 'NOTPAY':
+                return 400, {'code': 'INVALID_STATE', 'message': f'订单状态为 {order.trade_state}'}
+            order.trade_state = 'SUCCESS'
+            order.transaction_id = '4200' + datetime.now(CHINA_TZ).strftime('%Y%m%d') + secrets.token_hex(7)[:14]
+            order.success_time = datetime.now(CHINA_TZ).isoformat(timespec='seconds')
+
+        if deliver:
+            thread = threading.Thread(target=self._deliver_notify, args=(out_trade_no,), daemon=True)
+            thread.start()
+        return 200, {'out_trade_no': out_trade_no, 'transaction_id': order.transaction_id}
+
+    def build_notify(self, order):
+        """构造支付成功回调，返回 (body, headers)"""
+        body = json.dumps({
+            'id': str(uuid.uuid4()),
+            'create_time': datetime.now(CHINA_TZ).isoformat(timespec='seconds'),
+            'resource_type': 'encrypt-resource',
+            'event_type': 'TRANSACTION.SUCCESS',
+            'summary': '支付成功',
+            'resource': self.keys.encrypt_resource(
+                json.dumps(self._transaction(order), ensure_ascii=False)
+            ),
+        }, ensure_ascii=False)
+        headers = self.keys.signed_headers(body)
+        headers['Content-Type'] = 'application/json'
+        return body, headers
+
+    def _deliver_notify(self, out_trade_no):
+        if self.faults.notify_delay > 0:
+            time.sleep(self.faults.notify_delay)
+        order = self.orders[out_trade_no]
+        for attempt in range(self.faults.notify_retries + 1):
+            body, headers = self.build_notify(order)
+            with self.lock:
+                order.notify_attempts += 1
+            try:
+                request = urllib.request.Request(
+                    order.notify_url, data=body.encode(), headers=headers, method='POST'
+                )
+                with urllib.request.urlopen(request, timeout=10) as response:
+                    result = json.loads(response.read() or b'{}')
+                if result.get('code') == 'SUCCESS':
+                    with self.lock:
+                        order.notify_delivered = True
+                    self._count('notify_sent')
+                    return
+                logger.warning("回调未确认: %s, 响应=%s", out_trade_no, result)
+            except (urllib.error.URLError, OSError, ValueError) as e:
+                logger.warning("回调投递失败: %s, 第 %d 次, %s", out_trade_no, attempt + 1, e)
+            # 微信的回调重试间隔从 15 秒起，模拟器缩短为 1、2、4 秒
+            time.sleep(2 ** attempt)
+        self._count('notify_failed')
+
+    def snapshot(self):
+        with self.lock:
+            states = {}
+            for order in self.orders.values():
+                states[order.trade_state] = states.get(order.trade_state, 0) + 1
+            return {
+                'orders': len(self.orders),
+                'states': states,
+                'stats': dict(self.stats),
+                'faults': asdict(self.faults),
+            }
+
+    # ------------------------------------------------------------------
+    # 请求签名校验
+    # ------------------------------------------------------------------
+
+    def check_authorization(self, method, path, body, authorization):
+        if not self.verify_signature:
+            return True
+        scheme, _, params = authorization.partition(' ')
+        if scheme != 'WECHATPAY2-SHA256-RSA2048':
+            return False
+        fields = dict(_AUTH_FIELDS.findall(params))
+        try:
+            message = f"{method}\n{path}\n{fields['timestamp']}\n{fields['nonce_str']}\n{body}\n"
+            return self.keys.verify_merchant(message, fields['signature'])
+        except KeyError:
+            return False
+
+
+class SimulatorRequestHandler(BaseHTTPRequestHandler):
+    server_version = 'WeChatPaySimulator/1.0'
+    protocol_version = 'HTTP/1.1'
+
+    @property
+    def simulator(self):
+        return self.server.simulator
+
+    def log_message(self, format, *args):
+        logger.debug("%s - %s", self.address_string(), format % args)
+
+    def _read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length).decode() if length else ''
+
+    def _send(self, status, payload, sign=True):
+        body = '' if payload is None else json.dumps(payload, ensure_ascii=False)
+        encoded = body.encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(encoded)))
+        self.send_header('Request-ID', uuid.uuid4().hex)
+        if sign:
+            for key, value in self.simulator.keys.signed_headers(body).items():
+                self.send_header(key, value)
+        self.end_headers()
+        if encoded:
+            self.wfile.write(encoded)
+
+    def _handle_api(self, method):
+        simulator = self.simulator
+        simulator._count('requests')
+        body = self._read_body()
+        if not simulator.check_authorization(method, self.path, body, self.headers.get('Authorization', '')):
+            return self._send(401, {'code': 'SIGN_ERROR', 'message': '签名错误'})
+
+        injected = simulator.inject_faults()
+        if injected is not None:
+            return self._send(*injected)
+
+        parsed = urlparse(self.path)
+        if method == 'POST' and parsed.path == '/v3/pay/transactions/native':
+            try:
+                data = json.loads(body or '{}')
+            except ValueError:
+                return self._send(400, {'code': 'PARAM_ERROR', 'message': '请求体不是合法的 JSON'})
+            return self._send(*simulator.create_native_order(data))
+
+        match = _CLOSE_PATH.match(parsed.path)
+        if method == 'POST' and match:
+            return self._send(*simulator.close_order(match.group('no')))
+
+        match = _QUERY_PATH.match(parsed.path)
+        if method == 'GET' and match:
+            if not parse_qs(parsed.query).get('mchid'):
+                return self._send(400, {'code': 'PARAM_ERROR', 'message': '缺少 mchid'})
+            return self._send(*simulator.query_order(match.group('no')))
+
+        return self._send(404, {'code': 'NOT_FOUND', 'message': f'模拟器未实现该接口: {method} {parsed.path}'})
+
+    def _handle_control(self, method):
+        parsed = urlparse(self.path)
+        if method == 'GET' and parsed.path == '/simulator/orders':
+            return self._send(200, self.simulator.snapshot(), sign=False)
+        if method == 'POST' and parsed.path == '/simulator/feishu':
+            self._read_body()
+            return self._send(200, {'code': 0, 'msg': 'success'}, sign=False)
+        if method == 'POST' and parsed.path.startswith('/simulator/pay/'):
+            out_trade_no = parsed.path[len('/simulator/pay/'):]
+            return self._send(*self.simulator.pay(out_trade_no), sign=False)
+        if method == 'POST' and parsed.path == '/simulator/config':
+            try:
+                changes = json.loads(self._read_body() or '{}')
+                for key, value in changes.items():
+                    if not hasattr(self.simulator.faults, key):
+                        raise ValueError(f'未知参数: {key}')
+                    setattr(self.simulator.faults, key, type(getattr(self.simulator.faults, key))(value))
+            except ValueError as e:
+                return self._send(400, {'code': 'PARAM_ERROR', 'message': str(e)}, sign=False)
+            return self._send(200, asdict(self.simulator.faults), sign=False)
+        return self._send(404, {'code': 'NOT_FOUND', 'message': '未知的控制接口'}, sign=False)
+
+    def _dispatch(self, method):
+        if self.path.startswith('/simulator/'):
+            return self._handle_control(method)
+        return self._handle_api(method)
+
+    def do_GET(self):
+        self._dispatch('GET')
+
+    def do_POST(self):
+        self._dispatch('POST')
+
+
+class SimulatorServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, simulator):
+        super().__init__(address, SimulatorRequestHandler)
+        self.simulator = simulator
+
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}'
+
+
+def start_simulator(simulator, host='127.0.0.1', port=0):
+    """在后台线程启动模拟器（供压测命令在进程内使用），返回 server"""
+    server = SimulatorServer((host, port), simulator)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
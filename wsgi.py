@@ -2,6 +2,9 @@
 WSGI entrypoint for Vercel deployment.
 This file adds the django_shop directory to the Python path
 and imports the actual WSGI application.
+
+Startup diagnostics are opt-in: set WSGI_DIAGNOSTICS=true to print the
+database and middleware configuration on each cold start.
 """
 import os
 import sys
@@ -14,19 +17,17 @@ if project_dir not in sys.path:
 # Set the settings module
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'core.settings')
 
-# Import the WSGI application
-try:
-    from django.core.wsgi import get_wsgi_application
+DIAGNOSTICS_ENABLED = os.environ.get('WSGI_DIAGNOSTICS', 'False').lower() in ('true', '1', 'yes')
+
 
-    # Log initialization info
+def print_diagnostics():
+    """Print database and middleware configuration (only when WSGI_DIAGNOSTICS is enabled)."""
     database_url = os.environ.get('DATABASE_URL', '')
-    print(f"[INIT] Initializing Django WSGI application...")
     print(f"[INIT] DATABASE_URL: {'SET (length: ' + str(len(database_url)) + ')' if database_url else 'NOT SET'}")
     print(f"[INIT] DEBUG: {os.environ.get('DEBUG', 'not set')}")
 
     # Log database URL details (safely, without exposing password)
     if database_url:
-        # Parse URL to show structure
         import re
         url_pattern = r'postgresql://([^:]+):([^@]+)@([^/]+)/(.+)'
         match = re.match(url_pattern, database_url)
@@ -39,27 +40,29 @@ try:
         else:
             print(f"[INIT] WARNING: DATABASE_URL format may be incorrect")
 
-    application = get_wsgi_application()
-
-    # Vercel requires the variable to be named 'app' or 'handler'
-    app = application
-
-    # Debug: Print middleware configuration
     from django.conf import settings
     print(f"[INIT] MIDDLEWARE configuration:")
     for i, middleware in enumerate(settings.MIDDLEWARE, 1):
         print(f"[INIT]   {i}. {middleware}")
 
-    # Check if BasicAuthMiddleware is in the list
-    basic_auth_enabled = any('BasicAuthMiddleware' in m for m in settings.MIDDLEWARE)
-    print(f"[INIT] BasicAuthMiddleware in MIDDLEWARE: {basic_auth_enabled}")
-
-    # Check environment variables
     print(f"[INIT] BASIC_AUTH_ENABLED env: {os.environ.get('BASIC_AUTH_ENABLED', 'NOT_SET')}")
     print(f"[INIT] BASIC_AUTH_USERNAME env: {'SET' if os.environ.get('BASIC_AUTH_USERNAME') else 'NOT_SET'}")
     print(f"[INIT] BASIC_AUTH_PASSWORD env: {'SET' if os.environ.get('BASIC_AUTH_PASSWORD') else 'NOT_SET'}")
+    print(f"[INIT] BASIC_AUTH_DEBUG_HEADERS env: {os.environ.get('BASIC_AUTH_DEBUG_HEADERS', 'NOT_SET')}")
+
+
+# Import the WSGI application
+try:
+    from django.core.wsgi import get_wsgi_application
+
+    application = get_wsgi_application()
+
+    # Vercel requires the variable to be named 'app' or 'handler'
+    app = application
 
-    print(f"[INIT] ✅ WSGI application initialized successfully")
+    if DIAGNOSTICS_ENABLED:
+        print_diagnostics()
+        print(f"[INIT] ✅ WSGI application initialized successfully")
 
 except Exception as e:
     # Log detailed error for debugging in Vercel logs